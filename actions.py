@@ -0,0 +1,334 @@
+"""Validation for the /<resource>/manage endpoints, compiled from openapi.json.
+
+The request schema of each /<resource>/manage operation in openapi.json is
+the contract: its "properties" give every field's type, and its
+"x-actions" extension says, per action, which Todoist call to make:
+
+    "update": {"method": "POST", "path": "/tasks/{task_id}",
+               "body": [...], "body_required": true}
+
+    path           {field} placeholders are filled from the request (and required)
+    path_values    maps a placeholder's request value to the path segment sent
+    query, body    fields copied into the query string / JSON body when present
+    required       fields that must be present and non-empty
+    one_of         at least one is required; only the first one given is sent
+    any_of         at least one is required; all given are sent
+    body_required  at least one body field is required
+    list           a list action; fields/limit/cursor/order_by are read by listing.py
+
+The spec is loaded once, at import, into a dispatch table of
+(endpoint, action) -> Validator, so a request costs one dict lookup plus
+checks of only the fields its action uses, and a spec that references an
+unknown field or omits an action fails at startup instead of drifting from
+the handlers. Enum values are matched case-insensitively, ids may be sent
+as numbers and integers as digit strings, as the hand-written handlers
+allowed; other values of the wrong JSON type are refused with a 400.
+Nothing here touches Flask or the network, so the same rules back the
+single-action endpoints, /batch and the ASGI mode.
+"""
+import json
+import logging
+import os
+from collections import namedtuple
+
+from listing import ORDERINGS, parse_list_view
+
+log = logging.getLogger(__name__)
+
+SPEC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "openapi.json")
+
+# view is a listing.ListView (projection/pagination applied to a list response), or None
+UpstreamCall = namedtuple("UpstreamCall", "method path params json_data view")
+UpstreamCall.__new__.__defaults__ = (None, None, None)
+
+# The list view parameters are validated by listing.parse_list_view, which also accepts comma-separated fields
+LIST_VIEW_FIELDS = frozenset({"fields", "limit", "cursor", "order_by"})
+ACTION_KEYS = frozenset({"method", "path", "path_values", "query", "body", "required", "one_of", "any_of",
+                         "body_required", "list"})
+
+
+class ActionError(Exception):
+    """A request that fails validation; `status` is the HTTP status to return."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class SpecError(Exception):
+    """openapi.json doesn't describe a usable manage contract."""
+
+
+# --- Field checks ---
+#
+# Values are normalized the way the hand-written builders let them through
+# before: enum values are matched case-insensitively (and sent lowercased),
+# numeric ids are sent as strings and integers may be given as digit strings.
+
+def _is_int(value):
+    return type(value) is int
+
+
+def _field_check(name, schema):
+    """Builds check(value) -> normalized value for one property schema; raises SpecError if unsupported.
+
+    The check raises ActionError when the value doesn't fit the schema.
+    """
+    kind = schema.get("type")
+    if kind == "string":
+        is_id = name.endswith("_id")
+        allowed = frozenset(schema["enum"]) if "enum" in schema else None
+        min_length = schema.get("minLength")
+        if allowed is not None:
+            message = f"'{name}' must be one of: {', '.join(schema['enum'])}"
+        elif min_length:
+            message = f"'{name}' cannot be empty"
+        else:
+            message = f"'{name}' must be a string"
+
+        def check(value):
+            if is_id and _is_int(value):
+                value = str(value)
+            if type(value) is not str:
+                raise ActionError(message)
+            if allowed is not None:
+                value = value.lower()
+                if value not in allowed:
+                    raise ActionError(message)
+            if min_length and len(value) < min_length:
+                raise ActionError(message)
+            return value
+        return check
+    if kind == "integer":
+        low, high = schema.get("minimum"), schema.get("maximum")
+        if low is None and high is None:
+            message = f"'{name}' must be an integer"
+        elif high is None:
+            message = f"'{name}' must be an integer of at least {low}"
+        else:
+            message = f"'{name}' must be an integer from {float('-inf') if low is None else low} to {high}"
+
+        def check(value):
+            if type(value) is str and value.strip().lstrip("+-").isdigit():
+                value = int(value)
+            if not _is_int(value) or (low is not None and value < low) or (high is not None and value > high):
+                raise ActionError(message)
+            return value
+        return check
+    expected = {"boolean": (bool, f"'{name}' must be true or false"),
+                "object": (dict, f"'{name}' must be an object")}.get(kind)
+    if expected is not None:
+        json_type, message = expected
+
+        def check(value):
+            if type(value) is not json_type:
+                raise ActionError(message)
+            return value
+        return check
+    if kind == "array" and schema.get("items", {}).get("type") == "string":
+        def check(value):
+            if type(value) is not list or not all(type(item) is str for item in value):
+                raise ActionError(f"'{name}' must be a list of strings")
+            return value
+        return check
+    raise SpecError(f"Unsupported schema for '{name}': {schema}")
+
+
+# --- Validators ---
+
+def _split_path(path):
+    """"/tasks/{task_id}/{status}" -> ("/tasks/%s/%s", ("task_id", "status"))."""
+    fields, template = [], []
+    for part in path.split("/"):
+        if part.startswith("{") and part.endswith("}"):
+            fields.append(part[1:-1])
+            template.append("%s")
+        else:
+            template.append(part.replace("%", "%%"))
+    return "/".join(template), tuple(fields)
+
+
+class Validator:
+    """Checks a manage request for one (endpoint, action) and builds its UpstreamCall; see the x-actions keys."""
+
+    def __init__(self, endpoint, action, spec, properties, checks, always_required):
+        unknown = set(spec) - ACTION_KEYS
+        if unknown:
+            raise SpecError(f"{endpoint}.{action}: unknown x-actions keys {sorted(unknown)}")
+        method, path = spec.get("method"), spec.get("path")
+        if method not in ("GET", "POST", "DELETE") or not isinstance(path, str) or not path.startswith("/"):
+            raise SpecError(f"{endpoint}.{action}: needs a method and a path")
+
+        self.endpoint = endpoint
+        self.action = action
+        self.method = method
+        self.path = path
+        self.template, self.path_fields = _split_path(path)
+        self.path_values = spec.get("path_values", {})
+        self.query = tuple(spec.get("query", ()))
+        self.body = frozenset(spec.get("body", ())) if method == "POST" else frozenset()
+        self.one_of = tuple(spec.get("one_of", ()))
+        self.any_of = tuple(spec.get("any_of", ()))
+        self.required = tuple(dict.fromkeys(tuple(always_required) + self.path_fields +
+                                            tuple(spec.get("required", ()))))
+        self.body_required = bool(spec.get("body_required")) and bool(self.body)
+        self.is_list = bool(spec.get("list"))
+        self.checks = checks
+
+        used = (set(self.path_fields) | set(self.query) | set(spec.get("body", ())) | set(self.one_of) |
+                set(self.any_of) | set(self.required))
+        for name in used | set(self.path_values):
+            if name not in properties:
+                raise SpecError(f"{endpoint}.{action}: '{name}' is not a property of the {endpoint} schema")
+        if self.is_list and endpoint not in ORDERINGS:
+            raise SpecError(f"{endpoint}.{action}: listing.py has no orderings for '{endpoint}'")
+
+        # Message wording follows the original hand-written builders
+        self.missing = {}
+        for name in self.required:
+            allowed = properties[name].get("enum")
+            label = f"{name} ({' or '.join(repr(v) for v in allowed)})" if allowed else name
+            self.missing[name] = (f"'{name}' is required to create a {endpoint[:-1]}" if action == "create"
+                                  else f"{label} is required for '{action}' action")
+        either = self.one_of or self.any_of
+        self.either_message = f"Either {' or '.join(repr(n) for n in either)} is required for '{action}' action"
+        body_fields = ", ".join(name for name in spec.get("body", ()))
+        self.body_message = f"At least one field ({body_fields}) must be provided for update"
+
+        # Per-step (field, check, ...) tuples, so a request runs no lookups beyond reading its own fields
+        self._required = tuple((name, self._check(name), self.missing[name]) for name in self.required)
+        self._query = tuple((name, self._check(name), name in self.one_of) for name in self.query)
+        self._body = {name: self._check(name) for name in self.body}
+        self._path = tuple((name, self.path_values.get(name)) for name in self.path_fields)
+
+    def _check(self, name):
+        return _unchecked if name in LIST_VIEW_FIELDS else self.checks[name]
+
+    def __call__(self, data):
+        values = {}
+        for name, check, missing in self._required:
+            value = data.get(name)
+            if not value:
+                raise ActionError(missing)
+            values[name] = check(value)
+
+        either = self.one_of or self.any_of
+        if either and not any(data.get(name) for name in either):
+            raise ActionError(self.either_message)
+
+        # Query parameters: each one given is sent, except that only the first of one_of is
+        params = None
+        if self._query:
+            params = {}
+            chosen_one = False
+            for name, check, in_one_of in self._query:
+                if name in values:
+                    value = values[name]
+                    if not value or (in_one_of and chosen_one):
+                        continue
+                else:
+                    value = data.get(name)
+                    if not value or (in_one_of and chosen_one):
+                        continue
+                    value = check(value)
+                params[name] = value
+                chosen_one = chosen_one or in_one_of
+
+        # JSON body: every body field present in the request
+        payload = None
+        if self._body:
+            body = self._body
+            payload = {}
+            for name, value in data.items():
+                check = body.get(name)
+                if check is None:
+                    continue
+                if name in values:
+                    value = values[name]
+                elif value is not None:
+                    value = check(value)
+                payload[name] = value
+            if self.body_required and not payload:
+                raise ActionError(self.body_message)
+
+        view = None
+        if self.is_list:
+            try:
+                view = parse_list_view(data, self.endpoint)
+            except ValueError as e:
+                raise ActionError(str(e))
+
+        path = self.path
+        if len(self._path) == 1 and self._path[0][1] is None:
+            path = self.template % values[self._path[0][0]]
+        elif self._path:
+            # Mapped path values were enum-checked above, so their lookup can't miss
+            path = self.template % tuple(values[name] if mapping is None else mapping[values[name]]
+                                         for name, mapping in self._path)
+        return UpstreamCall(self.method, path, params, payload, view)
+
+
+def _unchecked(value):
+    return value
+
+
+def compile_spec(spec):
+    """Builds {endpoint: {action: validator}} from a parsed openapi.json; raises SpecError."""
+    table = {}
+    for route, item in spec.get("paths", {}).items():
+        if not route.endswith("/manage"):
+            continue
+        endpoint = route.strip("/")[:-len("/manage")]
+        try:
+            schema = item["post"]["requestBody"]["content"]["application/json"]["schema"]
+            properties = schema["properties"]
+            declared = tuple(properties["action"]["enum"])
+        except (KeyError, TypeError):
+            raise SpecError(f"{route}: needs a JSON request schema with an 'action' enum")
+        actions = schema.get("x-actions")
+        if not isinstance(actions, dict) or set(actions) != set(declared):
+            raise SpecError(f"{route}: x-actions must describe exactly the actions in the 'action' enum")
+        checks = {name: _field_check(name, prop) for name, prop in properties.items()
+                  if name != "action" and name not in LIST_VIEW_FIELDS}
+        always_required = [name for name in schema.get("required", ()) if name != "action"]
+        table[endpoint] = {action: Validator(endpoint, action, actions[action], properties, checks,
+                                             always_required)
+                           for action in declared}
+    if not table:
+        raise SpecError("No /<resource>/manage operations found")
+    return table
+
+
+def load_spec(path=SPEC_PATH):
+    with open(path) as f:
+        return compile_spec(json.load(f))
+
+
+# Endpoint name (as used by /batch) -> {action: validator}
+ACTIONS = load_spec()
+
+
+def build_call(endpoint, data):
+    """Validates `data` for `endpoint` ("tasks" or "/tasks/manage") and returns its UpstreamCall."""
+    validators = ACTIONS.get(endpoint)
+    if validators is None:
+        name = str(endpoint or "").strip("/")
+        if name.endswith("/manage"):
+            name = name[:-len("/manage")]
+        validators = ACTIONS.get(name)
+        if validators is None:
+            raise ActionError(f"Unknown endpoint '{endpoint}'")
+    if not isinstance(data, dict):
+        raise ActionError("Request body must be a JSON object")
+    action = data.get("action")
+    validate = validators.get(action)
+    if validate is None:
+        # Slow path: actions are matched case-insensitively
+        action = str(action or "").lower()
+        if not action:
+            raise ActionError("'action' field is required")
+        validate = validators.get(action)
+        if validate is None:
+            raise ActionError(f"Unknown or unsupported action '{data.get('action')}' for {endpoint}")
+    return validate(data)
@@ -0,0 +1,394 @@
+"""ASGI entry point: the async serving mode.
+
+    SERVER_MODE=asgi python main.py
+    gunicorn -k uvicorn.workers.UvicornWorker asgi:app
+
+The /<resource>/manage, /views/... and /comments/attachments endpoints run
+on the event loop. They validate with the same actions.build_call(),
+views.plan() and uploads.py the Flask handlers use, and their Todoist calls
+go through todoist.fetch_todoist_async(), so one worker can hold up to
+ASYNC_MAX_UPSTREAM calls in flight instead of one per thread. Attachment
+uploads are read from the client as Todoist takes them, never buffered.
+/export and /import run transfer.py's generators on worker threads, one
+step at a time, so their streams aren't buffered either, and /changes
+long-polls and event streams wait on the event loop. Everything else
+(/batch, /metrics, /debug/*, /openapi.json) is handed to the Flask app in
+main.py on a worker thread, with its response buffered.
+
+Needs the optional packages in requirements-async.txt (httpx, uvicorn).
+"""
+import asyncio
+import io
+import json
+import logging
+import sys
+import time
+from urllib.parse import parse_qsl
+
+import requests
+
+from actions import ACTIONS, ActionError, build_call
+from async_upstream import close_async_client, get_async_client
+from auth import authenticate
+from changes import event_stream_async, get_feed, long_poll_async, parse_since, poll_timeout
+from main import KNOWN_ACTIONS, STREAM_RESPONSES, app as flask_app
+from metrics import REQUEST_BYTES, REQUEST_LATENCY, REQUESTS, REQUESTS_IN_FLIGHT, RESPONSE_BYTES
+from outbox import accept, get_outbox, is_write_behind, with_request_id
+from todoist import apply_list_view, fetch_todoist_async, upstream_error
+from transfer import NDJSON, open_export, open_import
+from uploads import stream_attachment_async
+from views import run_view_async
+
+log = logging.getLogger(__name__)
+
+MANAGE_ROUTES = {f"/{name}/manage": name for name in ACTIONS}
+VIEW_ROUTES = {"/views/next-actions": "next-actions", "/views/weekly-review": "weekly-review"}
+PROJECT_VIEW_PREFIX = "/views/project/"
+UPLOAD_ROUTE = "/comments/attachments"
+TRANSFER_ROUTES = ("/export", "/import")
+CHANGES_ROUTE = "/changes"
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+    path = scope["path"]
+    endpoint = MANAGE_ROUTES.get(path)
+    view, object_id = VIEW_ROUTES.get(path), None
+    if path.startswith(PROJECT_VIEW_PREFIX) and "/" not in path[len(PROJECT_VIEW_PREFIX):]:
+        view, object_id = "project", path[len(PROJECT_VIEW_PREFIX):]
+    if endpoint is None and view is None and path not in (UPLOAD_ROUTE, CHANGES_ROUTE) + TRANSFER_ROUTES:
+        await _run_wsgi(flask_app, scope, receive, send)
+        return
+
+    # Label metrics with the route pattern, as the Flask app does
+    route = path if view != "project" else "/views/project/<project_id>"
+    started = time.perf_counter()
+    REQUESTS_IN_FLIGHT.inc(endpoint=route)
+    action = ""
+    try:
+        if path == UPLOAD_ROUTE:
+            action = "create"
+            reader = _BodyReader(receive)
+            status, headers, content = await upload(scope, reader)
+            REQUEST_BYTES.inc(reader.received, endpoint=route)
+        elif path == CHANGES_ROUTE:
+            await _read_body(receive)
+            status, headers, content = await changes(scope)
+        elif path in TRANSFER_ROUTES:
+            # The import's body is read while the response streams; its size isn't known up front
+            status, headers, content = await transfer(scope, _BodyReader(receive))
+        else:
+            body = await _read_body(receive)
+            REQUEST_BYTES.inc(len(body), endpoint=route)
+            if view is not None:
+                status, headers, content = await render(scope, view, object_id)
+            else:
+                action, (status, headers, content) = await manage(scope, endpoint, body)
+        REQUESTS.inc(endpoint=route, action=action, status=status)
+        # Timed until the whole body is sent, since a streamed one is still being produced here
+        sent = await _respond(send, status, headers, content)
+        REQUEST_LATENCY.observe(time.perf_counter() - started, endpoint=route, action=action)
+        RESPONSE_BYTES.inc(sent, endpoint=route)
+    finally:
+        REQUESTS_IN_FLIGHT.dec(endpoint=route)
+
+
+async def manage(scope, endpoint, body):
+    """Handles one /<endpoint>/manage call; returns (action label, (status, headers, body or async stream))."""
+    if scope["method"] != "POST":
+        return "", _json(405, {"error": "Method not allowed"})
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return "", _json(400, {"error": "Request body must be JSON"})
+    log.debug("%s manage request received: %s", endpoint.capitalize(), data)
+    if not isinstance(data, dict):
+        return "other", _json(400, {"error": "Request body must be a JSON object"})
+
+    action = str(data.get("action") or "").lower()
+    action = action if action in KNOWN_ACTIONS else "other"
+    try:
+        call = build_call(endpoint, data)
+    except ActionError as e:
+        return action, _json(e.status, {"error": e.message})
+
+    tenant, failure = authenticate(_header(scope, b"x-api-key"))
+    if tenant is None:
+        status, message = failure
+        return action, _json(status, {"error": message})
+    headers = tenant.headers
+
+    idempotency_key = _header(scope, b"idempotency-key")
+    outbox = get_outbox()
+    if outbox is not None and is_write_behind(call, action):
+        status, operation = await asyncio.to_thread(accept, outbox, tenant, endpoint, action, call, idempotency_key)
+        return action, _json(status, operation)
+    return action, await forward(headers, call, idempotency_key)
+
+
+async def forward(headers, call, idempotency_key=None):
+    """Sends a validated call to Todoist; returns (status, headers, body or async stream)."""
+    if call.method != "GET":
+        headers = with_request_id(headers, idempotency_key)
+    try:
+        result = await fetch_todoist_async(headers, call.method, call.path, params=call.params,
+                                           json_data=call.json_data, stream=STREAM_RESPONSES and call.view is None)
+    except requests.exceptions.RequestException as e:
+        status, error, extra_headers = upstream_error(e)
+        return _json(status, error, extra_headers)
+
+    # Handle successful empty response (204 No Content)
+    if result.status == 204:
+        return 204, [], b""
+
+    result = apply_list_view(result, call.view, call.path)
+    response_headers = [("Content-Type", result.content_type)] + list(result.headers.items())
+    return result.status, response_headers, result.stream if result.stream is not None else result.content
+
+
+async def upload(scope, reader):
+    """Handles one /comments/attachments call, streaming the file through; returns (status, headers, body)."""
+    if scope["method"] != "POST":
+        return _json(405, {"error": "Method not allowed"})
+    tenant, failure = authenticate(_header(scope, b"x-api-key"))
+    if tenant is None:
+        status, message = failure
+        return _json(status, {"error": message})
+    content_length = _header(scope, b"content-length")
+    content_length = int(content_length) if content_length and content_length.isdigit() else None
+    try:
+        call = await stream_attachment_async(tenant.headers, _header(scope, b"content-type"), content_length,
+                                             reader.read)
+    except ActionError as e:
+        return _json(e.status, {"error": e.message})
+    except requests.exceptions.RequestException as e:
+        status, error, extra_headers = upstream_error(e)
+        return _json(status, error, extra_headers)
+    return await forward(tenant.headers, call, _header(scope, b"idempotency-key"))
+
+
+async def transfer(scope, reader):
+    """Handles one /export or /import call; returns (status, headers, body or async stream)."""
+    exporting = scope["path"] == "/export"
+    if scope["method"] != ("GET" if exporting else "POST"):
+        return _json(405, {"error": "Method not allowed"})
+    tenant, failure = authenticate(_header(scope, b"x-api-key"))
+    if tenant is None:
+        status, message = failure
+        return _json(status, {"error": message})
+    try:
+        if exporting:
+            args = dict(parse_qsl(scope.get("query_string", b"").decode("latin-1")))
+            comments = args.get("comments", "1").lower() not in ("0", "false", "no")
+            chunks = await asyncio.to_thread(open_export, tenant.headers, comments)
+            headers = [("Content-Type", NDJSON),
+                       ("Content-Disposition", 'attachment; filename="todoist-export.ndjson"')]
+        else:
+            loop = asyncio.get_running_loop()
+
+            def read(size):
+                # Called on the import's thread; the body is received on the event loop
+                return asyncio.run_coroutine_threadsafe(reader.read(size), loop).result()
+
+            chunks = await asyncio.to_thread(open_import, tenant.headers, read)
+            headers = [("Content-Type", NDJSON)]
+    except ActionError as e:
+        return _json(e.status, {"error": e.message})
+    except requests.exceptions.RequestException as e:
+        status, error, extra_headers = upstream_error(e)
+        return _json(status, error, extra_headers)
+    return 200, headers, _from_thread(chunks)
+
+
+async def _from_thread(chunks):
+    """Steps a blocking iterator on worker threads, yielding its chunks on the event loop."""
+    done = object()
+    try:
+        while True:
+            chunk = await asyncio.to_thread(next, chunks, done)
+            if chunk is done:
+                return
+            yield chunk
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            await asyncio.to_thread(close)
+
+
+async def changes(scope):
+    """Handles one /changes long-poll or event stream; returns (status, headers, body or async stream)."""
+    if scope["method"] != "GET":
+        return _json(405, {"error": "Method not allowed"})
+    tenant, failure = authenticate(_header(scope, b"x-api-key"))
+    if tenant is None:
+        status, message = failure
+        return _json(status, {"error": message})
+    args = dict(parse_qsl(scope.get("query_string", b"").decode("latin-1")))
+    streaming = args.get("stream") == "sse" or "text/event-stream" in (_header(scope, b"accept") or "")
+    try:
+        since = parse_since(args.get("since") or (_header(scope, b"last-event-id") if streaming else None))
+        timeout = poll_timeout(args.get("timeout"))
+    except ValueError:
+        return _json(400, {"error": "'since' must be a sequence number and 'timeout' a number of seconds"})
+    namespace = tenant.headers["Authorization"]
+    if streaming:
+        return 200, [("Content-Type", "text/event-stream"), ("Cache-Control", "no-cache"),
+                     ("X-Accel-Buffering", "no")], event_stream_async(get_feed(), namespace, since)
+    return 200, [("Content-Type", "application/json")], await long_poll_async(get_feed(), namespace, since, timeout)
+
+
+async def render(scope, view, object_id=None):
+    """Handles one /views/... call; returns (status, headers, body)."""
+    if scope["method"] != "GET":
+        return _json(405, {"error": "Method not allowed"})
+    tenant, failure = authenticate(_header(scope, b"x-api-key"))
+    if tenant is None:
+        status, message = failure
+        return _json(status, {"error": message})
+    headers = tenant.headers
+    args = dict(parse_qsl(scope.get("query_string", b"").decode("latin-1")))
+    try:
+        return _json(200, await run_view_async(headers, view, args, object_id))
+    except ActionError as e:
+        return _json(e.status, {"error": e.message})
+    except requests.exceptions.RequestException as e:
+        status, error, extra_headers = upstream_error(e)
+        return _json(status, error, extra_headers)
+
+
+def _json(status, obj, extra_headers=None):
+    headers = [("Content-Type", "application/json")] + list((extra_headers or {}).items())
+    return status, headers, json.dumps(obj).encode()
+
+
+def _header(scope, name):
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+class _BodyReader:
+    """Reads a request body from ASGI receive() as it is needed, a piece at a time."""
+
+    def __init__(self, receive):
+        self.receive = receive
+        self.received = 0
+        self._buffer = b""
+        self._more = True
+
+    async def read(self, size):
+        """Returns up to `size` bytes, b"" once the body has ended."""
+        while not self._buffer and self._more:
+            message = await self.receive()
+            if message["type"] == "http.disconnect":
+                raise ActionError("The client disconnected during the upload")
+            self._buffer = message.get("body", b"")
+            self._more = message.get("more_body", False)
+            self.received += len(self._buffer)
+        chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+
+async def _respond(send, status, headers, content):
+    """Sends a response whose body is bytes or an async iterable of chunks; returns the bytes sent."""
+    raw_headers = [(k.lower().encode("latin-1"), str(v).encode("latin-1")) for k, v in headers]
+    if isinstance(content, bytes):
+        raw_headers.append((b"content-length", str(len(content)).encode()))
+        await send({"type": "http.response.start", "status": status, "headers": raw_headers})
+        await send({"type": "http.response.body", "body": content})
+        return len(content)
+
+    sent = 0
+    await send({"type": "http.response.start", "status": status, "headers": raw_headers})
+    try:
+        async for chunk in content:
+            sent += len(chunk)
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        await content.aclose()
+    return sent
+
+
+async def _run_wsgi(wsgi_app, scope, receive, send):
+    """Serves one request with a WSGI app on a worker thread, buffering its response."""
+    body = await _read_body(receive)
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": str(server[0]),
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for key, value in scope["headers"]:
+        name = key.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif name != "CONTENT_LENGTH":
+            name = "HTTP_" + name
+            environ[name] = f"{environ[name]},{value}" if name in environ else value
+
+    def call():
+        started = {}
+        chunks = []
+
+        def start_response(status, headers, exc_info=None):
+            started["status"], started["headers"] = status, headers
+            return chunks.append
+
+        result = wsgi_app(environ, start_response)
+        try:
+            for chunk in result:
+                chunks.append(chunk)
+        finally:
+            close = getattr(result, "close", None)
+            if close is not None:
+                close()
+        return int(started["status"].split(" ", 1)[0]), started["headers"], b"".join(chunks)
+
+    status, headers, content = await asyncio.to_thread(call)
+    headers = [(k, v) for k, v in headers if k.lower() != "content-length"]
+    await _respond(send, status, headers, content)
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                get_async_client()  # fail at startup, not on the first request, if httpx is missing
+            except RuntimeError as e:
+                await send({"type": "lifespan.startup.failed", "message": str(e)})
+                return
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await close_async_client()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
@@ -0,0 +1,245 @@
+"""Non-blocking Todoist client for the ASGI serving mode (see asgi.py).
+
+The async counterpart of upstream.UpstreamClient: a pooled httpx
+AsyncClient per tenant in each worker, the same timeouts, retry policy,
+rate limiter and circuit breakers, and the same metrics. At most
+ASYNC_MAX_UPSTREAM calls wait on Todoist at once; the rest, and calls
+queued for rate-limit budget, wait their turn on the event loop instead
+of in a thread. Transport errors are re-raised as their
+requests.exceptions equivalents so callers handle both modes the same way.
+
+httpx is an optional dependency, only needed for this mode
+(pip install -r requirements-async.txt).
+
+Tunables (environment variables, read once per process):
+    ASYNC_MAX_UPSTREAM  max concurrent Todoist calls per worker (200)
+    and the TODOIST_* / RATE_LIMIT_* settings described in upstream.py
+"""
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+
+import requests
+
+from metrics import UPSTREAM_IN_FLIGHT, UPSTREAM_LATENCY, UPSTREAM_REQUESTS, upstream_route
+from ratelimit import classify
+from upstream import (IDEMPOTENT_METHODS, MAX_TENANT_POOLS, TODOIST_API_BASE, env_float, env_int, get_breakers,
+                      get_limiter, replayable, retry_statuses)
+
+try:
+    import httpx
+except ImportError:  # only the ASGI mode needs it
+    httpx = None
+
+log = logging.getLogger(__name__)
+
+
+class AsyncUpstreamClient:
+    """Pooled keep-alive async client for the Todoist API."""
+
+    def __init__(self, base_url=TODOIST_API_BASE, max_in_flight=200, connect_timeout=3.05,
+                 read_timeout=15.0, max_retries=2, backoff_factor=0.3, max_retry_after=10.0, limiter=None,
+                 breakers=None):
+        if httpx is None:
+            raise RuntimeError("The ASGI serving mode needs httpx: pip install -r requirements-async.txt")
+        self.base_url = base_url.rstrip("/")
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_retry_after = max_retry_after
+        self.limiter = limiter if limiter is not None and limiter.enabled else None
+        self.breakers = breakers if breakers is not None and breakers.enabled else None
+        self.retry_statuses = retry_statuses(self.limiter)
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self._clients = {}  # namespace -> httpx.AsyncClient; tenants past MAX_TENANT_POOLS share ""
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self.max_in_flight = max_in_flight
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            base_url=os.getenv("TODOIST_API_BASE", TODOIST_API_BASE),
+            max_in_flight=env_int("ASYNC_MAX_UPSTREAM", 200),
+            connect_timeout=env_float("TODOIST_CONNECT_TIMEOUT", 3.05),
+            read_timeout=env_float("TODOIST_READ_TIMEOUT", 15.0),
+            max_retries=env_int("TODOIST_MAX_RETRIES", 2),
+            backoff_factor=env_float("TODOIST_RETRY_BACKOFF", 0.3),
+            max_retry_after=env_float("TODOIST_MAX_RETRY_AFTER", 10.0),
+            limiter=get_limiter(),
+            breakers=get_breakers(),
+        )
+
+    async def request(self, method, path, headers=None, params=None, json_data=None, stream=False,
+                      data=None, base_url=None, priority=None):
+        """Sends one request to Todoist and returns the httpx.Response.
+
+        With stream=True the body hasn't been read yet; iterate it with
+        aiter_bytes() and always aclose() it. Raises
+        requests.exceptions.RequestException on failure, like UpstreamClient.
+        """
+        breaker = self.breakers.get(path) if self.breakers is not None else None
+        probe = breaker.admit() if breaker is not None else False
+        try:
+            if self.limiter is None:
+                return await self._send(method, path, headers, params, json_data, stream, data, base_url, breaker)
+            namespace = (headers or {}).get("Authorization", "")
+            if priority is None:
+                priority = classify(method, path)
+            await self._acquire(namespace, priority)
+            resp = await self._send(method, path, headers, params, json_data, stream, data, base_url, breaker)
+            self.limiter.observe(namespace, resp)
+            if resp.status_code == 429 and replayable(data):
+                # Todoist didn't process it, so it is safe to queue and resend once whatever the method
+                await resp.aclose()
+                await self._acquire(namespace, priority)
+                resp = await self._send(method, path, headers, params, json_data, stream, data, base_url, breaker)
+                self.limiter.observe(namespace, resp)
+            return resp
+        finally:
+            if breaker is not None:
+                breaker.release(probe)
+
+    async def _acquire(self, namespace, priority):
+        # Queued calls wait on the event loop, not in the default executor that the WSGI fallback,
+        # the mirror and the outbox also use
+        await self.limiter.acquire_async(namespace, priority)
+
+    def _client(self, namespace):
+        """The httpx client whose connection pool serves `namespace`."""
+        client = self._clients.get(namespace)
+        if client is None:
+            # Clients can't be closed while streams may still be reading from them, so rather than
+            # evicting, tenants beyond the cap share one overflow pool
+            if len(self._clients) >= MAX_TENANT_POOLS and namespace != "":
+                return self._client("")
+            client = self._clients[namespace] = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.max_in_flight, max_keepalive_connections=self.max_in_flight),
+            )
+        return client
+
+    async def _send(self, method, path, headers, params, json_data, stream, data, base_url, breaker=None):
+        url = (base_url or self.base_url) + path
+        route = upstream_route(path)
+        client = self._client((headers or {}).get("Authorization", ""))
+        attempt = 0
+        elapsed = 0.0  # time spent on the wire, without queueing for a slot
+        while True:
+            status = "error"
+            async with self._slots:
+                UPSTREAM_IN_FLIGHT.inc()
+                started = time.perf_counter()
+                try:
+                    # httpx takes form fields as data= and raw or streamed bodies as content=
+                    form = isinstance(data, dict)
+                    request = client.build_request(method, url, headers=headers, params=params, json=json_data,
+                                                   data=data if form else None, content=None if form else data)
+                    resp = await client.send(request, stream=True)
+                    status = str(resp.status_code)
+                except httpx.TimeoutException as e:
+                    status = "timeout"
+                    error = e
+                except httpx.TransportError as e:
+                    error = e
+                else:
+                    error = None
+                finally:
+                    elapsed += time.perf_counter() - started
+                    UPSTREAM_IN_FLIGHT.dec()
+                    UPSTREAM_REQUESTS.inc(method=method, route=route, status=status)
+
+            delay = self._retry_delay(method, attempt, resp if error is None else None, error)
+            if delay is None:
+                break
+            if error is None:
+                await resp.aclose()
+            attempt += 1
+            await asyncio.sleep(delay)
+
+        # Once per call, retries included, as upstream.UpstreamClient records it
+        UPSTREAM_LATENCY.observe(elapsed, method=method, route=route)
+        if breaker is not None:
+            breaker.record(error is not None or resp.status_code >= 500, elapsed)
+        if error is not None:
+            raise _as_requests_error(error)
+        if not stream:
+            await self.read(resp)
+        return resp
+
+    def _retry_delay(self, method, attempt, resp, error):
+        """Seconds to wait before retrying, or None to stop; the same policy as TodoistRetry."""
+        if attempt >= self.max_retries:
+            return None
+        if error is not None:
+            # A failed connect never reached Todoist, so any method may be resent
+            if not isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout)) and method not in IDEMPOTENT_METHODS:
+                return None
+        elif method not in IDEMPOTENT_METHODS or resp.status_code not in self.retry_statuses:
+            return None
+        else:
+            retry_after = resp.headers.get("Retry-After")
+            if retry_after is not None:
+                try:
+                    retry_after = float(retry_after)
+                except ValueError:
+                    retry_after = None
+            if retry_after is not None:
+                return retry_after if retry_after <= self.max_retry_after else None
+        backoff = self.backoff_factor * (2 ** attempt) + random.uniform(0, self.backoff_factor)
+        return min(backoff, self.max_retry_after)
+
+    async def read(self, resp):
+        """Reads a streamed response's whole body and closes it."""
+        try:
+            return await resp.aread()
+        except httpx.TransportError as e:
+            raise _as_requests_error(e)
+        finally:
+            await resp.aclose()
+
+    async def aclose(self):
+        for client in list(self._clients.values()):
+            await client.aclose()
+        self._clients.clear()
+
+    def stats(self):
+        return {
+            "max_in_flight": self.max_in_flight,
+            "tenant_pools": len(self._clients),
+            "rate_limit": self.limiter.stats() if self.limiter is not None else {"enabled": False},
+            "circuits": self.breakers.stats() if self.breakers is not None else {"enabled": False},
+        }
+
+
+def _as_requests_error(error):
+    if isinstance(error, httpx.TimeoutException):
+        return requests.exceptions.Timeout(str(error))
+    if isinstance(error, httpx.ConnectError):
+        return requests.exceptions.ConnectionError(str(error))
+    return requests.exceptions.RequestException(str(error))
+
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_async_client():
+    """Returns this process's shared async client, creating it after any fork."""
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                _client = AsyncUpstreamClient.from_env()
+                _client_pid = pid
+    return _client
+
+
+async def close_async_client():
+    global _client
+    if _client is not None and _client_pid == os.getpid():
+        await _client.aclose()
+    _client = None
@@ -0,0 +1,233 @@
+"""Client API keys and the Todoist credentials they map to, shared by the Flask and ASGI apps.
+
+Credentials are loaded and validated once into an immutable registry that
+maps each client API key to a tenant: a Todoist token with its request
+headers already built. One deployment can serve several Todoist users;
+each tenant's token is also its namespace for the response cache, the
+rate-limit budget and the upstream connection pool.
+
+    TENANTS_FILE   JSON file of tenants (see below); without it the single
+                   tenant "default" is built from API_KEY and TODOIST_API_TOKEN
+                   (and TODOIST_USER_ID, if set)
+
+    {"tenants": [{"name": "alice", "api_key": "...", "todoist_token": "...",
+                  "rate_limit_requests": 300, "todoist_user_id": "2671355"}]}
+
+"api_key_sha256" (hex) may replace "api_key" to keep plaintext keys out of
+the file; "rate_limit_requests" is optional and overrides
+RATE_LIMIT_REQUESTS for that tenant. "todoist_user_id" routes Todoist
+webhooks for that user to the tenant (see changes.py); a lone tenant
+without one gets them all.
+
+Send SIGHUP to a worker to reload the registry. The new registry replaces
+the old one in a single assignment, so requests already in flight finish
+with the credentials they started with; a registry that fails validation
+is logged and the old one kept. Under gunicorn, run with gunicorn.conf.py
+(its post_worker_init hook installs the handler in every worker) and
+signal the workers (pkill -HUP -P <master pid>). A SIGHUP to the master
+restarts the workers instead, which only rereads the configuration
+without --preload: preloaded workers inherit the master's registry.
+"""
+import hashlib
+import json
+import logging
+import os
+import signal
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+
+log = logging.getLogger(__name__)
+
+# `headers` is a read-only mapping for Todoist calls; copy it before adding headers
+Tenant = namedtuple("Tenant", "name headers requests_per_window user_id")
+
+UNAUTHORIZED = (401, "Authentication failed: Invalid or missing X-API-KEY header")
+MISCONFIGURED = (500, "Internal server error: Service configuration issue")
+
+
+class ConfigError(Exception):
+    """The tenant configuration is missing or invalid."""
+
+
+class Registry:
+    """Immutable mapping of client API keys to tenants."""
+
+    def __init__(self, tenants=(), problem=None):
+        # Keyed by the SHA-256 of the API key: lookups never compare the raw key, so how long
+        # a lookup takes says nothing about how much of a guessed key was right
+        self._by_digest = MappingProxyType({digest: tenant for digest, tenant in tenants})
+        self.tenants = tuple(tenant for _, tenant in tenants)
+        self._by_name = MappingProxyType({t.name: t for t in self.tenants})
+        self._by_user = MappingProxyType({t.user_id: t for t in self.tenants if t.user_id is not None})
+        self.problem = problem
+
+    def authenticate(self, api_key):
+        """Returns (tenant, None) for a known key, else (None, (status, message))."""
+        if not api_key:
+            log.info("Missing X-API-KEY header from incoming request")
+            return None, UNAUTHORIZED
+        if not self._by_digest:
+            log.error("No tenants configured: %s", self.problem)
+            return None, MISCONFIGURED
+        tenant = self._by_digest.get(_digest(api_key))
+        if tenant is None:
+            log.info("Invalid X-API-KEY provided by client")
+            return None, UNAUTHORIZED
+        return tenant, None
+
+    def named(self, name):
+        """The tenant called `name`, or None."""
+        return self._by_name.get(name)
+
+    def for_user(self, user_id):
+        """The tenant Todoist events for `user_id` belong to, or None."""
+        tenant = self._by_user.get(str(user_id))
+        if tenant is None and len(self.tenants) == 1 and self.tenants[0].user_id is None:
+            return self.tenants[0]
+        return tenant
+
+    def budgets(self):
+        """{Authorization header: requests per window} for tenants with their own rate budget."""
+        return {t.headers["Authorization"]: t.requests_per_window for t in self.tenants
+                if t.requests_per_window is not None}
+
+
+def _digest(api_key):
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
+def _tenant(name, token, requests_per_window=None, user_id=None):
+    headers = MappingProxyType({
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json",
+    })
+    return Tenant(name, headers, requests_per_window, str(user_id) if user_id not in (None, "") else None)
+
+
+def load_registry():
+    """Builds a Registry from TENANTS_FILE or the API_KEY/TODOIST_API_TOKEN pair; raises ConfigError."""
+    path = os.getenv("TENANTS_FILE")
+    if not path:
+        api_key = os.getenv("API_KEY")
+        token = os.getenv("TODOIST_API_TOKEN")
+        if not api_key:
+            raise ConfigError("API_KEY environment variable not set on the server")
+        if not token:
+            raise ConfigError("TODOIST_API_TOKEN environment variable not set on the server")
+        return Registry([(_digest(api_key), _tenant("default", token, user_id=os.getenv("TODOIST_USER_ID")))])
+
+    try:
+        with open(path) as f:
+            document = json.load(f)
+    except (OSError, ValueError) as e:
+        raise ConfigError(f"Can't read TENANTS_FILE {path}: {e}")
+    entries = document.get("tenants") if isinstance(document, dict) else None
+    if not isinstance(entries, list) or not entries:
+        raise ConfigError(f"{path}: 'tenants' must be a non-empty array")
+
+    tenants = []
+    seen_digests, seen_names, seen_users = set(), set(), set()
+    for index, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            raise ConfigError(f"{path}: tenant {index} must be an object")
+        name = entry.get("name") or f"tenant-{index}"
+        token = entry.get("todoist_token")
+        if not isinstance(token, str) or not token:
+            raise ConfigError(f"{path}: tenant '{name}' needs a 'todoist_token'")
+        if isinstance(entry.get("api_key"), str) and entry["api_key"]:
+            digest = _digest(entry["api_key"])
+        elif isinstance(entry.get("api_key_sha256"), str) and len(entry["api_key_sha256"]) == 64:
+            digest = entry["api_key_sha256"].lower()
+        else:
+            raise ConfigError(f"{path}: tenant '{name}' needs an 'api_key' or a 64-character 'api_key_sha256'")
+        budget = entry.get("rate_limit_requests")
+        if budget is not None and (not isinstance(budget, int) or isinstance(budget, bool) or budget < 1):
+            raise ConfigError(f"{path}: tenant '{name}' has an invalid 'rate_limit_requests'")
+        user_id = entry.get("todoist_user_id")
+        if user_id is not None and (not isinstance(user_id, (str, int)) or isinstance(user_id, bool)):
+            raise ConfigError(f"{path}: tenant '{name}' has an invalid 'todoist_user_id'")
+        if digest in seen_digests:
+            raise ConfigError(f"{path}: tenant '{name}' reuses another tenant's API key")
+        if name in seen_names:
+            raise ConfigError(f"{path}: tenant name '{name}' is used twice")
+        if user_id is not None and str(user_id) in seen_users:
+            raise ConfigError(f"{path}: tenant '{name}' reuses another tenant's 'todoist_user_id'")
+        seen_digests.add(digest)
+        seen_names.add(name)
+        if user_id is not None:
+            seen_users.add(str(user_id))
+        tenants.append((digest, _tenant(name, token, budget, user_id)))
+    return Registry(tenants)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+_listeners = []
+
+
+def get_registry():
+    """Returns the current registry, loading it on first use."""
+    registry = _registry
+    if registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _install(_load_or_empty())
+            registry = _registry
+    return registry
+
+
+def _load_or_empty():
+    try:
+        registry = load_registry()
+    except ConfigError as e:
+        log.error("Server configuration error: %s", e)
+        return Registry(problem=str(e))
+    log.info("Loaded %d tenant(s)", len(registry.tenants))
+    return registry
+
+
+def _install(registry):
+    global _registry
+    _registry = registry
+    for listener in _listeners:
+        try:
+            listener(registry)
+        except Exception as e:
+            log.warning("Tenant registry listener failed: %s", e)
+
+
+def on_reload(listener):
+    """Calls `listener(registry)` whenever a registry is installed, starting with the current one."""
+    with _registry_lock:
+        _listeners.append(listener)
+        registry = _registry
+    if registry is not None:
+        listener(registry)
+
+
+def reload_registry():
+    """Re-reads the configuration; keeps the current registry if the new one is invalid."""
+    try:
+        registry = load_registry()
+    except ConfigError as e:
+        log.error("Tenant registry reload failed, keeping the current one: %s", e)
+        return False
+    with _registry_lock:
+        _install(registry)
+    log.info("Reloaded tenant registry: %d tenant(s)", len(registry.tenants))
+    return True
+
+
+def install_reload_handler():
+    """Reloads the registry on SIGHUP; a no-op off the main thread or without SIGHUP."""
+    if not hasattr(signal, "SIGHUP") or threading.current_thread() is not threading.main_thread():
+        return
+    # The handler runs between bytecodes of whatever the main thread was doing, so leave the work to a thread
+    signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+        target=reload_registry, name="tenant-reload", daemon=True).start())
+
+
+def authenticate(api_key):
+    """Resolves a client's X-API-KEY: (tenant, None) or (None, (status, message))."""
+    return get_registry().authenticate(api_key)
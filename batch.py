@@ -0,0 +1,402 @@
+"""Execution of /batch requests: many manage actions in one round trip.
+
+Every operation is validated up front with the same builders as the single
+action endpoints, so a bad operation rejects the batch before anything is
+sent to Todoist. A string value of the form "$<index>.<field>[.<field>...]"
+is replaced with that field of an earlier operation's result, e.g.
+{"endpoint": "sections", "action": "create", "project_id": "$0.id", ...}.
+
+Batches made only of writes are sent as Todoist Sync API commands, up to
+100 per upstream request, with references to created objects passed as
+temp ids. Sync only reports whether each command applied, so results
+differ from the REST pipeline's: a create answers 200 with just {"id"}
+rather than the whole object, and every other write 204 with no body
+(REST answers an update with the updated object). The response's "mode"
+says which applies; send "mode": "rest" to get full objects back.
+
+Anything else runs through the REST pipeline, with operations that don't
+depend on each other running concurrently. Reads and writes keep their
+order relative to each other, so a list or get sees the writes before it
+in the batch and not those after it; a run of reads, or of writes to
+different objects, runs concurrently.
+"""
+import json
+import logging
+import math
+import re
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+
+from actions import ActionError, build_call
+from listing import apply_view
+from ratelimit import BULK, RateLimited
+from todoist import after_write, fetch_todoist
+from upstream import get_client, sync_api_base
+
+log = logging.getLogger(__name__)
+
+REF_PATTERN = re.compile(r"^\$(\d+)((?:\.[A-Za-z0-9_]+)+)$")
+SYNC_COMMANDS_PER_REQUEST = 100
+
+# Primary id field of each endpoint; operations on the same object keep their order
+PRIMARY_IDS = {
+    "tasks": "task_id",
+    "projects": "project_id",
+    "sections": "section_id",
+    "labels": "label_id",
+    "comments": "comment_id",
+}
+
+
+class Operation:
+    def __init__(self, index, endpoint, data):
+        self.index = index
+        self.endpoint = endpoint
+        self.data = data
+        self.action = str(data.get("action") or "").lower()
+        self.refs = {}  # field -> (operation index, attribute path)
+        self.deps = set()  # operations this one can't run without
+        self.after = set()  # operations this one only has to follow
+        self.call = None
+
+    @property
+    def is_write(self):
+        return self.call.method != "GET"
+
+
+def _endpoint_name(endpoint):
+    name = str(endpoint or "").strip("/")
+    return name[:-len("/manage")] if name.endswith("/manage") else name
+
+
+def parse_operations(raw_ops, max_operations):
+    """Validates a list of operation dicts and returns Operations with their dependencies resolved."""
+    if not isinstance(raw_ops, list) or not raw_ops:
+        raise ActionError("'operations' must be a non-empty array")
+    if len(raw_ops) > max_operations:
+        raise ActionError(f"A batch may contain at most {max_operations} operations", status=413)
+
+    ops = []
+    last_touch = {}  # (endpoint, object id) -> index of the last operation on it
+    reads, writes = [], []
+    for index, raw in enumerate(raw_ops):
+        if not isinstance(raw, dict):
+            raise ActionError(f"Operation {index}: must be an object")
+        data = {k: v for k, v in raw.items() if k != "endpoint"}
+        op = Operation(index, _endpoint_name(raw.get("endpoint")), data)
+        for key, value in data.items():
+            match = REF_PATTERN.match(value) if isinstance(value, str) else None
+            if match is None:
+                continue
+            target = int(match.group(1))
+            if target >= index:
+                raise ActionError(f"Operation {index}: '{key}' refers to operation {target}, which does not run before it")
+            op.refs[key] = (target, match.group(2).lstrip(".").split("."))
+            op.deps.add(target)
+        try:
+            op.call = build_call(op.endpoint, data)
+        except ActionError as e:
+            raise ActionError(f"Operation {index}: {e.message}", e.status)
+
+        primary = data.get(PRIMARY_IDS.get(op.endpoint, ""))
+        if primary and isinstance(primary, (str, int)):
+            touch = (op.endpoint, primary)
+            if touch in last_touch:
+                op.deps.add(last_touch[touch])
+            last_touch[touch] = index
+        # A read sees the writes before it and none after it, wherever they are
+        op.after.update(reads if op.is_write else writes)
+        (writes if op.is_write else reads).append(index)
+        ops.append(op)
+    return ops
+
+
+def _lookup(result, attrs):
+    value = result.get("body")
+    for attr in attrs:
+        if not isinstance(value, dict) or attr not in value:
+            return None
+        value = value[attr]
+    return value
+
+
+def _resolved_call(op, results):
+    """Rebuilds an operation's call with references replaced by earlier results."""
+    if not op.refs:
+        return op.call
+    data = dict(op.data)
+    for key, (target, attrs) in op.refs.items():
+        value = _lookup(results[target], attrs)
+        if value is None:
+            raise ActionError(f"'{key}' refers to '{'.'.join(attrs)}', which operation {target} did not return")
+        data[key] = value
+    return build_call(op.endpoint, data)
+
+
+def _result_from_upstream(index, upstream, view=None):
+    result = {"index": index, "status": upstream.status}
+    if upstream.content:
+        try:
+            result["body"] = json.loads(upstream.content)
+        except ValueError:
+            result["body"] = upstream.content.decode("utf-8", "replace")
+        else:
+            if view is not None and upstream.status == 200 and isinstance(result["body"], list):
+                result["body"] = apply_view(view, result["body"])
+    return result
+
+
+def _run_rest_op(op, results, headers):
+    try:
+        call = _resolved_call(op, results)
+    except ActionError as e:
+        return {"index": op.index, "status": e.status, "error": e.message}
+    try:
+        upstream = fetch_todoist(headers, call.method, call.path, params=call.params, json_data=call.json_data,
+                                 priority=BULK)
+    except RateLimited as e:
+        return {"index": op.index, "status": 503, "error": str(e), "retry_after": math.ceil(e.retry_after)}
+    except requests.exceptions.Timeout as e:
+        return {"index": op.index, "status": 504, "error": f"Todoist API timed out: {str(e)}"}
+    except requests.exceptions.RequestException as e:
+        return {"index": op.index, "status": 503, "error": f"Failed to connect to Todoist API: {str(e)}"}
+    return _result_from_upstream(op.index, upstream, call.view)
+
+
+def run_rest(ops, headers, max_workers):
+    """Runs operations through the REST pipeline, each as soon as its dependencies have finished."""
+    results = [None] * len(ops)
+    pending = {op.index: op for op in ops}
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="batch") as pool:
+        while pending or running:
+            for index, op in list(pending.items()):
+                if any(results[dep] is None for dep in op.deps | op.after):
+                    continue
+                del pending[index]
+                failed = [dep for dep in sorted(op.deps) if not 200 <= results[dep]["status"] < 300]
+                if failed:
+                    results[index] = {"index": index, "status": 424,
+                                      "error": f"Skipped because operation {failed[0]} failed"}
+                    continue
+                running[pool.submit(_run_rest_op, op, results, headers)] = index
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+    return results
+
+
+# --- Sync API commands ---
+
+def _sync_due(data):
+    if "due_string" in data:
+        due = {"string": data["due_string"]}
+    elif "due_datetime" in data:
+        due = {"date": data["due_datetime"]}
+    elif "due_date" in data:
+        due = {"date": data["due_date"]}
+    else:
+        return None
+    if "due_lang" in data:
+        due["lang"] = data["due_lang"]
+    return due
+
+
+def _task_args(payload):
+    args = {k: payload[k] for k in ("content", "description", "project_id", "section_id", "parent_id",
+                                    "labels", "priority") if k in payload}
+    if "order" in payload:
+        args["child_order"] = payload["order"]
+    if "assignee_id" in payload:
+        args["responsible_uid"] = payload["assignee_id"]
+    if "duration" in payload:
+        args["duration"] = {"amount": payload["duration"], "unit": payload.get("duration_unit", "minute")}
+    due = _sync_due(payload)
+    if due is not None:
+        args["due"] = due
+    return args
+
+
+def _sync_command(op):
+    """Maps a write operation to (command type, args, creates object), or None when Sync can't express it."""
+    call, payload = op.call, op.call.json_data or {}
+    parts = call.path.strip("/").split("/")
+    obj_id = parts[1] if len(parts) > 1 else None
+    if op.endpoint == "tasks":
+        if op.action == "create":
+            return "item_add", _task_args(payload), True
+        if op.action == "update":
+            return "item_update", dict(_task_args(payload), id=obj_id), False
+        if op.action == "move":
+            # item_move takes exactly one destination; a section implies its project
+            key = "section_id" if "section_id" in payload else "project_id"
+            return "item_move", {"id": obj_id, key: payload[key]}, False
+        if op.action == "delete":
+            return "item_delete", {"id": obj_id}, False
+        if op.action == "status":
+            return ("item_close" if parts[2] == "close" else "item_uncomplete"), {"id": obj_id}, False
+    if op.endpoint == "projects":
+        if op.action == "create":
+            return "project_add", dict(payload), True
+        if op.action == "update":
+            return "project_update", dict(payload, id=obj_id), False
+        if op.action == "delete":
+            return "project_delete", {"id": obj_id}, False
+    if op.endpoint == "sections":
+        if op.action == "create":
+            args = {k: payload[k] for k in ("name", "project_id") if k in payload}
+            if "order" in payload:
+                args["section_order"] = payload["order"]
+            return "section_add", args, True
+        if op.action == "update" and "order" not in payload:  # reordering is a separate Sync command
+            return "section_update", dict(payload, id=obj_id), False
+        if op.action == "delete":
+            return "section_delete", {"id": obj_id}, False
+    if op.endpoint == "labels":
+        args = {k: payload[k] for k in ("name", "color", "is_favorite") if k in payload}
+        if "order" in payload:
+            args["item_order"] = payload["order"]
+        if op.action == "create":
+            return "label_add", args, True
+        if op.action == "update":
+            return "label_update", dict(args, id=obj_id), False
+        if op.action == "delete":
+            return "label_delete", {"id": obj_id}, False
+    if op.endpoint == "comments":
+        if op.action == "create":
+            args = {"content": payload["content"]}
+            if "attachment" in payload:
+                args["file_attachment"] = payload["attachment"]
+            if "task_id" in payload:
+                args["item_id"] = payload["task_id"]
+            else:
+                args["project_id"] = payload["project_id"]
+            return "note_add", args, True
+        if op.action == "update":
+            return "note_update", {"id": obj_id, "content": payload["content"]}, False
+        if op.action == "delete":
+            return "note_delete", {"id": obj_id}, False
+    return None
+
+
+def plan_sync(ops):
+    """Returns Sync commands for the batch, or None if any operation can't be sent that way."""
+    commands = []
+    creates = set()
+    for op in ops:
+        if not op.is_write:
+            return None
+        mapped = _sync_command(op)
+        if mapped is None:
+            return None
+        # Sync can only substitute the temp id of an object created earlier in the batch
+        for target, attrs in op.refs.values():
+            if target not in creates or attrs != ["id"]:
+                return None
+        command_type, args, creates_object = mapped
+        command = {"type": command_type, "uuid": str(uuid.uuid4()), "args": args}
+        if creates_object:
+            command["temp_id"] = str(uuid.uuid4())
+            creates.add(op.index)
+        commands.append(command)
+    return commands
+
+
+def _command_arg_key(op, field):
+    """Where a request field ended up in the Sync command args."""
+    if field == PRIMARY_IDS.get(op.endpoint):
+        return "id"
+    if op.endpoint == "comments" and field == "task_id":
+        return "item_id"
+    return field
+
+
+def run_sync(ops, commands, headers):
+    """Sends the batch as Sync API commands; returns (results, upstream calls made)."""
+    for op, command in zip(ops, commands):
+        for key, (target, _) in op.refs.items():
+            arg = _command_arg_key(op, key)
+            if arg in command["args"]:
+                command["args"][arg] = commands[target]["temp_id"]
+
+    results = [None] * len(ops)
+    temp_ids = {}
+    calls = 0
+    for start in range(0, len(commands), SYNC_COMMANDS_PER_REQUEST):
+        chunk = commands[start:start + SYNC_COMMANDS_PER_REQUEST]
+        # Temp ids created by an earlier request are real ids by now
+        for command in chunk:
+            for key, value in command["args"].items():
+                if isinstance(value, str) and value in temp_ids:
+                    command["args"][key] = temp_ids[value]
+        log.debug("Sending %d Sync API commands to Todoist", len(chunk))
+        calls += 1
+        try:
+            resp = get_client().request("POST", "/sync", base_url=sync_api_base(), headers=headers,
+                                        data={"commands": json.dumps(chunk)}, priority=BULK)
+        except RateLimited as e:
+            for offset in range(len(chunk)):
+                results[start + offset] = {"index": start + offset, "status": 503, "error": str(e),
+                                           "retry_after": math.ceil(e.retry_after)}
+            continue
+        except requests.exceptions.RequestException as e:
+            for offset in range(len(chunk)):
+                results[start + offset] = {"index": start + offset, "status": 503,
+                                           "error": f"Failed to connect to Todoist API: {str(e)}"}
+            continue
+        if resp.status_code != 200:
+            for offset in range(len(chunk)):
+                results[start + offset] = {"index": start + offset, "status": resp.status_code,
+                                           "error": resp.text[:500]}
+            continue
+        try:
+            payload = resp.json()
+        except ValueError:
+            # e.g. a proxy's error page: nothing says which commands were applied
+            for offset in range(len(chunk)):
+                results[start + offset] = {"index": start + offset, "status": 502,
+                                           "error": f"Todoist returned invalid JSON: {resp.text[:500]}"}
+            continue
+        temp_ids.update(payload.get("temp_id_mapping", {}))
+        for offset, command in enumerate(chunk):
+            index = start + offset
+            status = payload.get("sync_status", {}).get(command["uuid"])
+            if status == "ok":
+                result = {"index": index, "status": 204}
+                if "temp_id" in command:
+                    result = {"index": index, "status": 200, "body": {"id": temp_ids.get(command["temp_id"])}}
+                results[index] = result
+            else:
+                error = status if isinstance(status, dict) else {}
+                results[index] = {"index": index, "status": error.get("http_code", 400),
+                                  "error": error.get("error", "Sync command failed")}
+
+    # Keep cached reads and the mirror in line with what was written
+    namespace = headers["Authorization"]
+    for op, result in zip(ops, results):
+        if 200 <= result["status"] < 300:
+            path = op.call.path
+            for value in re.findall(r"\$\d+\.id", path):
+                target = int(value[1:].split(".")[0])
+                path = path.replace(value, str(_lookup(results[target], ["id"])))
+            after_write(namespace, op.call.method, path)
+    return results, calls
+
+
+def run_batch(raw_ops, headers, mode="auto", max_workers=4, max_operations=200):
+    """Validates and runs a batch; returns the response document."""
+    if mode not in ("auto", "rest", "sync"):
+        raise ActionError("'mode' must be one of 'auto', 'rest' or 'sync'")
+    ops = parse_operations(raw_ops, max_operations)
+    commands = plan_sync(ops) if mode != "rest" and (mode == "sync" or len(ops) > 1) else None
+    if mode == "sync" and commands is None:
+        raise ActionError("This batch can't be sent as Sync API commands (it contains reads, "
+                          "section reorders, or references to fields other than a created object's id)")
+    if commands is not None:
+        results, calls = run_sync(ops, commands, headers)
+        return {"mode": "sync", "upstream_calls": calls, "results": results}
+    return {"mode": "rest", "results": run_rest(ops, headers, max_workers)}
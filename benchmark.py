@@ -0,0 +1,435 @@
+"""Load-tests the manage endpoints against a mock Todoist.
+
+    python benchmark.py --concurrency 16 --duration 30 --latency-ms 40
+    python benchmark.py --mix read --save-baseline reads
+    python benchmark.py --mix read --compare reads
+    python benchmark.py --validation --against <git revision>
+
+The app is started as a subprocess (`python main.py`, SERVER_MODE=asgi
+with --asgi, or any --server-cmd with {port} in it, e.g. gunicorn) with
+TODOIST_API_BASE pointed at a mock_todoist server running in this
+process, so the mock's latency, error, 429 and payload-size options are
+all available here. RATE_LIMIT_REQUESTS is set to 0 unless --env sets it,
+since the client-side Todoist budget would otherwise be the bottleneck.
+
+--concurrency workers post tasks, projects, sections, labels, comments
+and collaborators manage actions for --duration seconds, picking each
+action by the weights of --mix: "default", "read", "write", or a list like
+"tasks.list=3,tasks.get=1". Nothing is recorded during the first --warmup
+seconds. The report gives throughput, p50/p95/p99 latency overall and per
+action, response statuses, Todoist calls in total and per request (from
+the mock's counters), and the RSS of the app's process tree at the start,
+peak and end.
+
+Results can be saved as baselines and later runs compared with them:
+--save-baseline NAME keeps the report in benchmarks/NAME.json;
+--compare NAME exits 1 if throughput fell, p95/p99 latency rose or
+upstream calls per request rose by more than --tolerance (a fraction).
+Baselines are only comparable on the same machine and options; a
+mismatch in the options is reported. The committed baselines (default,
+read, write, and default-asgi with --asgi) were recorded with
+--concurrency 16 --duration 20 --warmup 3 --latency-ms 40; re-record
+them on your own machine before comparing.
+
+--validation skips the load test and times actions.build_call, in
+process, on one request of every action above; --against REV times the
+actions.py of that git revision on the same requests (e.g. the
+hand-written builders from before it was compiled from openapi.json).
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import timeit
+import types
+
+import requests
+
+import actions
+import mock_todoist
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks")
+API_KEY = "benchmark"
+
+MIXES = {
+    "default": {"tasks.list": 30, "tasks.get": 15, "tasks.create": 8, "tasks.update": 6, "tasks.status": 4,
+                "tasks.move": 2, "tasks.delete": 2, "projects.list": 8, "projects.get": 3, "sections.list": 5,
+                "labels.list": 5, "comments.list": 5, "comments.create": 3, "collaborators.list": 3},
+    "read": {"tasks.list": 40, "tasks.get": 20, "projects.list": 10, "projects.get": 5, "sections.list": 8,
+             "labels.list": 8, "comments.list": 6, "collaborators.list": 3},
+    "write": {"tasks.create": 30, "tasks.update": 25, "tasks.status": 15, "tasks.move": 10, "tasks.delete": 5,
+              "projects.update": 5, "labels.create": 5, "comments.create": 5},
+}
+
+
+def parse_mix(value):
+    if value in MIXES:
+        return MIXES[value]
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.strip().partition("=")
+        if name not in PAYLOADS:
+            raise argparse.ArgumentTypeError(f"unknown action {name!r}; known: {', '.join(sorted(PAYLOADS))}")
+        try:
+            mix[name] = float(weight or 1)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"bad weight in {item!r}")
+    return mix
+
+
+def _pick(rng, objects):
+    return rng.choice(objects)["id"]
+
+
+# "resource.action" -> builds the manage request body from the mock's account
+PAYLOADS = {
+    "tasks.list": lambda rng, a: {"action": "list", "project_id": _pick(rng, a["projects"])} if rng.random() < 0.5
+    else {"action": "list"},
+    "tasks.get": lambda rng, a: {"action": "get", "task_id": _pick(rng, a["tasks"])},
+    "tasks.create": lambda rng, a: {"action": "create", "content": f"Benchmark task {rng.randrange(10 ** 6)}",
+                                    "project_id": _pick(rng, a["projects"])},
+    "tasks.update": lambda rng, a: {"action": "update", "task_id": _pick(rng, a["tasks"]),
+                                    "priority": rng.randint(1, 4)},
+    "tasks.move": lambda rng, a: {"action": "move", "task_id": _pick(rng, a["tasks"]),
+                                  "section_id": _pick(rng, a["sections"])},
+    "tasks.status": lambda rng, a: {"action": "status", "task_id": _pick(rng, a["tasks"]),
+                                    "status": rng.choice(("closed", "open"))},
+    "tasks.delete": lambda rng, a: {"action": "delete", "task_id": _pick(rng, a["tasks"])},
+    "projects.list": lambda rng, a: {"action": "list"},
+    "projects.get": lambda rng, a: {"action": "get", "project_id": _pick(rng, a["projects"])},
+    "projects.update": lambda rng, a: {"action": "update", "project_id": _pick(rng, a["projects"][1:]),
+                                       "color": rng.choice(("red", "blue", "green"))},
+    "sections.list": lambda rng, a: {"action": "list", "project_id": _pick(rng, a["projects"])},
+    "sections.get": lambda rng, a: {"action": "get", "section_id": _pick(rng, a["sections"])},
+    "labels.list": lambda rng, a: {"action": "list"},
+    "labels.get": lambda rng, a: {"action": "get", "label_id": _pick(rng, a["labels"])},
+    "labels.create": lambda rng, a: {"action": "create", "name": f"bench-{rng.randrange(10 ** 6)}"},
+    "comments.list": lambda rng, a: {"action": "list", "task_id": rng.choice(a["comments"])["task_id"]},
+    "comments.create": lambda rng, a: {"action": "create", "task_id": _pick(rng, a["tasks"]),
+                                       "content": "Benchmark comment"},
+    "collaborators.list": lambda rng, a: {"action": "list", "project_id": _pick(rng, a["projects"])},
+}
+
+
+def percentile(ordered, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not ordered:
+        return None
+    rank = max(int(round(pct / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def summarize(latencies, seconds):
+    ordered = sorted(latencies)
+    ms = lambda value: None if value is None else round(value * 1000, 2)
+    return {"requests": len(ordered), "throughput": round(len(ordered) / seconds, 1) if seconds else 0.0,
+            "p50_ms": ms(percentile(ordered, 50)), "p95_ms": ms(percentile(ordered, 95)),
+            "p99_ms": ms(percentile(ordered, 99)), "max_ms": ms(ordered[-1] if ordered else None)}
+
+
+def tree_rss_kb(pid):
+    """Resident memory of `pid` and its descendants (gunicorn/uvicorn workers), in KiB; Linux only."""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    total, pending = 0, [pid]
+    while pending:
+        current = pending.pop()
+        pending.extend(children.get(current, ()))
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total
+
+
+class RssSampler(threading.Thread):
+    def __init__(self, pid, interval=0.5):
+        super().__init__(name="rss-sampler", daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.is_set():
+            self.sample()
+            self._done.wait(self.interval)
+
+    def sample(self):
+        self.samples.append(tree_rss_kb(self.pid))
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        self.sample()
+
+    def stats(self):
+        samples = [s for s in self.samples if s] or [0]
+        return {"start_mb": round(samples[0] / 1024, 1), "peak_mb": round(max(samples) / 1024, 1),
+                "end_mb": round(samples[-1] / 1024, 1)}
+
+
+def start_app(args, port, mock_url):
+    env = dict(os.environ, PORT=str(port), API_KEY=API_KEY, TODOIST_API_TOKEN="benchmark-token",
+               TODOIST_API_BASE=mock_url, LOG_LEVEL="WARNING", RATE_LIMIT_REQUESTS="0")
+    if args.asgi:
+        env["SERVER_MODE"] = "asgi"
+    for item in args.env:
+        name, _, value = item.partition("=")
+        env[name] = value
+    cmd = args.server_cmd.format(port=port).split() if args.server_cmd else [sys.executable, "main.py"]
+    return subprocess.Popen(cmd, env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                            stdout=subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL)
+
+
+def wait_ready(base, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"the app exited with status {process.returncode} before it was ready")
+        try:
+            if requests.get(f"{base}/metrics", timeout=1).status_code == 200:
+                return
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.2)
+    raise SystemExit(f"the app wasn't ready within {timeout}s")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Run:
+    """Shared state for the worker threads: the recording window and the per-action results."""
+
+    def __init__(self, mix, account, seed):
+        self.names = list(mix)
+        self.weights = [mix[name] for name in self.names]
+        self.account = account
+        self.seed = seed
+        self.recording = False
+        self.stopping = False
+        self.latencies = {}  # action -> [seconds]
+        self.statuses = {}
+        self._lock = threading.Lock()
+
+    def worker(self, number, base):
+        rng = random.Random(f"{self.seed}-{number}")
+        session = requests.Session()
+        session.headers.update({"X-API-KEY": API_KEY})
+        while not self.stopping:
+            name = rng.choices(self.names, self.weights)[0]
+            resource = name.split(".", 1)[0]
+            body = PAYLOADS[name](rng, self.account)
+            started = time.perf_counter()
+            try:
+                status = session.post(f"{base}/{resource}/manage", json=body, timeout=60).status_code
+            except requests.exceptions.RequestException:
+                status = "error"
+            elapsed = time.perf_counter() - started
+            if self.recording:
+                with self._lock:
+                    self.latencies.setdefault(name, []).append(elapsed)
+                    self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+
+    def reset(self):
+        with self._lock:
+            self.latencies.clear()
+            self.statuses.clear()
+
+
+def run_benchmark(args):
+    mock = mock_todoist.MockTodoist(("127.0.0.1", 0), mock_todoist.settings_from(args)).start_in_thread()
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    process = start_app(args, port, mock.base_url)
+    try:
+        wait_ready(base, process)
+        sampler = RssSampler(process.pid)
+        sampler.sample()
+        sampler.start()
+        run = Run(args.mix, mock.account, args.seed)
+        threads = [threading.Thread(target=run.worker, args=(n, base), daemon=True) for n in range(args.concurrency)]
+        for thread in threads:
+            thread.start()
+        time.sleep(args.warmup)
+        run.reset()
+        mock.reset()
+        run.recording = True
+        started = time.monotonic()
+        time.sleep(args.duration)
+        run.recording = False
+        seconds = time.monotonic() - started
+        upstream = mock.stats()
+        run.stopping = True
+        for thread in threads:
+            thread.join()
+        sampler.stop()
+    finally:
+        process.terminate()
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        mock.shutdown()
+
+    total = summarize([v for values in run.latencies.values() for v in values], seconds)
+    return {
+        "config": config_of(args),
+        "overall": total,
+        "actions": {name: summarize(values, seconds) for name, values in sorted(run.latencies.items())},
+        "statuses": dict(sorted(run.statuses.items())),
+        "upstream": {"calls": upstream["total"], "per_request": round(upstream["total"] / total["requests"], 3)
+                     if total["requests"] else None, "routes": upstream["calls"]},
+        "rss": sampler.stats(),
+    }
+
+
+def load_actions(revision):
+    """actions.py as of a git revision, as a module of its own."""
+    source = subprocess.run(["git", "show", f"{revision}:actions.py"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, check=True).stdout
+    module = types.ModuleType(f"actions@{revision}")
+    exec(compile(source, f"actions.py@{revision}", "exec"), module.__dict__)
+    return module
+
+
+def time_validation(against=None, number=20000, seed=0):
+    """Microseconds per build_call() for one request of each action in PAYLOADS; best of 5 runs."""
+    builders = {"current": actions.build_call}
+    if against:
+        builders[against] = load_actions(against).build_call
+    account = mock_todoist.build_account(mock_todoist.Settings(seed=seed))
+    rng = random.Random(seed)
+    report = {}
+    for name, payload in PAYLOADS.items():
+        endpoint, body = name.split(".", 1)[0], payload(rng, account)
+        report[name] = {label: round(min(timeit.repeat(lambda: build(endpoint, body), number=number, repeat=5))
+                                     / number * 1e6, 3) for label, build in builders.items()}
+    return report
+
+
+def print_validation(report):
+    labels = list(next(iter(report.values())))
+    print(f"{'action':22s}" + "".join(f" {label[:12]:>12s}" for label in labels) + "   (us per call)")
+    for name, timings in list(report.items()) + [("all", {label: round(sum(t[label] for t in report.values()), 3)
+                                                          for label in labels})]:
+        print(f"{name:22s}" + "".join(f" {timings[label]:12.2f}" for label in labels))
+
+
+def config_of(args):
+    return {"concurrency": args.concurrency, "duration": args.duration, "mix": args.mix,
+            "server": args.server_cmd or ("asgi" if args.asgi else "wsgi"), "env": sorted(args.env),
+            "latency_ms": args.latency_ms, "jitter_ms": args.jitter_ms, "error_rate": args.error_rate,
+            "rate_limit_rate": args.rate_limit_rate, "tasks": args.tasks, "projects": args.projects,
+            "description_bytes": args.description_bytes}
+
+
+def compare(report, baseline, tolerance):
+    """Lists the ways `report` is worse than `baseline` by more than `tolerance`."""
+    regressions = []
+    checks = [("throughput", report["overall"]["throughput"], baseline["overall"]["throughput"], -1),
+              ("p95_ms", report["overall"]["p95_ms"], baseline["overall"]["p95_ms"], 1),
+              ("p99_ms", report["overall"]["p99_ms"], baseline["overall"]["p99_ms"], 1),
+              ("upstream calls/request", report["upstream"]["per_request"],
+               baseline["upstream"]["per_request"], 1)]
+    for name, now, then, worse in checks:
+        if now is None or not then:
+            continue
+        change = (now - then) / then
+        if change * worse > tolerance:
+            regressions.append(f"{name}: {then} -> {now} ({change:+.1%})")
+    return regressions
+
+
+def print_report(report):
+    overall, upstream, rss = report["overall"], report["upstream"], report["rss"]
+    print(f"{'action':22s} {'requests':>9s} {'req/s':>8s} {'p50 ms':>8s} {'p95 ms':>8s} {'p99 ms':>8s}")
+    for name, stats in list(report["actions"].items()) + [("all", overall)]:
+        print(f"{name:22s} {stats['requests']:9d} {stats['throughput']:8.1f} {stats['p50_ms'] or 0:8.1f} "
+              f"{stats['p95_ms'] or 0:8.1f} {stats['p99_ms'] or 0:8.1f}")
+    print("statuses: " + ", ".join(f"{status}={count}" for status, count in report["statuses"].items()))
+    print(f"upstream: {upstream['calls']} calls, {upstream['per_request']} per request")
+    for route, count in upstream["routes"].items():
+        print(f"    {route:36s} {count}")
+    print(f"rss: start {rss['start_mb']} MB, peak {rss['peak_mb']} MB, end {rss['end_mb']} MB")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--concurrency", type=int, default=8, help="client threads")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds measured")
+    parser.add_argument("--warmup", type=float, default=3.0, help="seconds run before measuring")
+    parser.add_argument("--mix", type=parse_mix, default="default",
+                        help=f"action weights: {', '.join(MIXES)} or name=weight,...")
+    parser.add_argument("--asgi", action="store_true", help="serve with SERVER_MODE=asgi")
+    parser.add_argument("--server-cmd", help="command starting the app, with {port}, e.g. "
+                        "'gunicorn -w 4 -b 127.0.0.1:{port} main:app'")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="extra environment for the app, repeatable")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--save-baseline", metavar="NAME", help="save the report as benchmarks/NAME.json")
+    parser.add_argument("--compare", metavar="NAME", help="fail on a regression from benchmarks/NAME.json")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed regression, as a fraction")
+    parser.add_argument("--verbose", action="store_true", help="show the app's stderr")
+    parser.add_argument("--validation", action="store_true", help="time request validation instead of load-testing")
+    parser.add_argument("--against", metavar="REV", help="with --validation, also time actions.py at this revision")
+    mock_todoist.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.validation:
+        report = time_validation(args.against, seed=args.seed)
+        if args.json:
+            print(json.dumps(report, indent=2))
+        else:
+            print_validation(report)
+        return 0
+
+    baseline = None
+    if args.compare:
+        with open(os.path.join(BASELINE_DIR, f"{args.compare}.json")) as f:
+            baseline = json.load(f)
+
+    report = run_benchmark(args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(os.path.join(BASELINE_DIR, f"{args.save_baseline}.json"), "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+    if baseline is not None:
+        if baseline["config"] != report["config"]:
+            print(f"warning: baseline {args.compare!r} was run with different options", file=sys.stderr)
+        regressions = compare(report, baseline, args.tolerance)
+        for line in regressions:
+            print(f"regression: {line}", file=sys.stderr)
+        if regressions:
+            return 1
+        print(f"no regression from baseline {args.compare!r}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
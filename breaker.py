@@ -0,0 +1,179 @@
+"""Circuit breakers that stop calling Todoist routes that are failing.
+
+Every upstream call goes through the breaker for its route (the path with
+ids collapsed, as in the metrics: /tasks, /tasks/{id}, /sync). While a
+route's breaker is closed its calls go through and their outcomes are kept
+for a rolling window. A call fails if Todoist can't be reached, times out
+or answers 5xx, and a call slower than BREAKER_SLOW_CALL_SECONDS counts
+as failed too. Once the window holds enough calls and the failed share
+reaches BREAKER_FAILURE_RATE, the breaker opens: calls to that route are
+refused at once with CircuitOpen instead of tying up a worker until the
+network gives up. After BREAKER_OPEN_SECONDS it half-opens and lets a
+probe call through; the probe's success closes it, a failure opens it
+again.
+
+Reads that have a last known good response are answered from it while a
+breaker isn't closed (see todoist.fetch_todoist), and the probe is sent in
+the background to revalidate it.
+
+Tunables (environment variables, read once per process by upstream.get_breakers()):
+    BREAKER_FAILURE_RATE       share of failed calls that opens a breaker, 0 disables (0.5)
+    BREAKER_MIN_CALLS          calls the window needs before it can open (10)
+    BREAKER_WINDOW_SECONDS     how long outcomes are remembered (30)
+    BREAKER_SLOW_CALL_SECONDS  calls slower than this count as failed (5)
+    BREAKER_OPEN_SECONDS       how long an open breaker refuses calls before probing (30)
+"""
+import logging
+import threading
+import time
+from collections import deque
+
+import requests
+
+from metrics import REGISTRY, upstream_route
+
+log = logging.getLogger(__name__)
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+OPENED = REGISTRY.counter(
+    "gtd_circuit_opened_total", "Times a route's circuit breaker opened.", ("route",))
+SHORT_CIRCUITED = REGISTRY.counter(
+    "gtd_circuit_rejected_total", "Upstream calls refused because their route's circuit was open.", ("route",))
+
+
+class CircuitOpen(requests.exceptions.RequestException):
+    """Raised instead of calling a route whose breaker is open; `retry_after` is in seconds."""
+
+    def __init__(self, route, retry_after):
+        super().__init__(f"Todoist is failing on {route}; not calling it for {retry_after:.1f}s")
+        self.route = route
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Closed/open/half-open breaker over one route's recent call outcomes."""
+
+    def __init__(self, route, failure_rate=0.5, min_calls=10, window=30.0, slow_call_seconds=5.0,
+                 open_seconds=30.0, clock=time.monotonic):
+        self.route = route
+        self.failure_rate = failure_rate
+        self.min_calls = max(min_calls, 1)
+        self.window = window
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.clock = clock
+        self.state = CLOSED
+        self.opened_at = None
+        self._outcomes = deque()  # (time, failed), oldest first
+        self._failures = 0
+        self._probing = False
+        self._revalidating = False
+        self._lock = threading.Lock()
+
+    @property
+    def closed(self):
+        return self.state == CLOSED
+
+    def admit(self):
+        """Lets a call through, returning whether it is the half-open probe; raises CircuitOpen."""
+        with self._lock:
+            if self.state == CLOSED:
+                return False
+            now = self.clock()
+            if self.state == OPEN:
+                remaining = self.opened_at + self.open_seconds - now
+                if remaining > 0:
+                    SHORT_CIRCUITED.inc(route=self.route)
+                    raise CircuitOpen(self.route, remaining)
+                self.state = HALF_OPEN
+                log.info("Circuit for %s half-open, probing", self.route)
+            if self._probing:
+                SHORT_CIRCUITED.inc(route=self.route)
+                raise CircuitOpen(self.route, 1.0)
+            self._probing = True
+            return True
+
+    def release(self, probe):
+        """Ends a call admit() let through, whether or not record() was reached."""
+        if probe:
+            with self._lock:
+                self._probing = False
+
+    def record(self, failed, elapsed):
+        """Takes one call's outcome: `failed` for an unreachable Todoist or a 5xx, and its duration."""
+        failed = failed or elapsed > self.slow_call_seconds
+        with self._lock:
+            now = self.clock()
+            if self.state == HALF_OPEN:
+                if failed:
+                    self._open(now, "the probe failed")
+                else:
+                    self.state = CLOSED
+                    self._outcomes.clear()
+                    self._failures = 0
+                    log.info("Circuit for %s closed", self.route)
+                return
+            if self.state == OPEN:
+                return  # a call admitted before the breaker opened
+            self._outcomes.append((now, failed))
+            self._failures += failed
+            while self._outcomes and self._outcomes[0][0] < now - self.window:
+                self._failures -= self._outcomes.popleft()[1]
+            calls = len(self._outcomes)
+            if calls >= self.min_calls and self._failures >= self.failure_rate * calls:
+                self._open(now, f"{self._failures} of the last {calls} calls failed")
+
+    def _open(self, now, reason):
+        log.warning("Circuit for %s open for %.0fs: %s", self.route, self.open_seconds, reason)
+        self.state = OPEN
+        self.opened_at = now
+        self._outcomes.clear()
+        self._failures = 0
+        OPENED.inc(route=self.route)
+
+    def start_revalidation(self):
+        """Claims the background refresh of a stale read: True if a probe is due and none is running."""
+        with self._lock:
+            due = (self.state == HALF_OPEN and not self._probing) or (
+                self.state == OPEN and self.clock() >= self.opened_at + self.open_seconds)
+            if not due or self._revalidating:
+                return False
+            self._revalidating = True
+            return True
+
+    def end_revalidation(self):
+        with self._lock:
+            self._revalidating = False
+
+    def stats(self):
+        with self._lock:
+            stats = {"state": self.state, "calls": len(self._outcomes), "failures": self._failures}
+            if self.state == OPEN:
+                stats["retry_after"] = round(max(self.opened_at + self.open_seconds - self.clock(), 0.0), 1)
+            return stats
+
+
+class Breakers:
+    """One CircuitBreaker per upstream route, created on first use."""
+
+    def __init__(self, **settings):
+        self.settings = settings
+        self.enabled = settings.get("failure_rate", 0.5) > 0
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """The breaker for `path`'s route, or None when breakers are disabled."""
+        if not self.enabled:
+            return None
+        route = upstream_route(path)
+        breaker = self._breakers.get(route)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(route, CircuitBreaker(route, **self.settings))
+        return breaker
+
+    def stats(self):
+        return {route: breaker.stats() for route, breaker in list(self._breakers.items())}
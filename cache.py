@@ -0,0 +1,215 @@
+"""Bounded in-process cache for Todoist GET responses.
+
+proxy() consults this before any GET goes upstream. Entries expire after a
+TTL and the least recently used ones are dropped once the entry or byte cap
+is reached. Successful writes evict whatever they could have made stale.
+
+A second, longer-lived store keeps the last good response of each read for
+when Todoist can't be asked (see breaker.py); such answers carry an
+X-Stale header with their age in seconds. It shares the cached bodies
+rather than copying them.
+
+Tunables (environment variables, read once per process):
+    CACHE_TTL_SECONDS      seconds an entry stays fresh, 0 disables (30)
+    CACHE_MAX_ENTRIES      max cached responses per worker (512)
+    CACHE_MAX_BYTES        max total cached body bytes per worker (16 MiB)
+    CACHE_MAX_ENTRY_BYTES  bodies larger than this are not cached (2 MiB)
+    STALE_MAX_AGE_SECONDS  oldest last good response served, 0 disables the store (86400)
+    STALE_MAX_ENTRIES      max last good responses kept per worker (1024)
+    STALE_MAX_BYTES        max total bytes of last good responses per worker (32 MiB)
+"""
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from metrics import REGISTRY
+from upstream import env_float, env_int
+
+CachedResponse = namedtuple("CachedResponse", "status body content_type stored_at")
+
+# Writes to one resource can change what other resources return, e.g.
+# deleting a project deletes its sections, tasks and comments, and renaming
+# a label rewrites the label names stored on tasks.
+CASCADES = {
+    ("projects", "DELETE"): ("sections", "tasks", "comments"),
+    ("sections", "DELETE"): ("tasks",),
+    ("tasks", "DELETE"): ("comments",),
+    ("labels", "POST"): ("tasks",),
+    ("labels", "DELETE"): ("tasks",),
+    ("comments", "POST"): ("tasks",),  # comment_count
+    ("comments", "DELETE"): ("tasks",),
+}
+
+
+def normalize_params(params):
+    if not params:
+        return ()
+    return tuple(sorted((str(k), str(v)) for k, v in params.items() if v is not None))
+
+
+class ResponseCache:
+    """TTL + LRU cache of upstream GET responses, keyed by (namespace, path, params)."""
+
+    def __init__(self, ttl=30.0, max_entries=512, max_bytes=16 * 1024 * 1024, max_entry_bytes=2 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        # Bumped on every invalidation so a GET that started before a write
+        # can't store its (now stale) body afterwards.
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = self.invalidations = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            ttl=env_float("CACHE_TTL_SECONDS", 30.0),
+            max_entries=env_int("CACHE_MAX_ENTRIES", 512),
+            max_bytes=env_int("CACHE_MAX_BYTES", 16 * 1024 * 1024),
+            max_entry_bytes=env_int("CACHE_MAX_ENTRY_BYTES", 2 * 1024 * 1024),
+        )
+
+    @property
+    def enabled(self):
+        return self.ttl > 0 and self.max_entries > 0
+
+    def make_key(self, namespace, path, params=None):
+        return (namespace, path, normalize_params(params))
+
+    def generation(self, namespace):
+        return self._generations.get(namespace, 0)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if time.monotonic() - entry.stored_at > self.ttl:
+                self._drop(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(self, key, status, body, content_type, generation=None):
+        """Stores a response unless it is too big or the namespace was invalidated since `generation`."""
+        if not self.enabled or len(body) > self.max_entry_bytes:
+            return False
+        with self._lock:
+            if generation is not None and generation != self._generations.get(key[0], 0):
+                return False
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = CachedResponse(status, body, content_type, time.monotonic())
+            self._bytes += len(body)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self.evictions += 1
+        return True
+
+    def invalidate(self, namespace, method, path):
+        """Evicts entries a successful write of `method path` may have made stale."""
+        parts = path.strip("/").split("/")
+        resource = parts[0]
+        item_path = f"/{resource}/{parts[1]}" if len(parts) > 1 else None
+        cascaded = tuple(f"/{other}" for other in CASCADES.get((resource, method), ()))
+
+        def is_stale(entry_path):
+            if entry_path == f"/{resource}":
+                return True
+            if item_path and (entry_path == item_path or entry_path.startswith(item_path + "/")):
+                return True
+            return any(entry_path == p or entry_path.startswith(p + "/") for p in cascaded)
+
+        with self._lock:
+            self._generations[namespace] = self._generations.get(namespace, 0) + 1
+            stale = [k for k in self._entries if k[0] == namespace and is_stale(k[1])]
+            for key in stale:
+                self._drop(key)
+            self.invalidations += len(stale)
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self._generations.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "ttl_seconds": self.ttl,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= len(entry.body)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+_stale = None
+
+STALE_RESPONSES = REGISTRY.counter(
+    "gtd_stale_responses_total", "Reads answered with a last good response, by why Todoist wasn't used.",
+    ("reason",))
+
+
+def _cache_collector():
+    if _cache is None:
+        return []
+    stats = _cache.stats()
+    return [
+        (f"gtd_cache_{name}_total", "counter", f"Response cache {name}.", [({}, stats[name])])
+        for name in ("hits", "misses", "evictions", "expirations", "invalidations")
+    ] + [
+        ("gtd_cache_entries", "gauge", "Responses currently cached.", [({}, stats["entries"])]),
+        ("gtd_cache_bytes", "gauge", "Body bytes currently cached.", [({}, stats["bytes"])]),
+    ]
+
+
+REGISTRY.add_collector(_cache_collector)
+
+
+def get_cache():
+    """Returns this process's shared response cache."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache.from_env()
+    return _cache
+
+
+def get_stale_store():
+    """Returns this process's store of last good responses: a ResponseCache whose TTL is the max staleness."""
+    global _stale
+    if _stale is None:
+        with _cache_lock:
+            if _stale is None:
+                _stale = ResponseCache(
+                    ttl=env_float("STALE_MAX_AGE_SECONDS", 86400.0),
+                    max_entries=env_int("STALE_MAX_ENTRIES", 1024),
+                    max_bytes=env_int("STALE_MAX_BYTES", 32 * 1024 * 1024),
+                    max_entry_bytes=env_int("CACHE_MAX_ENTRY_BYTES", 2 * 1024 * 1024),
+                )
+    return _stale
@@ -0,0 +1,307 @@
+"""Change feed fed by Todoist webhooks, so clients stop re-listing to find changes.
+
+    POST /webhooks/todoist   Todoist's webhook deliveries (signed, no API key)
+    GET  /changes            ?since=<seq>: long-poll for the changes after seq
+    GET  /changes            Accept: text/event-stream (or ?stream=sse): server-sent events (ASGI mode)
+
+Each delivery is checked against X-Todoist-Hmac-SHA256, the base64
+HMAC-SHA256 of the body under the app's TODOIST_CLIENT_SECRET, and routed
+to the tenant whose Todoist user it is for (auth.Registry.for_user).
+Item, note, project, section and label events are numbered and kept in a
+ring buffer of the last CHANGES_BUFFER_SIZE changes; a redelivery (same
+X-Todoist-Delivery-ID) is accepted but not added again. Each event also
+evicts the cached reads it made stale and wakes the mirror, as a write
+through this service would.
+
+A long-poll answers at once if there are changes after `since`, else
+waits up to `timeout` seconds (at most CHANGES_MAX_WAIT_SECONDS) for one:
+
+    {"next": 1760000000123, "reset": false, "changes": [
+        {"seq": 1760000000123, "event": "item:updated", "resource": "tasks",
+         "id": "123", "triggered_at": "...", "data": {...Todoist's object...}}]}
+
+Poll again with since=next. "reset": true means changes after `since`
+are no longer held (the buffer moved on, or this process restarted), so
+the client should list what it needs once and go on from `next`.
+Sequence numbers start at the process's start time in milliseconds, so a
+restart never reuses them. An event stream sends the same changes as
+"id: <seq>", "event: <event>", "data: <change>" messages, a "reset" event
+in place of a reset, and keep-alive comments; it ends after
+CHANGES_STREAM_SECONDS and resumes from Last-Event-ID on reconnect.
+
+Waiting is only done in the ASGI mode (asgi.py), where a waiting client
+costs the event loop a future rather than a worker thread. Under WSGI a
+long-poll would hold a sync worker for its whole timeout, so there
+/changes answers at once with the changes already held, whatever
+`timeout` says, and event streams are refused with 501.
+
+The buffer is per process, and so are the sequence numbers: a webhook is
+only seen by clients of the worker process that took it, and `since` from
+one process means nothing to another. Serve /changes and
+/webhooks/todoist from a single worker process (e.g. gunicorn -w 1 -k
+uvicorn.workers.UvicornWorker asgi:app); more workers lose changes and
+reset clients.
+
+Tunables (environment variables, read once per process):
+    TODOIST_CLIENT_SECRET      the Todoist app's client secret; /webhooks/todoist is off without it
+    CHANGES_BUFFER_SIZE        changes kept for clients to catch up on (1000)
+    CHANGES_MAX_WAIT_SECONDS   longest long-poll wait (30)
+    CHANGES_STREAM_SECONDS     how long one event stream stays open (300)
+"""
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+from itertools import islice
+
+from auth import get_registry
+from metrics import REGISTRY
+from todoist import after_write
+from upstream import env_float, env_int
+
+log = logging.getLogger(__name__)
+
+MAX_WEBHOOK_BYTES = 1024 * 1024
+HEARTBEAT_SECONDS = 15.0
+DEFAULT_LIMIT = 500
+
+# Todoist's object names -> the manage endpoint that reads them
+RESOURCES = {"item": "tasks", "note": "comments", "project": "projects", "section": "sections", "label": "labels"}
+
+WEBHOOKS = REGISTRY.counter(
+    "gtd_webhook_deliveries_total", "Todoist webhook deliveries received, by outcome.", ("outcome",))
+SUBSCRIBERS = REGISTRY.gauge(
+    "gtd_change_subscribers", "Clients waiting on /changes, by mode.", ("mode",))
+
+Change = namedtuple("Change", "seq namespace event encoded")
+Batch = namedtuple("Batch", "changes next reset")
+
+
+class ChangeFeed:
+    """Bounded, numbered log of changes per namespace, with blocking and async waits for new ones."""
+
+    def __init__(self, size=1000, start=None):
+        self.size = max(size, 1)
+        self._changes = deque(maxlen=self.size)
+        self._seq = int(time.time() * 1000) if start is None else start
+        self._lock = threading.Lock()
+        self._callbacks = []  # wake-ups for async waiters, called once on the next publish
+        self._deliveries = OrderedDict()  # recent delivery ids, to drop redeliveries
+
+    @property
+    def seq(self):
+        return self._seq
+
+    def publish(self, namespace, event, change, delivery_id=None):
+        """Numbers `change` (a dict) and adds it; returns its seq, or None for a redelivery."""
+        with self._lock:
+            if delivery_id:
+                if delivery_id in self._deliveries:
+                    return None
+                self._deliveries[delivery_id] = None
+                if len(self._deliveries) > self.size:
+                    self._deliveries.popitem(last=False)
+            self._seq += 1
+            change["seq"] = self._seq
+            # Encoded once here rather than for every client that reads it
+            encoded = json.dumps(change, separators=(",", ":")).encode("utf-8")
+            self._changes.append(Change(self._seq, namespace, event, encoded))
+            callbacks, self._callbacks = self._callbacks, []
+            seq = self._seq
+        for callback in callbacks:
+            callback()
+        return seq
+
+    def read(self, namespace, since, limit=DEFAULT_LIMIT):
+        """The namespace's changes after `since`, at most `limit` of them, as a Batch."""
+        with self._lock:
+            return self._read(namespace, since, limit)
+
+    def _read(self, namespace, since, limit):
+        oldest = self._changes[0].seq if self._changes else self._seq + 1
+        if since is None:
+            since = self._seq
+        if since < oldest - 1 or since > self._seq:
+            return Batch([], self._seq, True)
+        found = []
+        for change in islice(self._changes, since - oldest + 1, None):
+            if change.namespace == namespace:
+                found.append(change)
+                if len(found) == limit:
+                    return Batch(found, change.seq, False)
+        return Batch(found, self._seq, False)
+
+    async def wait_async(self, namespace, since, timeout, limit=DEFAULT_LIMIT):
+        """read(), waiting up to `timeout` seconds for a change if there is none yet; for the event loop."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            published = loop.create_future()
+
+            def wake(published=published):
+                loop.call_soon_threadsafe(lambda: published.done() or published.set_result(None))
+
+            with self._lock:
+                batch = self._read(namespace, since, limit)
+                remaining = deadline - loop.time()
+                if batch.changes or batch.reset or remaining <= 0:
+                    return batch
+                self._callbacks.append(wake)
+            since = batch.next
+            try:
+                await asyncio.wait_for(published, remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self._lock:
+                    if wake in self._callbacks:
+                        self._callbacks.remove(wake)
+
+    def stats(self):
+        with self._lock:
+            return {"seq": self._seq, "buffered": len(self._changes), "size": self.size,
+                    "oldest": self._changes[0].seq if self._changes else None}
+
+
+_feed = None
+_feed_lock = threading.Lock()
+
+
+def get_feed():
+    """Returns this process's change feed."""
+    global _feed
+    if _feed is None:
+        with _feed_lock:
+            if _feed is None:
+                _feed = ChangeFeed(size=env_int("CHANGES_BUFFER_SIZE", 1000))
+    return _feed
+
+
+# --- Webhooks ---
+
+def _signature_ok(secret, body, signature):
+    expected = base64.b64encode(hmac.new(secret.encode("utf-8"), body, hashlib.sha256).digest()).decode("ascii")
+    return hmac.compare_digest(expected, signature or "")
+
+
+def receive_webhook(body, signature, delivery_id=None):
+    """Takes one Todoist webhook delivery; returns (status, JSON body) for Todoist."""
+    secret = os.getenv("TODOIST_CLIENT_SECRET")
+    if not secret:
+        return 404, {"error": "Webhooks are not configured"}
+    if len(body) > MAX_WEBHOOK_BYTES:
+        WEBHOOKS.inc(outcome="rejected")
+        return 413, {"error": "Webhook body too large"}
+    if not _signature_ok(secret, body, signature):
+        WEBHOOKS.inc(outcome="rejected")
+        log.warning("Rejected a webhook delivery with a bad signature")
+        return 401, {"error": "Invalid webhook signature"}
+    try:
+        delivery = json.loads(body)
+        event = str(delivery["event_name"])
+        data = delivery.get("event_data") or {}
+        user_id = delivery["user_id"]
+    except (ValueError, KeyError, TypeError):
+        WEBHOOKS.inc(outcome="rejected")
+        return 400, {"error": "Not a Todoist webhook delivery"}
+
+    kind, _, verb = event.partition(":")
+    resource = RESOURCES.get(kind)
+    if resource is None or not isinstance(data, dict):
+        WEBHOOKS.inc(outcome="ignored")
+        return 200, {"accepted": False}
+    tenant = get_registry().for_user(user_id)
+    if tenant is None:
+        WEBHOOKS.inc(outcome="unrouted")
+        log.warning("Webhook %s for Todoist user %s matches no tenant", event, user_id)
+        return 200, {"accepted": False}
+
+    namespace = tenant.headers["Authorization"]
+    object_id = data.get("id")
+    change = {"event": event, "resource": resource, "id": str(object_id) if object_id is not None else None,
+              "triggered_at": delivery.get("triggered_at"), "data": data}
+    seq = get_feed().publish(namespace, event, change, delivery_id)
+    if seq is None:
+        WEBHOOKS.inc(outcome="duplicate")
+        return 200, {"accepted": True, "duplicate": True}
+    WEBHOOKS.inc(outcome="accepted")
+    # The same invalidation a write through this service does; Todoist has already applied it
+    path = f"/{resource}/{object_id}" if object_id is not None else f"/{resource}"
+    after_write(namespace, "DELETE" if verb == "deleted" else "POST", path)
+    log.debug("Webhook %s for %s as change %s", event, tenant.name, seq)
+    return 200, {"accepted": True, "seq": seq}
+
+
+# --- Clients ---
+
+def parse_since(value):
+    """A since/Last-Event-ID value as a seq (None when absent); raises ValueError."""
+    if value in (None, ""):
+        return None
+    since = int(value)
+    if since < 0:
+        raise ValueError(value)
+    return since
+
+
+def poll_timeout(value):
+    """A long-poll's timeout in seconds, capped at CHANGES_MAX_WAIT_SECONDS; raises ValueError."""
+    limit = env_float("CHANGES_MAX_WAIT_SECONDS", 30.0)
+    timeout = limit if value in (None, "") else float(value)
+    if not timeout >= 0:  # also rejects NaN
+        raise ValueError(value)
+    return min(timeout, limit)
+
+
+def stream_seconds():
+    return env_float("CHANGES_STREAM_SECONDS", 300.0)
+
+
+def snapshot(feed, namespace, since):
+    """The long-poll response body under WSGI: the namespace's changes after `since`, without waiting."""
+    return encode_batch(feed.read(namespace, since))
+
+
+async def long_poll_async(feed, namespace, since, timeout):
+    """The long-poll response body: the namespace's changes after `since`, waiting for one if need be."""
+    SUBSCRIBERS.inc(mode="poll")
+    try:
+        return encode_batch(await feed.wait_async(namespace, since, timeout))
+    finally:
+        SUBSCRIBERS.dec(mode="poll")
+
+
+def encode_batch(batch):
+    """The long-poll response body for a Batch."""
+    return b"".join((b'{"next":', str(batch.next).encode(), b',"reset":', b"true" if batch.reset else b"false",
+                     b',"changes":[', b",".join(change.encoded for change in batch.changes), b"]}"))
+
+
+def _event_messages(batch):
+    if batch.reset:
+        return b'id: %d\nevent: reset\ndata: {"next":%d}\n\n' % (batch.next, batch.next)
+    return b"".join(b"id: %d\nevent: %s\ndata: %s\n\n" % (change.seq, change.event.encode("utf-8"), change.encoded)
+                    for change in batch.changes)
+
+
+async def event_stream_async(feed, namespace, since):
+    """Server-sent events for the namespace's changes after `since`, for CHANGES_STREAM_SECONDS."""
+    deadline = time.monotonic() + stream_seconds()
+    SUBSCRIBERS.inc(mode="stream")
+    try:
+        yield b"retry: 3000\n\n"
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            batch = await feed.wait_async(namespace, since, min(HEARTBEAT_SECONDS, remaining))
+            since = batch.next
+            yield _event_messages(batch) or b": keep-alive\n\n"
+    finally:
+        SUBSCRIBERS.dec(mode="stream")
@@ -0,0 +1,252 @@
+"""Single-flight coalescing of identical concurrent GETs.
+
+When several requests want the same Todoist GET (same credential, path and
+params) at the same moment, the first one goes upstream and the rest wait
+for its result instead of sending their own. Nothing is kept once the call
+lands, so this never serves anything older than an in-flight request.
+
+Within a worker, threads share a Flight. Across gunicorn workers, the
+leader holds an flock() on a per-key lock file in COALESCE_SHARED_DIR
+(ideally on tmpfs, e.g. /dev/shm/gtd-flights) and publishes the body next
+to it; workers that find the lock taken wait for it and read that body.
+
+Tunables (environment variables):
+    COALESCE_GETS          set to 0 to turn coalescing off (on)
+    COALESCE_SHARED_DIR    directory for cross-worker coalescing (off)
+    COALESCE_WAIT_SECONDS  longest a follower waits before going upstream itself (15)
+    COALESCE_MAX_BYTES     larger bodies aren't shared; waiters fetch their own (8 MiB)
+"""
+import asyncio
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from metrics import REGISTRY
+from upstream import env_float
+
+log = logging.getLogger(__name__)
+
+POLL_SECONDS = 0.005
+SHARED_FILE_MAX_AGE = 60.0
+
+
+class Flight:
+    """One in-flight upstream call that other threads (or coroutines) can wait on."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self.result = None
+        self.error = None
+
+    def wait(self, timeout):
+        """Returns the leader's result, None if it has none to share, or raises the leader's error."""
+        if not self._done.wait(timeout):
+            return None
+        return self._outcome()
+
+    async def wait_async(self, timeout):
+        """wait() for the event loop, without tying up a thread per waiter."""
+        loop = asyncio.get_running_loop()
+        landed = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: landed.done() or landed.set_result(None))
+
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(wake)
+            else:
+                landed.set_result(None)
+        try:
+            await asyncio.wait_for(landed, timeout)
+        except asyncio.TimeoutError:
+            return None
+        return self._outcome()
+
+    def _outcome(self):
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def _set(self, result, error):
+        with self._lock:
+            self.result = result
+            self.error = error
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+class SingleFlight:
+    """Table of in-flight calls in this process, keyed by (namespace, path, params)."""
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.leaders = self.followers = 0
+
+    def join(self, key):
+        """Returns (flight, True) for the caller that should go upstream, (flight, False) for waiters."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.followers += 1
+                return flight, False
+            flight = self._flights[key] = Flight()
+            self.leaders += 1
+            return flight, True
+
+    def land(self, key, flight, result=None, error=None):
+        """Hands the leader's buffered result (or None, or an error) to every waiter."""
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight._set(result, error)
+
+
+class SharedFlights:
+    """Cross-process coalescing through flock()ed lock files and published bodies."""
+
+    def __init__(self, directory, wait_timeout=15.0):
+        self.directory = directory
+        self.wait_timeout = wait_timeout
+        self.led = self.followed = 0
+        self._publishes = 0
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def _paths(self, key):
+        # Keys contain the credential, so only a digest goes on disk
+        digest = hashlib.sha256(repr(key).encode()).hexdigest()[:32]
+        base = os.path.join(self.directory, digest)
+        return base + ".lock", base + ".body"
+
+    def try_lead(self, key):
+        """Returns a lock handle if this process should go upstream, None if another one already is."""
+        lock_path, _ = self._paths(key)
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        self.led += 1
+        return fd
+
+    def publish(self, key, fd, status=None, content_type=None, content=None):
+        """Publishes the leader's body (content None means nothing to share) and releases the lock."""
+        _, body_path = self._paths(key)
+        try:
+            header = {"finished_at": time.time(), "status": status, "content_type": content_type,
+                      "shared": content is not None}
+            tmp_path = f"{body_path}.{os.getpid()}.tmp"
+            with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as f:
+                f.write(json.dumps(header).encode() + b"\n")
+                if content is not None:
+                    f.write(content)
+            os.replace(tmp_path, body_path)
+        except OSError as e:
+            log.warning("Could not publish coalesced response: %s", e)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+        self._publishes += 1
+        if self._publishes % 100 == 0:
+            self._sweep()
+
+    def follow(self, key, arrived):
+        """Waits for the other process's call to land; returns (status, content_type, content) or None."""
+        lock_path, body_path = self._paths(key)
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            deadline = time.monotonic() + self.wait_timeout
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        return None
+                    time.sleep(POLL_SECONDS)
+            try:
+                with open(body_path, "rb") as f:
+                    header = json.loads(f.readline())
+                    content = f.read()
+            except (OSError, ValueError):
+                return None
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            # Only a call that landed after we arrived is the one we were waiting on
+            if not header.get("shared") or header["finished_at"] < arrived:
+                return None
+            self.followed += 1
+            return header["status"], header["content_type"], content
+        finally:
+            os.close(fd)
+
+    def _sweep(self):
+        cutoff = time.time() - SHARED_FILE_MAX_AGE
+        for name in os.listdir(self.directory):
+            if not name.endswith(".body"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+_flights = None
+_shared = None
+_shared_pid = None
+_init_lock = threading.Lock()
+
+
+def coalescing_enabled():
+    return os.getenv("COALESCE_GETS", "1").lower() not in ("0", "false", "no")
+
+
+def get_flights():
+    """Returns this process's in-flight call table."""
+    global _flights
+    if _flights is None:
+        with _init_lock:
+            if _flights is None:
+                _flights = SingleFlight()
+    return _flights
+
+
+def get_shared_flights():
+    """Returns the cross-worker coordinator, or None when COALESCE_SHARED_DIR isn't set."""
+    global _shared, _shared_pid
+    directory = os.getenv("COALESCE_SHARED_DIR")
+    if not directory:
+        return None
+    if _shared is None or _shared_pid != os.getpid():
+        with _init_lock:
+            if _shared is None or _shared_pid != os.getpid():
+                _shared = SharedFlights(directory, env_float("COALESCE_WAIT_SECONDS", 15.0))
+                _shared_pid = os.getpid()
+    return _shared
+
+
+def _coalesce_collector():
+    families = []
+    if _flights is not None:
+        families.append(("gtd_coalesce_requests_total", "counter",
+                         "GETs that led an upstream call or waited on one already in flight.",
+                         [({"role": "leader", "scope": "worker"}, _flights.leaders),
+                          ({"role": "follower", "scope": "worker"}, _flights.followers)]
+                         + ([({"role": "leader", "scope": "shared"}, _shared.led),
+                             ({"role": "follower", "scope": "shared"}, _shared.followed)] if _shared else [])))
+    return families
+
+
+REGISTRY.add_collector(_coalesce_collector)
@@ -0,0 +1,13 @@
+"""gunicorn settings, read from the working directory by default (or pass -c gunicorn.conf.py).
+
+gunicorn resets a worker's signal handlers once it has forked, and with
+--preload the app is imported in the master, before any worker exists, so
+the SIGHUP handler main.py installs at import never reaches the workers.
+It is installed again here, in each worker, after gunicorn has set up its
+own handlers.
+"""
+from auth import install_reload_handler
+
+
+def post_worker_init(worker):
+    install_reload_handler()
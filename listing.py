@@ -0,0 +1,131 @@
+"""Field projection and cursor pagination for the `list` actions.
+
+Todoist's REST v2 list endpoints return every object with every field in
+one response. A list request may narrow that with:
+
+    fields    top-level fields to keep, as an array or comma-separated string
+              ("id" is always included)
+    limit     page size, 1..LIST_MAX_LIMIT; returns {"items": [...], "next_cursor": ...}
+    cursor    next_cursor from the previous page
+    order_by  "id" (default) or "order"; pages are stable across inserts and
+              deletes because the cursor holds the last key, not an offset
+
+The full upstream list still comes from the mirror, the cache or Todoist
+(so later pages are usually cache hits); only the requested slice is
+serialized back to the client.
+"""
+import base64
+import json
+from collections import namedtuple
+
+from upstream import env_int
+
+LIST_MAX_LIMIT = env_int("LIST_MAX_LIMIT", 200)
+
+# Sort orders each resource supports; comments have no manual order
+ORDERINGS = {
+    "tasks": ("id", "order"),
+    "projects": ("id", "order"),
+    "sections": ("id", "order"),
+    "labels": ("id", "order"),
+    "comments": ("id",),
+}
+
+ListView = namedtuple("ListView", "fields limit cursor order_by")
+
+
+def parse_list_view(data, resource):
+    """Reads fields/limit/cursor/order_by from a list request; None when none were given.
+
+    Raises ValueError with a client-facing message for invalid parameters.
+    """
+    if not any(data.get(key) is not None for key in ("fields", "limit", "cursor", "order_by")):
+        return None
+
+    fields = data.get("fields")
+    if fields is not None:
+        if isinstance(fields, str):
+            fields = [f.strip() for f in fields.split(",") if f.strip()]
+        if not isinstance(fields, list) or not fields or not all(isinstance(f, str) for f in fields):
+            raise ValueError("'fields' must be a non-empty list of field names or a comma-separated string")
+        fields = tuple(dict.fromkeys(["id"] + fields))
+
+    order_by = str(data.get("order_by") or "id")
+    if order_by not in ORDERINGS[resource]:
+        raise ValueError(f"'order_by' must be one of: {', '.join(ORDERINGS[resource])}")
+
+    limit = data.get("limit")
+    if limit is not None:
+        if isinstance(limit, bool) or not isinstance(limit, (int, str)) or not str(limit).isdigit():
+            raise ValueError("'limit' must be a positive integer")
+        limit = int(limit)
+        if not 1 <= limit <= LIST_MAX_LIMIT:
+            raise ValueError(f"'limit' must be between 1 and {LIST_MAX_LIMIT}")
+
+    cursor = data.get("cursor")
+    if cursor is not None:
+        cursor = _decode_cursor(cursor, order_by)
+        if limit is None:
+            limit = LIST_MAX_LIMIT
+    return ListView(fields, limit, cursor, order_by)
+
+
+def apply_view(view, items):
+    """Returns the projected list, or a {"items", "next_cursor"} page when paginating."""
+    if not isinstance(items, list):
+        raise ValueError("expected a JSON array")
+    if view.limit is not None:
+        keyed = sorted(((_sort_key(item, view.order_by), item) for item in items if isinstance(item, dict)),
+                       key=lambda pair: pair[0])
+        if view.cursor is not None:
+            keyed = [pair for pair in keyed if pair[0] > view.cursor]
+        page = keyed[:view.limit]
+        next_cursor = _encode_cursor(page[-1][0], view.order_by) if len(keyed) > view.limit else None
+        items = [item for _, item in page]
+    if view.fields is not None:
+        items = [{f: item[f] for f in view.fields if f in item} if isinstance(item, dict) else item
+                 for item in items]
+    if view.limit is None:
+        return items
+    return {"items": items, "next_cursor": next_cursor}
+
+
+def render_view(view, content):
+    """Applies `view` to a raw JSON list body and returns the serialized result."""
+    shaped = apply_view(view, json.loads(content))
+    return json.dumps(shaped, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+def _id_key(value):
+    # Todoist ids are numeric strings; compare them as numbers, falling back to text
+    text = str(value)
+    return (0, len(text), text) if text.isdigit() else (1, 0, text)
+
+
+def _sort_key(item, order_by):
+    if order_by == "order":
+        order = item.get("order")
+        return (order if isinstance(order, (int, float)) else 0,) + _id_key(item.get("id"))
+    return _id_key(item.get("id"))
+
+
+def _encode_cursor(key, order_by):
+    raw = json.dumps({"o": order_by, "k": list(key)}, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _decode_cursor(cursor, order_by):
+    try:
+        raw = base64.urlsafe_b64decode(str(cursor) + "=" * (-len(str(cursor)) % 4))
+        decoded = json.loads(raw)
+        key = tuple(decoded["k"])
+    except (ValueError, TypeError, KeyError):
+        raise ValueError("'cursor' is not a valid cursor")
+    if decoded.get("o") != order_by:
+        raise ValueError("'cursor' was issued for a different 'order_by'")
+    # Must compare cleanly against _sort_key(): [order,] (kind, length, text)
+    id_part = key[1:] if order_by == "order" else key
+    if (order_by == "order" and (not key or isinstance(key[0], bool) or not isinstance(key[0], (int, float)))
+            or len(id_part) != 3 or not all(type(k) is t for k, t in zip(id_part, (int, int, str)))):
+        raise ValueError("'cursor' is not a valid cursor")
+    return key
@@ -0,0 +1,40 @@
+"""Logging setup: one JSON object per line on stderr.
+
+Modules log through logging.getLogger(__name__) with %-style arguments, so
+messages below LOG_LEVEL (WARNING by default) are never formatted. Set
+LOG_LEVEL=DEBUG to see every request payload and upstream call, INFO for
+startup and background-worker activity. Extra structured fields can be
+attached with `extra={"fields": {...}}`.
+"""
+import json
+import logging
+import os
+import time
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging():
+    """Installs the JSON handler on the root logger once; safe to call repeatedly."""
+    root = logging.getLogger()
+    if any(isinstance(h.formatter, JsonFormatter) for h in root.handlers):
+        return
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter())
+    root.addHandler(handler)
+    level = logging.getLevelName(os.getenv("LOG_LEVEL", "WARNING").upper())
+    root.setLevel(level if isinstance(level, int) else logging.WARNING)
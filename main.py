@@ -1,9 +1,72 @@
+import logging
 import os
-from flask import Flask, request, jsonify, Response, send_file
+import time
+from flask import Flask, request, jsonify, Response, send_file, g, stream_with_context
 import requests
 
+from actions import ActionError, build_call
+from auth import authenticate, get_registry, install_reload_handler
+from batch import run_batch
+from cache import get_cache, get_stale_store
+from changes import MAX_WEBHOOK_BYTES, get_feed, parse_since, poll_timeout, receive_webhook, snapshot
+from mirror import get_mirror
+from outbox import accept, get_outbox, is_write_behind, with_request_id
+from todoist import apply_list_view, fetch_todoist, upstream_error
+from transfer import NDJSON, open_export, open_import
+from logs import configure_logging
+from metrics import (REGISTRY, REQUEST_BYTES, REQUEST_LATENCY, REQUESTS, REQUESTS_IN_FLIGHT, RESPONSE_BYTES,
+                     count_bytes)
+from upstream import env_int, get_client
+from uploads import stream_attachment
+from views import run_view
+
+configure_logging()
+log = logging.getLogger(__name__)
+# Validate the tenant configuration at startup rather than on the first request
+get_registry()
+install_reload_handler()
+
 app = Flask(__name__)
 
+# Action names used as metric labels; anything else is counted as "other"
+KNOWN_ACTIONS = frozenset({"list", "get", "create", "update", "delete", "move", "status", "collaborators"})
+
+
+# --- Request instrumentation ---
+@app.before_request
+def start_request_metrics():
+    g.metrics_endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    g.metrics_action = ""
+    g.metrics_started = time.perf_counter()
+    REQUESTS_IN_FLIGHT.inc(endpoint=g.metrics_endpoint)
+    REQUEST_BYTES.inc(request.content_length or 0, endpoint=g.metrics_endpoint)
+
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint, action = g.get("metrics_endpoint", "unmatched"), g.get("metrics_action", "")
+    started = g.get("metrics_started", time.perf_counter())
+    REQUESTS.inc(endpoint=endpoint, action=action, status=response.status_code)
+    if response.is_streamed:
+        # The body is produced after this returns; time the request until the server is done with it
+        response.response = count_bytes(response.response, endpoint, action, started)
+    else:
+        REQUEST_LATENCY.observe(time.perf_counter() - started, endpoint=endpoint, action=action)
+        RESPONSE_BYTES.inc(response.calculate_content_length() or 0, endpoint=endpoint)
+    return response
+
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    if "metrics_endpoint" in g:
+        REQUESTS_IN_FLIGHT.dec(endpoint=g.metrics_endpoint)
+
+
+@app.route("/metrics")
+def metrics():
+    """Prometheus scrape endpoint for this worker."""
+    return Response(REGISTRY.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
 # Serve the OpenAPI spec file
 @app.route("/openapi.json")
 def serve_openapi():
@@ -15,295 +78,92 @@ def serve_openapi():
         return jsonify({"error": "openapi.json not found"}), 404
 
 
-# Base URL for Todoist’s REST v2 API
-TODOIST_API_BASE = "https://api.todoist.com/rest/v2"
-
 def get_todoist_headers():
-    """Validates API keys and returns headers for Todoist API calls."""
-    # Get the API key provided by the client (e.g., OpenAI Action)
-    api_key = request.headers.get("X-API-KEY")
-    if not api_key:
-        print("Missing X-API-KEY header from incoming request")
-        # Don't return 401 here immediately, let the caller handle None
-        return None
-
-    # Get the expected API key from environment variables (set in Render)
-    expected_api_key = os.getenv("API_KEY")
-    if not expected_api_key:
-        print("API_KEY environment variable not set on the server")
-        return None # Server configuration issue
-
-    # Validate the client's API key against the expected key
-    if api_key != expected_api_key:
-        print(f"Invalid X-API-KEY provided by client: {api_key}")
-        return None # Authentication failure
-
-    # Get the Todoist API Token from environment variables (set in Render)
-    todoist_token = os.getenv("TODOIST_API_TOKEN")
-    if not todoist_token:
-        print("TODOIST_API_TOKEN environment variable not set on the server")
-        return None # Server configuration issue
-
-    # Prepare headers for the Todoist API
-    headers = {
-        "Authorization": f"Bearer {todoist_token}",
-        "Content-Type": "application/json"
-    }
-    # Avoid printing sensitive headers in production logs if possible
-    # print(f"Headers prepared for Todoist (Authorization omitted for security)")
-    return headers
-
-def proxy(method, path, params=None, json_data=None):
-    """Proxies requests to the Todoist API."""
+    """Validates the client's API key and returns its tenant's headers for Todoist API calls, or None."""
+    tenant, g.auth_failure = authenticate(request.headers.get("X-API-KEY"))
+    g.tenant = tenant
+    return tenant.headers if tenant is not None else None
+
+def auth_failure_response():
+    """Builds the error response for a request that get_todoist_headers() rejected."""
+    status, message = g.auth_failure
+    return jsonify({"error": message}), status
+
+# Stream successful upstream bodies to the client in chunks instead of buffering them
+STREAM_RESPONSES = os.getenv("PROXY_STREAM_RESPONSES", "1").lower() not in ("0", "false", "no")
+
+def proxy(method, path, params=None, json_data=None, view=None):
+    """Proxies requests to the Todoist API.
+
+    `view` (a listing.ListView) projects/paginates a list response; the body
+    then has to be buffered and re-serialized instead of streamed.
+    """
     headers = get_todoist_headers()
     if headers is None:
-        # Determine if the error was client-side (bad X-API-KEY) or server-side (missing ENV VARS)
-        if not request.headers.get("X-API-KEY") or request.headers.get("X-API-KEY") != os.getenv("API_KEY"):
-             return jsonify({"error": "Authentication failed: Invalid or missing X-API-KEY header"}), 401
-        else:
-             # If X-API-KEY was valid, the issue is likely server config
-             print("Server configuration error: Check API_KEY and TODOIST_API_TOKEN environment variables.")
-             return jsonify({"error": "Internal server error: Service configuration issue"}), 500
+        return auth_failure_response()
+    if method != "GET":
+        headers = with_request_id(headers, request.headers.get("Idempotency-Key"))
 
-
-    url = TODOIST_API_BASE + path
-    print(f"Sending to Todoist: {method} {url}, Params: {params}, JSON: {json_data}")
     try:
-        resp = requests.request(method, url, headers=headers, params=params, json=json_data)
-        print(f"Todoist response: Status {resp.status_code}, Body: {resp.text[:500]}...") # Log truncated body
+        result = fetch_todoist(headers, method, path, params=params, json_data=json_data,
+                               stream=STREAM_RESPONSES and view is None)
+    except requests.exceptions.RequestException as e:
+        status, body, extra_headers = upstream_error(e)
+        return jsonify(body), status, extra_headers
 
-        # Handle successful empty response (204 No Content)
-        if resp.status_code == 204:
-            return ("", 204)
+    # Handle successful empty response (204 No Content)
+    if result.status == 204:
+        return ("", 204)
 
-        # Try to parse JSON, otherwise return raw text
-        try:
-            body = resp.json()
-            # Return JSON response with the original status code
-            return jsonify(body), resp.status_code
-        except ValueError:
-            # If response is not JSON, return it as text
-             return Response(resp.text, status=resp.status_code, content_type=resp.headers.get("Content-Type", "text/plain"))
+    result = apply_list_view(result, view, path)
+    # Pass Todoist's body through untouched, with its status and content type
+    if result.stream is not None:
+        return Response(result.stream, status=result.status, content_type=result.content_type,
+                        headers=result.headers, direct_passthrough=True)
+    return Response(result.content, status=result.status, content_type=result.content_type, headers=result.headers)
 
-    except requests.exceptions.RequestException as e:
-        print(f"Request error connecting to Todoist: {str(e)}")
-        return jsonify({"error": f"Failed to connect to Todoist API: {str(e)}"}), 503 # Service Unavailable
+
+def run_action(endpoint, data):
+    """Validates a manage request for `endpoint` against the compiled spec and proxies the resulting call."""
+    action = str(data.get("action") or "").lower() if isinstance(data, dict) else ""
+    g.metrics_action = action if action in KNOWN_ACTIONS else "other"
+    try:
+        call = build_call(endpoint, data)
+    except ActionError as e:
+        return jsonify({"error": e.message}), e.status
+
+    outbox = get_outbox()
+    if outbox is not None and is_write_behind(call, action):
+        headers = get_todoist_headers()
+        if headers is None:
+            return auth_failure_response()
+        status, body = accept(outbox, g.tenant, endpoint, action, call, request.headers.get("Idempotency-Key"))
+        return jsonify(body), status
+    return proxy(call.method, call.path, params=call.params, json_data=call.json_data, view=call.view)
 
 
 @app.route("/tasks/manage", methods=["POST"])
 def manage_tasks():
     """Manages task operations based on the 'action' field."""
     data = request.get_json(force=True) # Use force=True cautiously
-    action = data.get("action")
-    print(f"Tasks manage request received: {data}")
-
-    if not action:
-        return jsonify({"error": "'action' field is required"}), 400
-
-    action = action.lower()  # Normalize action to lowercase
-
-    # --- List Tasks ---
-    if action == "list":
-        params = {}
-        for key in ("project_id", "label_id", "filter", "lang"):
-            if data.get(key) is not None:
-                params[key] = data[key]
-        return proxy("GET", "/tasks", params=params)
-
-    # --- Get Task ---
-    if action == "get":
-        tid = data.get("task_id")
-        if not tid:
-            return jsonify({"error": "task_id is required for 'get' action"}), 400
-        return proxy("GET", f"/tasks/{tid}")
-
-    # --- Create Task ---
-    if action == "create":
-        payload = {k: data[k] for k in (
-            "content", "project_id", "section_id", "parent_id", "order",
-            "due_string", "due_date", "due_datetime", "due_lang",
-            "priority", "assignee_id", "duration", "duration_unit", "description"  # <-- Added description here
-        ) if k in data}
-
-        if "labels" in data:
-            if isinstance(data["labels"], list) and all(isinstance(item, str) for item in data["labels"]):
-                payload["labels"] = data["labels"]
-            else:
-                return jsonify({"error": "'labels' must be a list of strings"}), 400
-
-        if "content" not in payload or not payload["content"]:
-            return jsonify({"error": "'content' is required to create a task"}), 400
-
-        return proxy("POST", "/tasks", json_data=payload)
-
-    # --- Update Task ---
-    if action == "update":
-        tid = data.get("task_id")
-        if not tid:
-            return jsonify({"error": "task_id is required for 'update' action"}), 400
-
-        payload = {k: data[k] for k in (
-            "content", "due_string", "due_date", "due_datetime", "due_lang",
-            "priority", "assignee_id", "duration", "duration_unit", "description"  # <-- Added description here
-        ) if k in data}
-
-        if "labels" in data:
-            if isinstance(data["labels"], list) and all(isinstance(item, str) for item in data["labels"]):
-                payload["labels"] = data["labels"]
-            else:
-                return jsonify({"error": "'labels' must be a list of strings"}), 400
-
-        if not payload:
-            return jsonify({"error": "At least one field (content, due_*, priority, labels, description, etc.) must be provided for update"}), 400
-
-        return proxy("POST", f"/tasks/{tid}", json_data=payload)
-
-    # --- Delete Task ---
-    if action == "delete":
-        tid = data.get("task_id")
-        if not tid:
-            return jsonify({"error": "task_id is required for 'delete' action"}), 400
-        return proxy("DELETE", f"/tasks/{tid}")
-
-    # --- Move Task ---
-    if action == "move":
-        print("Warning: The 'move' action might not work as expected with Todoist REST API v2. Consider using 'update' with project_id/section_id.")
-        tid = data.get("task_id")
-        if not tid:
-            return jsonify({"error": "task_id is required for 'move' action"}), 400
-
-        move_payload = {}
-        if "project_id" in data:
-            move_payload["project_id"] = data["project_id"]
-        if "section_id" in data:
-            move_payload["section_id"] = data["section_id"]
-
-        if not move_payload:
-            return jsonify({"error": "Either 'project_id' or 'section_id' is required for 'move' action"}), 400
-
-        return proxy("POST", f"/tasks/{tid}", json_data=move_payload)
-
-    # --- Change Task Status (Close/Reopen) ---
-    if action == "status":
-        tid = data.get("task_id")
-        status = data.get("status", "").lower()
-        if not tid:
-            return jsonify({"error": "task_id is required for 'status' action"}), 400
-        if status not in ("closed", "open"):
-            return jsonify({"error": "status ('closed' or 'open') is required for 'status' action"}), 400
-
-        endpoint = "close" if status == "closed" else "reopen"
-        return proxy("POST", f"/tasks/{tid}/{endpoint}")
-
-    # --- Unknown Action ---
-    return jsonify({"error": f"Unknown or unsupported action '{data.get('action')}' for tasks"}), 400
+    log.debug("Tasks manage request received: %s", data)
+    return run_action("tasks", data)
 
 
 # --- Project Management ---
 @app.route("/projects/manage", methods=["POST"])
 def manage_projects():
     data = request.get_json(force=True)
-    action = data.get("action", "").lower()
-    print(f"Projects manage request received: {data}")
-
-    if not action:
-         return jsonify({"error": "'action' field is required"}), 400
-
-    if action == "list":
-        return proxy("GET", "/projects")
-
-    if action == "get":
-        pid = data.get("project_id")
-        if not pid:
-            return jsonify({"error": "project_id is required for 'get' action"}), 400
-        return proxy("GET", f"/projects/{pid}")
-
-    if action == "create":
-        payload = {k: data[k] for k in ("name", "color", "parent_id", "is_favorite", "view_style") if k in data}
-        if "name" not in payload or not payload["name"]:
-             return jsonify({"error": "'name' is required to create a project"}), 400
-        return proxy("POST", "/projects", json_data=payload)
-
-    if action == "update":
-        pid = data.get("project_id")
-        if not pid:
-            return jsonify({"error": "project_id is required for 'update' action"}), 400
-        # Note: is_shared cannot be updated via API after creation
-        payload = {k: data[k] for k in ("name", "color", "is_favorite", "view_style") if k in data}
-        if not payload:
-             return jsonify({"error": "At least one field (name, color, is_favorite, view_style) must be provided for update"}), 400
-        return proxy("POST", f"/projects/{pid}", json_data=payload)
-
-    if action == "delete":
-        pid = data.get("project_id")
-        if not pid:
-            return jsonify({"error": "project_id is required for 'delete' action"}), 400
-        return proxy("DELETE", f"/projects/{pid}")
-
-    # Note: Archive/Unarchive are not distinct actions in REST v2.
-    # It's handled by updating the project (is_archived is read-only).
-    # Shared projects are managed via sharing endpoints, not a simple 'state'.
-    # Removing 'state' action as it doesn't map directly to REST v2 in this way.
-    # if action == "state": ... (Removed)
-
-    if action == "collaborators":
-        pid = data.get("project_id")
-        # Listing collaborators requires a project ID
-        if not pid:
-             return jsonify({"error": "project_id is required for 'collaborators' action"}), 400
-        return proxy("GET", f"/projects/{pid}/collaborators")
-
-    return jsonify({"error": f"Unknown or unsupported action '{data.get('action')}' for projects"}), 400
+    log.debug("Projects manage request received: %s", data)
+    return run_action("projects", data)
 
 
 # --- Section Management ---
 @app.route("/sections/manage", methods=["POST"])
 def manage_sections():
     data = request.get_json(force=True)
-    action = data.get("action", "").lower()
-    print(f"Sections manage request received: {data}")
-
-    if not action:
-         return jsonify({"error": "'action' field is required"}), 400
-
-    if action == "list":
-        params = {}
-        if data.get("project_id"):
-            params["project_id"] = data["project_id"]
-        return proxy("GET", "/sections", params=params) # Can list all sections or by project_id
-
-    if action == "get":
-        sid = data.get("section_id")
-        if not sid:
-            return jsonify({"error": "section_id is required for 'get' action"}), 400
-        return proxy("GET", f"/sections/{sid}")
-
-    if action == "create":
-        payload = {k: data[k] for k in ("project_id", "name", "order") if k in data}
-        if "name" not in payload or not payload["name"]:
-             return jsonify({"error": "'name' is required to create a section"}), 400
-        if "project_id" not in payload or not payload["project_id"]:
-             return jsonify({"error": "'project_id' is required to create a section"}), 400
-        return proxy("POST", "/sections", json_data=payload)
-
-    if action == "update":
-        sid = data.get("section_id")
-        if not sid:
-            return jsonify({"error": "section_id is required for 'update' action"}), 400
-        payload = {k: data[k] for k in ("name", "order") if k in data} # Only name and order are updatable
-        if not payload:
-             return jsonify({"error": "At least one field (name, order) must be provided for update"}), 400
-        if "name" in payload and not payload["name"]:
-             return jsonify({"error": "'name' cannot be empty for update"}), 400
-        return proxy("POST", f"/sections/{sid}", json_data=payload)
-
-    if action == "delete":
-        sid = data.get("section_id")
-        if not sid:
-            return jsonify({"error": "section_id is required for 'delete' action"}), 400
-        return proxy("DELETE", f"/sections/{sid}")
-
-    return jsonify({"error": f"Unknown action '{data.get('action')}' for sections"}), 400
+    log.debug("Sections manage request received: %s", data)
+    return run_action("sections", data)
 
 
 # --- Label Management ---
@@ -311,110 +171,33 @@ def manage_sections():
 def manage_labels():
     # Manages personal labels
     data = request.get_json(force=True)
-    action = data.get("action", "").lower()
-    print(f"Labels manage request received: {data}")
-
-    if not action:
-         return jsonify({"error": "'action' field is required"}), 400
-
-    # --- Personal Label Actions ---
-    if action == "list":
-        return proxy("GET", "/labels") # Gets personal labels
-
-    if action == "get":
-        # Todoist uses string IDs for labels in URLs, but might return numeric IDs in objects. Be consistent.
-        lid = data.get("label_id") # Expect string ID from request as per typical REST patterns
-        if not lid:
-            return jsonify({"error": "label_id (string) is required for 'get' action"}), 400
-        return proxy("GET", f"/labels/{lid}")
-
-    if action == "create":
-        payload = {k: data[k] for k in ("name", "color", "order", "is_favorite") if k in data}
-        if "name" not in payload or not payload["name"]:
-             return jsonify({"error": "'name' is required to create a label"}), 400
-        return proxy("POST", "/labels", json_data=payload)
-
-    if action == "update":
-        lid = data.get("label_id")
-        if not lid:
-            return jsonify({"error": "label_id (string) is required for 'update' action"}), 400
-        payload = {k: data[k] for k in ("name", "color", "order", "is_favorite") if k in data}
-        if not payload:
-             return jsonify({"error": "At least one field (name, color, order, is_favorite) must be provided for update"}), 400
-        return proxy("POST", f"/labels/{lid}", json_data=payload)
-
-    if action == "delete":
-        lid = data.get("label_id")
-        if not lid:
-            return jsonify({"error": "label_id (string) is required for 'delete' action"}), 400
-        return proxy("DELETE", f"/labels/{lid}")
-
-    # --- Shared Label Actions (These are different in REST v2) ---
-    # REST v2 doesn't have these exact endpoints. Shared labels are viewed via GET /labels.
-    # Renaming/removing applies to personal labels only via the update/delete actions above.
-    # Removing shared-specific actions as they don't map directly.
-    # if action == "list_shared": ... (Removed)
-    # if action == "rename_shared": ... (Removed)
-    # if action == "remove_shared": ... (Removed)
-
-    return jsonify({"error": f"Unknown or unsupported action '{data.get('action')}' for labels"}), 400
+    log.debug("Labels manage request received: %s", data)
+    return run_action("labels", data)
 
 
 # --- Comment Management ---
 @app.route("/comments/manage", methods=["POST"])
 def manage_comments():
     data = request.get_json(force=True)
-    action = data.get("action", "").lower()
-    print(f"Comments manage request: {data}")
-
-    if not action:
-         return jsonify({"error": "'action' field is required"}), 400
-
-    if action == "list":
-        params = {}
-        # Must provide either task_id or project_id
-        if data.get("task_id"):
-            params["task_id"] = data["task_id"]
-        elif data.get("project_id"):
-             params["project_id"] = data["project_id"]
-        else:
-            return jsonify({"error": "Either 'task_id' or 'project_id' is required for 'list' action"}), 400
-        return proxy("GET", "/comments", params=params)
-
-    if action == "get":
-        cid = data.get("comment_id")
-        if not cid:
-            return jsonify({"error": "comment_id is required for 'get' action"}), 400
-        return proxy("GET", f"/comments/{cid}")
-
-    if action == "create":
-        payload = {k: data[k] for k in ("content", "task_id", "project_id", "attachment") if k in data}
-        # Attachment needs special handling (file upload), not covered here simply.
-        if "attachment" in payload:
-             print("Warning: Simple JSON proxy cannot handle file attachments for comments.")
-             del payload["attachment"] # Remove attachment if just passing JSON
-        if "content" not in payload or not payload["content"]:
-             return jsonify({"error": "'content' is required to create a comment"}), 400
-        if not ("task_id" in payload or "project_id" in payload):
-            return jsonify({"error": "Either 'task_id' or 'project_id' is required for 'create' action"}), 400
-        return proxy("POST", "/comments", json_data=payload)
-
-    if action == "update":
-        cid = data.get("comment_id")
-        if not cid:
-            return jsonify({"error": "comment_id is required for 'update' action"}), 400
-        content = data.get("content")
-        if not content:
-            return jsonify({"error": "'content' is required for 'update' action"}), 400
-        return proxy("POST", f"/comments/{cid}", json_data={"content": content}) # Only content is updatable
-
-    if action == "delete":
-        cid = data.get("comment_id")
-        if not cid:
-            return jsonify({"error": "comment_id is required for 'delete' action"}), 400
-        return proxy("DELETE", f"/comments/{cid}")
-
-    return jsonify({"error": f"Unknown action '{data.get('action')}' for comments"}), 400
+    log.debug("Comments manage request: %s", data)
+    return run_action("comments", data)
+
+
+# Multipart comment with a file; the file is streamed through to Todoist, see uploads.py.
+@app.route("/comments/attachments", methods=["POST"])
+def upload_comment_attachment():
+    g.metrics_action = "create"
+    headers = get_todoist_headers()
+    if headers is None:
+        return auth_failure_response()
+    try:
+        call = stream_attachment(headers, request.content_type, request.content_length, request.stream.read)
+    except ActionError as e:
+        return jsonify({"error": e.message}), e.status
+    except requests.exceptions.RequestException as e:
+        status, body, extra_headers = upstream_error(e)
+        return jsonify(body), status, extra_headers
+    return proxy(call.method, call.path, json_data=call.json_data)
 
 
 # --- Reminder Management (Not standard in REST v2 like this) ---
@@ -429,38 +212,168 @@ def manage_comments():
 @app.route("/collaborators/manage", methods=["POST"])
 def manage_collaborators():
     data = request.get_json(force=True)
-    action = data.get("action", "").lower()
-    print(f"Collaborators manage request: {data}")
+    log.debug("Collaborators manage request: %s", data)
+    return run_action("collaborators", data)
 
-    if action != "list":
-        return jsonify({"error": "Only 'list' action is supported for collaborators via this endpoint"}), 400
 
-    pid = data.get("project_id")
-    # Listing collaborators requires a project ID in REST v2
-    if not pid:
-         return jsonify({"error": "project_id is required for 'list' collaborators action"}), 400
+# --- Batch ---
+# Runs an ordered list of {endpoint, action, ...} operations in one request.
+@app.route("/batch", methods=["POST"])
+def batch():
+    data = request.get_json(force=True)
+    headers = get_todoist_headers()
+    if headers is None:
+        return auth_failure_response()
+
+    operations = data.get("operations") if isinstance(data, dict) else data
+    mode = str(data.get("mode") or "auto").lower() if isinstance(data, dict) else "auto"
+    log.debug("Batch request received: %s operations, mode %s",
+              len(operations) if isinstance(operations, list) else 0, mode)
+    try:
+        document = run_batch(operations, headers, mode=mode,
+                             max_workers=env_int("BATCH_MAX_WORKERS", 4),
+                             max_operations=env_int("BATCH_MAX_OPERATIONS", 200))
+    except ActionError as e:
+        return jsonify({"error": e.message}), e.status
+    return jsonify(document), 200
+
 
-    return proxy("GET", f"/projects/{pid}/collaborators")
+# --- Composite views ---
+# One request for the several reads behind a GTD screen; see views.py.
+def serve_view(name, object_id=None):
+    headers = get_todoist_headers()
+    if headers is None:
+        return auth_failure_response()
+    try:
+        document = run_view(headers, name, request.args, object_id)
+    except ActionError as e:
+        return jsonify({"error": e.message}), e.status
+    except requests.exceptions.RequestException as e:
+        status, body, extra_headers = upstream_error(e)
+        return jsonify(body), status, extra_headers
+    return jsonify(document), 200
+
+
+@app.route("/views/next-actions", methods=["GET"])
+def next_actions_view():
+    return serve_view("next-actions")
+
+
+@app.route("/views/project/<project_id>", methods=["GET"])
+def project_view(project_id):
+    return serve_view("project", project_id)
+
+
+@app.route("/views/weekly-review", methods=["GET"])
+def weekly_review_view():
+    return serve_view("weekly-review")
+
+
+# --- Export / import ---
+# The whole account as an NDJSON stream, and back; see transfer.py.
+@app.route("/export", methods=["GET"])
+def export_account():
+    headers = get_todoist_headers()
+    if headers is None:
+        return auth_failure_response()
+    comments = request.args.get("comments", "1").lower() not in ("0", "false", "no")
+    try:
+        chunks = open_export(headers, comments=comments)
+    except ActionError as e:
+        return jsonify({"error": e.message}), e.status
+    except requests.exceptions.RequestException as e:
+        status, body, extra_headers = upstream_error(e)
+        return jsonify(body), status, extra_headers
+    return Response(chunks, content_type=NDJSON,
+                    headers={"Content-Disposition": 'attachment; filename="todoist-export.ndjson"'})
+
+
+@app.route("/import", methods=["POST"])
+def import_account():
+    headers = get_todoist_headers()
+    if headers is None:
+        return auth_failure_response()
+    try:
+        progress = open_import(headers, request.stream.read)
+    except ActionError as e:
+        return jsonify({"error": e.message}), e.status
+    except requests.exceptions.RequestException as e:
+        status, body, extra_headers = upstream_error(e)
+        return jsonify(body), status, extra_headers
+    # The body is read as the import goes, so the request has to outlive this function
+    return Response(stream_with_context(progress), content_type=NDJSON)
+
+
+# --- Change feed ---
+# Todoist webhooks feed /changes, which clients poll or stream instead of re-listing; see changes.py.
+@app.route("/webhooks/todoist", methods=["POST"])
+def todoist_webhook():
+    if (request.content_length or 0) > MAX_WEBHOOK_BYTES:
+        return jsonify({"error": "Webhook body too large"}), 413
+    status, body = receive_webhook(request.get_data(cache=False), request.headers.get("X-Todoist-Hmac-SHA256"),
+                                   request.headers.get("X-Todoist-Delivery-ID"))
+    return jsonify(body), status
+
+
+@app.route("/changes", methods=["GET"])
+def changes():
+    headers = get_todoist_headers()
+    if headers is None:
+        return auth_failure_response()
+    streaming = request.args.get("stream") == "sse" or request.accept_mimetypes.best == "text/event-stream"
+    try:
+        since = parse_since(request.args.get("since") or (request.headers.get("Last-Event-ID") if streaming else None))
+        poll_timeout(request.args.get("timeout"))  # validated, though nothing waits here
+    except ValueError:
+        return jsonify({"error": "'since' must be a sequence number and 'timeout' a number of seconds"}), 400
+    # Waiting would hold this worker for the whole wait; only the ASGI mode waits (see changes.py)
+    if streaming:
+        return jsonify({"error": "Event streams are only served in the ASGI mode (SERVER_MODE=asgi)"}), 501
+    return Response(snapshot(get_feed(), headers["Authorization"], since), content_type="application/json")
+
+
+# --- Write-behind status ---
+# Queued writes (WRITE_BEHIND_ENABLED=1) are answered with 202 and tracked here by idempotency key.
+@app.route("/writes/<key>", methods=["GET"])
+def write_status(key):
+    headers = get_todoist_headers()
+    if headers is None:
+        return auth_failure_response()
+    outbox = get_outbox()
+    operation = outbox.lookup(g.tenant.name, key) if outbox is not None else None
+    if operation is None:
+        return jsonify({"error": "No queued write with this idempotency key"}), 404
+    return jsonify(operation), 200
+
+
+@app.route("/writes", methods=["GET"])
+def write_summary():
+    headers = get_todoist_headers()
+    if headers is None:
+        return auth_failure_response()
+    outbox = get_outbox()
+    if outbox is None:
+        return jsonify({"enabled": False}), 200
+    state = request.args.get("state")
+    if state not in (None, "pending", "applied", "failed"):
+        return jsonify({"error": "state must be one of: pending, applied, failed"}), 400
+    limit = request.args.get("limit", 50, type=int)
+    return jsonify(dict(outbox.summary(g.tenant.name, state=state, limit=max(1, min(limit, 200))),
+                        enabled=True)), 200
 
 
 # --- Debug Endpoint (Example) ---
 @app.route("/debug/labels", methods=["GET"])
 def debug_labels():
     """Endpoint to fetch all personal labels for debugging."""
-    print("Debug: Received request for /debug/labels")
+    log.debug("Debug: Received request for /debug/labels")
     headers = get_todoist_headers()
     if headers is None:
-         # Check if the error is client-side authentication or server-side config
-        if not request.headers.get("X-API-KEY") or request.headers.get("X-API-KEY") != os.getenv("API_KEY"):
-             return jsonify({"error": "Authentication failed: Invalid or missing X-API-KEY header"}), 401
-        else:
-             return jsonify({"error": "Internal server error: Service configuration issue"}), 500
-
-    url = f"{TODOIST_API_BASE}/labels"
-    print(f"Debug: Sending GET request to {url}")
+        return auth_failure_response()
+
     try:
-        resp = requests.get(url, headers=headers)
-        print(f"Debug labels Todoist response: Status {resp.status_code}, Body: {resp.text[:200]}...")
+        resp = get_client().request("GET", "/labels", headers=headers)
+        log.debug("Debug labels Todoist response: Status %s", resp.status_code)
         status_code = resp.status_code
         try:
              body = resp.json()
@@ -472,12 +385,43 @@ def debug_labels():
             "response_body": body
         }), 200 # Always return 200 from this debug endpoint itself, showing the result
     except requests.exceptions.RequestException as e:
-        print(f"Debug labels error: {str(e)}")
+        log.warning("Debug labels error: %s", e)
         return jsonify({"error": f"Debug request failed: {str(e)}"}), 500
 
 
+@app.route("/debug/upstream", methods=["GET"])
+def debug_upstream():
+    """Reports connection pool reuse for this worker's Todoist client."""
+    if get_todoist_headers() is None:
+        return auth_failure_response()
+    return jsonify({"pid": os.getpid(), "tenants": len(get_registry().tenants),
+                    "upstream": get_client().stats()}), 200
+
+
+@app.route("/debug/cache", methods=["GET"])
+def debug_cache():
+    """Reports response cache and last-good-response store hit/miss/eviction counts for this worker."""
+    if get_todoist_headers() is None:
+        return auth_failure_response()
+    return jsonify({"pid": os.getpid(), "cache": get_cache().stats(), "stale": get_stale_store().stats()}), 200
+
+
+@app.route("/debug/mirror", methods=["GET"])
+def debug_mirror():
+    """Reports the local mirror's sync age and row counts for this worker."""
+    if get_todoist_headers() is None:
+        return auth_failure_response()
+    mirror = get_mirror()
+    return jsonify({"pid": os.getpid(), "mirror": mirror.stats() if mirror else {"enabled": False}}), 200
+
+
 if __name__ == "__main__":
     # Set default port to 10000, suitable for Render deployment
     port = int(os.environ.get("PORT", 10000))
-    # Run on 0.0.0.0 to be accessible externally
-    app.run(host="0.0.0.0", port=port)
\ No newline at end of file
+    # SERVER_MODE=asgi serves the manage endpoints from an event loop instead (see asgi.py)
+    if os.getenv("SERVER_MODE", "wsgi").lower() == "asgi":
+        import uvicorn
+        uvicorn.run("asgi:app", host="0.0.0.0", port=port)
+    else:
+        # Run on 0.0.0.0 to be accessible externally
+        app.run(host="0.0.0.0", port=port)
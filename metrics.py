@@ -0,0 +1,226 @@
+"""Prometheus metrics, rendered in the text exposition format on /metrics.
+
+Metrics live in this worker process; under gunicorn each scrape reports the
+worker that served it, so aggregate with sum()/rate() across scrapes as
+usual. Subsystems with their own counters (cache, connection pool, mirror)
+register collectors that are read at scrape time instead of on every call.
+"""
+import bisect
+import threading
+import time
+
+# Seconds; spans cache hits (sub-millisecond) through slow Todoist calls
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield self.name, tuple(zip(self.labelnames, key)), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self._lock:
+            items = [(key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items()]
+        for key, (counts, total, count) in items:
+            labels = tuple(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", labels + (("le", _format_value(float(bound))),), cumulative
+            yield f"{self.name}_bucket", labels + (("le", "+Inf"),), count
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, count
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """`collector()` returns [(name, kind, help, [(labels dict, value), ...]), ...] at scrape time."""
+        self._collectors.append(collector)
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            try:
+                families = collector()
+            except Exception:  # a broken collector must not take /metrics down with it
+                continue
+            for name, kind, documentation, samples in families:
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    if value is not None:
+                        lines.append(f"{name}{_format_labels(sorted(labels.items()))} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# --- Inbound requests ---
+REQUESTS = REGISTRY.counter(
+    "gtd_requests_total", "Requests handled, by endpoint, action and response status.",
+    ("endpoint", "action", "status"))
+REQUEST_LATENCY = REGISTRY.histogram(
+    "gtd_request_duration_seconds",
+    "Time to produce and send a response, streamed bodies included, by endpoint and action.",
+    ("endpoint", "action"))
+REQUESTS_IN_FLIGHT = REGISTRY.gauge(
+    "gtd_requests_in_flight", "Requests currently being handled.", ("endpoint",))
+REQUEST_BYTES = REGISTRY.counter(
+    "gtd_request_bytes_total", "Request body bytes received.", ("endpoint",))
+RESPONSE_BYTES = REGISTRY.counter(
+    "gtd_response_bytes_total", "Response body bytes sent.", ("endpoint",))
+
+# --- Upstream Todoist calls ---
+UPSTREAM_REQUESTS = REGISTRY.counter(
+    "gtd_upstream_requests_total", "Calls to Todoist, by method, route and status (or error class).",
+    ("method", "route", "status"))
+UPSTREAM_LATENCY = REGISTRY.histogram(
+    "gtd_upstream_duration_seconds", "Time until Todoist's response headers arrived, retries included.",
+    ("method", "route"))
+UPSTREAM_IN_FLIGHT = REGISTRY.gauge(
+    "gtd_upstream_in_flight", "Calls to Todoist currently waiting on a response.")
+
+
+def upstream_route(path):
+    """Collapses ids out of a Todoist path so it is safe to use as a label: /tasks/123/close -> /tasks/{id}/close."""
+    parts = path.strip("/").split("/")
+    if len(parts) > 1:
+        parts[1] = "{id}"
+    return "/" + "/".join(parts)
+
+
+class count_bytes:
+    """Wraps a streamed response body so its size, and the request's latency, are recorded once it has been sent.
+
+    The server closes this wrapper itself, even for a direct_passthrough
+    response, whose Response.call_on_close callbacks never run.
+    """
+
+    def __init__(self, chunks, endpoint, action="", started=None):
+        self.chunks = chunks
+        self.endpoint = endpoint
+        self.action = action
+        self.started = started
+        self.sent = 0
+        self._closed = False
+
+    def __iter__(self):
+        try:
+            for chunk in self.chunks:
+                self.sent += len(chunk)
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        RESPONSE_BYTES.inc(self.sent, endpoint=self.endpoint)
+        if self.started is not None:
+            REQUEST_LATENCY.observe(time.perf_counter() - self.started, endpoint=self.endpoint, action=self.action)
+        close = getattr(self.chunks, "close", None)
+        if close is not None:
+            close()
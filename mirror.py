@@ -0,0 +1,517 @@
+"""Optional local mirror of the Todoist account, kept current via the Sync API.
+
+A background thread pulls incremental changes with Todoist's sync_token
+protocol into SQLite (in memory by default) and proxy() answers GETs it
+can serve from there instead of going upstream. Rows are stored already
+shaped like REST v2 objects so reads are a single indexed query.
+
+Writes still go to Todoist through proxy(); the object Todoist returns is
+applied to the mirror straight away, and anything with side effects we
+can't reproduce locally (label renames, completing recurring tasks) also
+wakes the sync thread early.
+
+Tunables (environment variables):
+    MIRROR_ENABLED         set to 1 to turn the mirror on (off)
+    MIRROR_DB_PATH         SQLite file, shared by workers if set (:memory:)
+    MIRROR_SYNC_INTERVAL   seconds between incremental syncs (15)
+    MIRROR_MAX_STALENESS   stop answering locally past this age in seconds (120)
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import REGISTRY
+from ratelimit import BACKGROUND
+from upstream import env_float, get_client, sync_api_base
+log = logging.getLogger(__name__)
+
+SYNC_RESOURCE_TYPES = ["projects", "sections", "labels", "items", "notes", "project_notes"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS projects (id TEXT PRIMARY KEY, parent_id TEXT, ord INTEGER, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS sections (id TEXT PRIMARY KEY, project_id TEXT, ord INTEGER, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS labels (id TEXT PRIMARY KEY, name TEXT, ord INTEGER, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS tasks (
+    id TEXT PRIMARY KEY, project_id TEXT, section_id TEXT, parent_id TEXT,
+    due_date TEXT, is_completed INTEGER NOT NULL DEFAULT 0, ord INTEGER, data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS task_labels (task_id TEXT NOT NULL, label TEXT NOT NULL, PRIMARY KEY (task_id, label));
+CREATE TABLE IF NOT EXISTS comments (id TEXT PRIMARY KEY, task_id TEXT, project_id TEXT, posted_at TEXT, data TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS idx_projects_parent ON projects (parent_id);
+CREATE INDEX IF NOT EXISTS idx_sections_project ON sections (project_id, ord);
+CREATE INDEX IF NOT EXISTS idx_tasks_project ON tasks (project_id, is_completed, ord);
+CREATE INDEX IF NOT EXISTS idx_tasks_section ON tasks (section_id, is_completed, ord);
+CREATE INDEX IF NOT EXISTS idx_tasks_parent ON tasks (parent_id);
+CREATE INDEX IF NOT EXISTS idx_tasks_due ON tasks (due_date);
+CREATE INDEX IF NOT EXISTS idx_task_labels_label ON task_labels (label);
+CREATE INDEX IF NOT EXISTS idx_comments_task ON comments (task_id, posted_at);
+CREATE INDEX IF NOT EXISTS idx_comments_project ON comments (project_id, posted_at);
+"""
+
+
+# --- Sync API -> REST v2 shape ---
+
+def _rest_due(due):
+    if not due:
+        return None
+    when = due.get("date") or ""
+    rest = {"string": due.get("string"), "date": when[:10], "is_recurring": due.get("is_recurring", False)}
+    if "T" in when:
+        rest["datetime"] = when
+    if due.get("timezone"):
+        rest["timezone"] = due["timezone"]
+    if due.get("lang"):
+        rest["lang"] = due["lang"]
+    return rest
+
+
+def task_from_sync(item):
+    return {
+        "id": item["id"],
+        "project_id": item.get("project_id"),
+        "section_id": item.get("section_id"),
+        "parent_id": item.get("parent_id"),
+        "content": item.get("content", ""),
+        "description": item.get("description", ""),
+        "is_completed": bool(item.get("checked")),
+        "labels": item.get("labels", []),
+        "order": item.get("child_order", 0),
+        "priority": item.get("priority", 1),
+        "due": _rest_due(item.get("due")),
+        "duration": item.get("duration"),
+        "url": f"https://app.todoist.com/app/task/{item['id']}",
+        "comment_count": 0,
+        "created_at": item.get("added_at"),
+        "creator_id": item.get("added_by_uid"),
+        "assignee_id": item.get("responsible_uid"),
+        "assigner_id": item.get("assigned_by_uid"),
+    }
+
+
+def project_from_sync(project):
+    return {
+        "id": project["id"],
+        "name": project.get("name", ""),
+        "color": project.get("color"),
+        "parent_id": project.get("parent_id"),
+        "order": project.get("child_order", 0),
+        "comment_count": 0,
+        "is_shared": bool(project.get("shared")),
+        "is_favorite": bool(project.get("is_favorite")),
+        "is_inbox_project": bool(project.get("inbox_project")),
+        "is_team_inbox": bool(project.get("team_inbox")),
+        "view_style": project.get("view_style", "list"),
+        "url": f"https://app.todoist.com/app/project/{project['id']}",
+    }
+
+
+def section_from_sync(section):
+    return {
+        "id": section["id"],
+        "project_id": section.get("project_id"),
+        "order": section.get("section_order", 0),
+        "name": section.get("name", ""),
+    }
+
+
+def label_from_sync(label):
+    return {
+        "id": label["id"],
+        "name": label.get("name", ""),
+        "color": label.get("color"),
+        "order": label.get("item_order", 0),
+        "is_favorite": bool(label.get("is_favorite")),
+    }
+
+
+def comment_from_sync(note):
+    return {
+        "id": note["id"],
+        "task_id": note.get("item_id"),
+        "project_id": note.get("project_id") if not note.get("item_id") else None,
+        "posted_at": note.get("posted_at"),
+        "content": note.get("content", ""),
+        "attachment": note.get("file_attachment"),
+    }
+
+
+def _is_gone(obj):
+    return bool(obj.get("is_deleted") or obj.get("is_archived"))
+
+
+class Mirror:
+    """SQLite copy of one Todoist account's projects, sections, labels, tasks and comments."""
+
+    def __init__(self, token, db_path=":memory:", sync_interval=15.0, max_staleness=120.0, sync_base=None):
+        self.token = token
+        self.authorization = f"Bearer {token}"
+        self.sync_interval = sync_interval
+        self.max_staleness = max_staleness
+        self.sync_base = sync_base or sync_api_base()
+        self.last_sync = None  # wall clock time of the last successful sync
+        self.last_error = None
+        self.syncs = 0
+        self._lock = threading.RLock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+
+    @classmethod
+    def from_env(cls, token):
+        return cls(
+            token,
+            db_path=os.getenv("MIRROR_DB_PATH", ":memory:"),
+            sync_interval=env_float("MIRROR_SYNC_INTERVAL", 15.0),
+            max_staleness=env_float("MIRROR_MAX_STALENESS", 120.0),
+        )
+
+    # --- Background sync ---
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="todoist-mirror", daemon=True)
+            self._thread.start()
+
+    def request_sync(self):
+        """Wakes the sync thread now instead of at the next interval."""
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            try:
+                self.sync_once()
+            except Exception as e:  # keep the thread alive through any upstream hiccup
+                self.last_error = str(e)
+                log.warning("Mirror sync failed: %s", e)
+            self._wake.wait(self.sync_interval)
+            self._wake.clear()
+
+    def sync_once(self):
+        """Pulls changes since the stored sync_token and applies them in one transaction."""
+        with self._lock:
+            token = self._meta("sync_token") or "*"
+        resp = get_client().request(
+            "POST", "/sync", base_url=self.sync_base,
+            headers={"Authorization": self.authorization},
+            data={"sync_token": token, "resource_types": json.dumps(SYNC_RESOURCE_TYPES)},
+            priority=BACKGROUND,
+        )
+        resp.raise_for_status()
+        payload = resp.json()
+        with self._transaction():
+            # Another worker sharing the file may have synced meanwhile; its data wins.
+            if (self._meta("sync_token") or "*") != token:
+                self.last_sync = time.time()
+                return False
+            self._apply_sync(payload)
+            self._set_meta("sync_token", payload["sync_token"])
+        self.last_sync = time.time()
+        self.last_error = None
+        self.syncs += 1
+        return True
+
+    def _apply_sync(self, payload):
+        if payload.get("full_sync"):
+            for table in ("projects", "sections", "labels", "tasks", "task_labels", "comments"):
+                self._db.execute(f"DELETE FROM {table}")
+        for project in payload.get("projects", []):
+            if _is_gone(project):
+                self._delete_project(project["id"])
+            else:
+                self._put_project(project_from_sync(project))
+        for section in payload.get("sections", []):
+            if _is_gone(section):
+                self._delete_section(section["id"])
+            else:
+                self._put_section(section_from_sync(section))
+        for label in payload.get("labels", []):
+            if label.get("is_deleted"):
+                self._db.execute("DELETE FROM labels WHERE id = ?", (label["id"],))
+            else:
+                self._put_label(label_from_sync(label))
+        touched_tasks, touched_projects = set(), set()
+        for item in payload.get("items", []):
+            if item.get("is_deleted"):
+                self._delete_task(item["id"])
+            else:
+                self._put_task(task_from_sync(item))
+                touched_tasks.add(item["id"])
+        for note in payload.get("notes", []) + payload.get("project_notes", []):
+            comment = comment_from_sync(note)
+            if note.get("is_deleted"):
+                self._db.execute("DELETE FROM comments WHERE id = ?", (comment["id"],))
+            else:
+                self._put_comment(comment)
+            if comment["task_id"]:
+                touched_tasks.add(comment["task_id"])
+            elif comment["project_id"]:
+                touched_projects.add(comment["project_id"])
+        if payload.get("full_sync"):
+            touched_tasks = None
+            touched_projects = None
+        self._refresh_comment_counts("tasks", "task_id", touched_tasks)
+        self._refresh_comment_counts("projects", "project_id", touched_projects)
+
+    # --- Row writers (caller holds the lock) ---
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def _put_project(self, p):
+        self._db.execute("INSERT OR REPLACE INTO projects VALUES (?, ?, ?, ?)",
+                         (p["id"], p.get("parent_id"), p.get("order"), json.dumps(p)))
+
+    def _put_section(self, s):
+        self._db.execute("INSERT OR REPLACE INTO sections VALUES (?, ?, ?, ?)",
+                         (s["id"], s.get("project_id"), s.get("order"), json.dumps(s)))
+
+    def _put_label(self, lbl):
+        self._db.execute("INSERT OR REPLACE INTO labels VALUES (?, ?, ?, ?)",
+                         (lbl["id"], lbl.get("name"), lbl.get("order"), json.dumps(lbl)))
+
+    def _put_task(self, t):
+        due = t.get("due") or {}
+        self._db.execute("INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         (t["id"], t.get("project_id"), t.get("section_id"), t.get("parent_id"),
+                          due.get("date"), int(bool(t.get("is_completed"))), t.get("order"), json.dumps(t)))
+        self._db.execute("DELETE FROM task_labels WHERE task_id = ?", (t["id"],))
+        self._db.executemany("INSERT OR IGNORE INTO task_labels VALUES (?, ?)",
+                             [(t["id"], name) for name in t.get("labels") or []])
+
+    def _put_comment(self, c):
+        self._db.execute("INSERT OR REPLACE INTO comments VALUES (?, ?, ?, ?, ?)",
+                         (c["id"], c.get("task_id"), c.get("project_id"), c.get("posted_at"), json.dumps(c)))
+
+    def _delete_task(self, task_id):
+        # Deleting a task deletes its subtasks and comments as well
+        ids = [row[0] for row in self._db.execute(
+            "WITH RECURSIVE sub(id) AS (SELECT ? UNION SELECT t.id FROM tasks t JOIN sub ON t.parent_id = sub.id) "
+            "SELECT id FROM sub", (task_id,))]
+        marks = ",".join("?" * len(ids))
+        self._db.execute(f"DELETE FROM tasks WHERE id IN ({marks})", ids)
+        self._db.execute(f"DELETE FROM task_labels WHERE task_id IN ({marks})", ids)
+        self._db.execute(f"DELETE FROM comments WHERE task_id IN ({marks})", ids)
+
+    def _delete_section(self, section_id):
+        for (task_id,) in self._db.execute("SELECT id FROM tasks WHERE section_id = ?", (section_id,)).fetchall():
+            self._delete_task(task_id)
+        self._db.execute("DELETE FROM sections WHERE id = ?", (section_id,))
+
+    def _delete_project(self, project_id):
+        for (child_id,) in self._db.execute("SELECT id FROM projects WHERE parent_id = ?", (project_id,)).fetchall():
+            self._delete_project(child_id)
+        for (task_id,) in self._db.execute("SELECT id FROM tasks WHERE project_id = ?", (project_id,)).fetchall():
+            self._delete_task(task_id)
+        self._db.execute("DELETE FROM sections WHERE project_id = ?", (project_id,))
+        self._db.execute("DELETE FROM comments WHERE project_id = ?", (project_id,))
+        self._db.execute("DELETE FROM projects WHERE id = ?", (project_id,))
+
+    def _refresh_comment_counts(self, table, column, ids):
+        """Rewrites comment_count on the given rows (all rows when ids is None)."""
+        if ids is not None and not ids:
+            return
+        query = f"SELECT id, data, (SELECT COUNT(*) FROM comments c WHERE c.{column} = t.id) FROM {table} t"
+        args = ()
+        if ids is not None:
+            query += f" WHERE id IN ({','.join('?' * len(ids))})"
+            args = tuple(ids)
+        updates = []
+        for row_id, data, count in self._db.execute(query, args).fetchall():
+            obj = json.loads(data)
+            if obj.get("comment_count") != count:
+                obj["comment_count"] = count
+                updates.append((json.dumps(obj), row_id))
+        self._db.executemany(f"UPDATE {table} SET data = ? WHERE id = ?", updates)
+
+    def _refresh_parent_comment_count(self, task_id, project_id):
+        if task_id:
+            self._refresh_comment_counts("tasks", "task_id", {task_id})
+        elif project_id:
+            self._refresh_comment_counts("projects", "project_id", {project_id})
+
+    def _meta(self, key):
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key, value):
+        self._db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+    # --- Reads ---
+
+    def age(self):
+        """Seconds since the last successful sync, or None before the first one."""
+        return None if self.last_sync is None else time.time() - self.last_sync
+
+    def is_fresh(self):
+        age = self.age()
+        return age is not None and age <= self.max_staleness
+
+    def answer(self, path, params=None):
+        """Returns a REST v2 JSON body for `GET path` as a string, or None if the mirror can't answer it."""
+        if not self.is_fresh():
+            return None
+        params = {k: v for k, v in (params or {}).items() if v is not None}
+        parts = path.strip("/").split("/")
+        resource = parts[0]
+        with self._lock:
+            if len(parts) == 2:
+                return self._get_one(resource, parts[1])
+            if len(parts) != 1:
+                return None
+            if resource == "tasks":
+                return self._list_tasks(params)
+            if resource == "projects" and not params:
+                return self._list("SELECT data FROM projects ORDER BY ord, id")
+            if resource == "sections" and set(params) <= {"project_id"}:
+                if "project_id" in params:
+                    return self._list("SELECT data FROM sections WHERE project_id = ? ORDER BY ord, id",
+                                      (str(params["project_id"]),))
+                return self._list("SELECT data FROM sections ORDER BY project_id, ord, id")
+            if resource == "labels" and not params:
+                return self._list("SELECT data FROM labels ORDER BY ord, id")
+            if resource == "comments" and len(params) == 1:
+                column = "task_id" if "task_id" in params else "project_id" if "project_id" in params else None
+                if column:
+                    return self._list(f"SELECT data FROM comments WHERE {column} = ? ORDER BY posted_at, id",
+                                      (str(params[column]),))
+        return None
+
+    def _get_one(self, resource, obj_id):
+        if resource not in ("tasks", "projects", "sections", "labels", "comments"):
+            return None
+        row = self._db.execute(f"SELECT data FROM {resource} WHERE id = ?", (obj_id,)).fetchone()
+        return row[0] if row else None
+
+    def _list_tasks(self, params):
+        # Todoist filter queries (and lang) can't be evaluated locally; those go upstream
+        if not set(params) <= {"project_id", "section_id", "label_id", "parent_id"}:
+            return None
+        where, args = ["t.is_completed = 0"], []
+        for key in ("project_id", "section_id", "parent_id"):
+            if key in params:
+                where.append(f"t.{key} = ?")
+                args.append(str(params[key]))
+        if "label_id" in params:
+            label = self._db.execute("SELECT name FROM labels WHERE id = ?", (str(params["label_id"]),)).fetchone()
+            if label is None:
+                return None
+            where.append("t.id IN (SELECT task_id FROM task_labels WHERE label = ?)")
+            args.append(label[0])
+        return self._list(f"SELECT t.data FROM tasks t WHERE {' AND '.join(where)} ORDER BY t.project_id, t.ord, t.id",
+                          args)
+
+    def _list(self, query, args=()):
+        return "[" + ",".join(row[0] for row in self._db.execute(query, args)) + "]"
+
+    # --- Writes made through proxy() ---
+
+    def apply_write(self, method, path, body):
+        """Applies a successful REST write (and Todoist's returned object, if any) to the mirror."""
+        parts = path.strip("/").split("/")
+        resource, obj_id = parts[0], parts[1] if len(parts) > 1 else None
+        needs_sync = False
+        with self._transaction():
+            if method == "DELETE" and obj_id:
+                if resource == "tasks":
+                    self._delete_task(obj_id)
+                elif resource == "projects":
+                    self._delete_project(obj_id)
+                elif resource == "sections":
+                    self._delete_section(obj_id)
+                elif resource == "comments":
+                    row = self._db.execute("SELECT task_id, project_id FROM comments WHERE id = ?",
+                                           (obj_id,)).fetchone()
+                    self._db.execute("DELETE FROM comments WHERE id = ?", (obj_id,))
+                    if row is not None:
+                        self._refresh_parent_comment_count(*row)
+                elif resource == "labels":
+                    self._db.execute("DELETE FROM labels WHERE id = ?", (obj_id,))
+                    needs_sync = True  # label names on tasks
+            elif resource == "tasks" and len(parts) == 3 and parts[2] in ("close", "reopen"):
+                row = self._db.execute("SELECT data FROM tasks WHERE id = ?", (obj_id,)).fetchone()
+                if row is not None:
+                    task = json.loads(row[0])
+                    task["is_completed"] = parts[2] == "close"
+                    self._put_task(task)
+                needs_sync = True  # closing recurring tasks moves the due date instead
+            elif isinstance(body, dict) and body.get("id"):
+                if resource == "tasks":
+                    self._put_task(body)
+                elif resource == "projects":
+                    self._put_project(body)
+                elif resource == "sections":
+                    self._put_section(body)
+                elif resource == "labels":
+                    self._put_label(body)
+                    needs_sync = obj_id is not None  # a rename rewrites label names on tasks
+                elif resource == "comments":
+                    self._put_comment(body)
+                    self._refresh_parent_comment_count(body.get("task_id"), body.get("project_id"))
+            else:
+                needs_sync = True
+        if needs_sync:
+            self.request_sync()
+
+    def stats(self):
+        with self._lock:
+            counts = {table: self._db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                      for table in ("projects", "sections", "labels", "tasks", "comments")}
+        age = self.age()
+        return {
+            "enabled": True,
+            "fresh": self.is_fresh(),
+            "age_seconds": None if age is None else round(age, 3),
+            "syncs": self.syncs,
+            "last_error": self.last_error,
+            "counts": counts,
+        }
+
+
+_mirror = None
+_mirror_pid = None
+_mirror_lock = threading.Lock()
+
+
+def _mirror_collector():
+    if _mirror is None or _mirror_pid != os.getpid():
+        return []
+    return [
+        ("gtd_mirror_age_seconds", "gauge", "Seconds since the mirror last synced.", [({}, _mirror.age())]),
+        ("gtd_mirror_syncs_total", "counter", "Successful mirror syncs.", [({}, _mirror.syncs)]),
+    ]
+
+
+REGISTRY.add_collector(_mirror_collector)
+
+
+def get_mirror():
+    """Returns this process's mirror (starting its sync thread), or None when MIRROR_ENABLED is off."""
+    global _mirror, _mirror_pid
+    if os.getenv("MIRROR_ENABLED", "0").lower() not in ("1", "true", "yes"):
+        return None
+    token = os.getenv("TODOIST_API_TOKEN")
+    if not token:
+        return None
+    pid = os.getpid()
+    if _mirror is None or _mirror_pid != pid:
+        with _mirror_lock:
+            if _mirror is None or _mirror_pid != pid:
+                _mirror = Mirror.from_env(token)
+                _mirror_pid = pid
+                _mirror.start()
+    return _mirror
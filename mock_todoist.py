@@ -0,0 +1,297 @@
+"""A local stand-in for the Todoist REST v2 endpoints proxy() calls, for benchmarks and manual testing.
+
+    python mock_todoist.py --port 18080 --latency-ms 40 --error-rate 0.01
+    TODOIST_API_BASE=http://127.0.0.1:18080/rest/v2 python main.py
+
+It serves tasks, projects, sections, labels and comments (list, get,
+create, update, close/reopen, delete) and project collaborators from a
+generated account whose size is set by --tasks, --projects and
+--description-bytes. Writes are answered as Todoist would but not kept,
+so list payloads stay the same size for a whole run.
+
+The Sync API's uploads/add (TODOIST_SYNC_API_BASE=.../sync/v9) takes a
+multipart file and its file_name, as Todoist requires, and answers with
+the attachment object a comment is created with.
+
+Every call waits --latency-ms (plus up to --jitter-ms); --error-rate of
+them fail with a 500 and --rate-limit-rate with a 429 and a Retry-After
+of --retry-after seconds. GET /__stats returns the calls received per
+method and route, and POST /__reset zeroes them.
+"""
+import argparse
+import email.parser
+import email.policy
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+API_PREFIX = "/rest/v2"
+UPLOAD_PATH = "/sync/v9/uploads/add"
+RESOURCES = ("tasks", "projects", "sections", "labels", "comments")
+ID_SEGMENT = re.compile(r"^\d+$")
+
+
+class Settings:
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, rate_limit_rate=0.0, retry_after=1,
+                 tasks=200, projects=10, description_bytes=100, seed=0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.tasks = tasks
+        self.projects = projects
+        self.description_bytes = description_bytes
+        self.seed = seed
+
+
+def build_account(settings):
+    """Generates {resource: [objects]} shaped like Todoist REST v2 responses."""
+    rng = random.Random(settings.seed)
+    ids = itertools.count(6000000000)
+    projects = [{"id": str(next(ids)), "name": "Inbox" if i == 0 else f"Project {i}", "color": "charcoal",
+                 "order": i, "comment_count": 0, "is_shared": False, "is_favorite": False,
+                 "is_inbox_project": i == 0, "is_team_inbox": False, "view_style": "list", "parent_id": None,
+                 "url": "https://todoist.com/showProject?id=0"} for i in range(max(settings.projects, 1))]
+    sections = [{"id": str(next(ids)), "project_id": project["id"], "order": i, "name": f"Section {i}"}
+                for project in projects[1:] for i in range(2)]
+    labels = [{"id": str(next(ids)), "name": f"context-{i}", "color": "charcoal", "order": i,
+               "is_favorite": False} for i in range(8)]
+    tasks, comments = [], []
+    for i in range(settings.tasks):
+        project = projects[i % len(projects)]
+        task_sections = [s for s in sections if s["project_id"] == project["id"]]
+        task = {
+            "id": str(next(ids)), "project_id": project["id"], "content": f"Task {i}",
+            "description": "d" * settings.description_bytes, "is_completed": False,
+            "labels": [labels[i % len(labels)]["name"]], "order": i, "priority": 1 + i % 4,
+            "section_id": task_sections[i % len(task_sections)]["id"] if task_sections and i % 3 else None,
+            "parent_id": tasks[-1]["id"] if i % 7 == 6 else None, "comment_count": 0,
+            "creator_id": "2671355", "created_at": "2026-01-01T00:00:00.000000Z", "assignee_id": None,
+            "assigner_id": None, "url": "https://todoist.com/showTask?id=0", "duration": None,
+            "due": {"date": f"2026-10-{1 + rng.randrange(28):02d}", "string": "soon", "lang": "en",
+                    "is_recurring": False} if i % 2 else None,
+        }
+        if i % 5 == 0:
+            comment = {"id": str(next(ids)), "task_id": task["id"], "project_id": None,
+                       "posted_at": "2026-01-02T00:00:00.000000Z", "content": f"Comment on task {i}",
+                       "attachment": None}
+            comments.append(comment)
+            task["comment_count"] = 1
+        tasks.append(task)
+    return {"tasks": tasks, "projects": projects, "sections": sections, "labels": labels, "comments": comments}
+
+
+class MockTodoist(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, address, settings):
+        super().__init__(address, _Handler)
+        self.settings = settings
+        self.account = build_account(settings)
+        self.by_id = {(resource, obj["id"]): obj for resource, objects in self.account.items() for obj in objects}
+        self.ids = itertools.count(7000000000)
+        self.calls = {}
+        self._lock = threading.Lock()
+        self._lists = {}  # (resource, filters) -> encoded body, built on first use
+        self._rng = random.Random(settings.seed)
+
+    @property
+    def base_url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}{API_PREFIX}"
+
+    @property
+    def sync_url(self):
+        return self.base_url[:-len(API_PREFIX)] + "/sync/v9"
+
+    def count(self, key):
+        with self._lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            return {"total": sum(self.calls.values()), "calls": dict(sorted(self.calls.items()))}
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+
+    def fault(self):
+        """Sleeps for the configured latency; returns the status of an injected failure, or None."""
+        settings = self.settings
+        with self._lock:
+            roll, jitter = self._rng.random(), self._rng.random()
+        delay = settings.latency_ms + jitter * settings.jitter_ms
+        if delay > 0:
+            time.sleep(delay / 1000)
+        if roll < settings.rate_limit_rate:
+            return 429
+        if roll < settings.rate_limit_rate + settings.error_rate:
+            return 500
+        return None
+
+    def listing(self, resource, params):
+        filters = tuple(sorted((k, v) for k, v in params.items() if k in ("project_id", "task_id")))
+        key = (resource, filters)
+        body = self._lists.get(key)
+        if body is None:
+            objects = [obj for obj in self.account[resource] if all(obj.get(k) == v for k, v in filters)]
+            body = self._lists[key] = json.dumps(objects).encode()
+        return body
+
+    def start_in_thread(self):
+        threading.Thread(target=self.serve_forever, kwargs={"poll_interval": 0.05}, name="mock-todoist",
+                         daemon=True).start()
+        return self
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "MockTodoist/1"
+    disable_nagle_algorithm = True  # headers and body go out in separate writes
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=b"", headers=()):
+        self.send_response(status)
+        if body:
+            self.send_header("Content-Type", "application/json")
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self):
+        url = urlsplit(self.path)
+        parts = url.path[len(API_PREFIX):].strip("/").split("/") if url.path.startswith(API_PREFIX) else []
+        template = "/" + "/".join("{id}" if ID_SEGMENT.match(part) else part for part in parts)
+        return parts, dict(parse_qsl(url.query)), template
+
+    def _raw_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() != "chunked":
+            length = int(self.headers.get("Content-Length") or 0)
+            return self.rfile.read(length) if length else b""
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(b";")[0], 16)
+            if not size:
+                self.rfile.readline()
+                return b"".join(chunks)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+
+    def _body(self):
+        raw = self._raw_body()
+        try:
+            return json.loads(raw) if raw else {}
+        except ValueError:
+            return {}
+
+    def _upload(self):
+        """Sync API uploads/add: a multipart form with the file and its file_name."""
+        head = f"Content-Type: {self.headers.get('Content-Type', '')}\r\n\r\n".encode("latin-1")
+        form = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(head + self._raw_body())
+        parts = {part.get_param("name", header="content-disposition"): part
+                 for part in form.iter_parts()} if form.is_multipart() else {}
+        if "file" not in parts:
+            return self._send(400, b'{"error": "No file uploaded"}')
+        if "file_name" not in parts:
+            return self._send(400, b'{"error": "Required argument is missing", "error_extra": {"argument": "file_name"}}')
+        file_part, file_name = parts["file"], parts["file_name"].get_content().strip()
+        data = file_part.get_payload(decode=True) or b""
+        attachment = {"resource_type": "file", "file_name": file_name, "file_size": len(data),
+                      "file_type": file_part.get_content_type(), "upload_state": "completed",
+                      "file_url": f"https://files.todoist.com/mock/{next(self.server.ids)}/{file_name}"}
+        return self._send(200, json.dumps(attachment).encode())
+
+    def _handle(self):
+        server = self.server
+        if self.path == "/__stats":
+            return self._send(200, json.dumps(server.stats()).encode())
+        if self.path == "/__reset":
+            server.reset()
+            return self._send(204)
+        if self.path == UPLOAD_PATH and self.command == "POST":
+            server.count("POST /uploads/add")
+            return self._upload()
+        parts, params, template = self._route()
+        body = self._body() if self.command == "POST" else {}
+        server.count(f"{self.command} {template}")
+        if not parts or parts[0] not in RESOURCES:
+            return self._send(404, b'{"error": "Not found"}')
+        status = server.fault()
+        if status == 429:
+            return self._send(429, b'{"error": "Too many requests"}', [("Retry-After", str(server.settings.retry_after))])
+        if status is not None:
+            return self._send(status, b'{"error": "Injected failure"}')
+
+        resource = parts[0]
+        if len(parts) == 1:
+            if self.command == "GET":
+                return self._send(200, server.listing(resource, params))
+            created = dict(body, id=str(next(server.ids)))
+            return self._send(200, json.dumps(created).encode())
+        obj = server.by_id.get((resource, parts[1]))
+        if obj is None:
+            return self._send(404, b"Task not found" if resource == "tasks" else b"Not found")
+        if len(parts) == 3:
+            if parts[2] == "collaborators" and self.command == "GET":
+                return self._send(200, b'[{"id": "2671355", "name": "Mock User", "email": "mock@example.com"}]')
+            return self._send(204)  # close / reopen
+        if self.command == "DELETE":
+            return self._send(204)
+        if self.command == "POST":
+            return self._send(200, json.dumps(dict(obj, **body)).encode())
+        return self._send(200, json.dumps(obj).encode())
+
+    do_GET = do_POST = do_DELETE = _handle
+
+
+def start(port=0, host="127.0.0.1", **settings):
+    """Starts a mock on a background thread; returns the server (see base_url, stats(), shutdown())."""
+    return MockTodoist((host, port), Settings(**settings)).start_in_thread()
+
+
+def add_arguments(parser):
+    """The mock's options, shared with benchmark.py."""
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="delay added to every call")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="extra random delay, up to this much")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of calls failing with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of calls answered 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds on a 429")
+    parser.add_argument("--tasks", type=int, default=200, help="tasks in the account")
+    parser.add_argument("--projects", type=int, default=10, help="projects in the account")
+    parser.add_argument("--description-bytes", type=int, default=100, help="size of each task's description")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the account and the faults")
+
+
+def settings_from(args):
+    return Settings(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+                    rate_limit_rate=args.rate_limit_rate, retry_after=args.retry_after, tasks=args.tasks,
+                    projects=args.projects, description_bytes=args.description_bytes, seed=args.seed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    server = MockTodoist((args.host, args.port), settings_from(args))
+    print(f"Mock Todoist at {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,415 @@
+"""Opt-in write-behind queue for manage writes, journaled in SQLite.
+
+With WRITE_BEHIND_ENABLED=1, create/update/move/status actions are
+validated as usual, stored in a durable journal under an idempotency key
+(the client's Idempotency-Key header, or one we generate) and answered
+with 202 right away. A background thread then sends them to Todoist in
+arrival order per object, retrying timeouts, 429s and 5xx with backoff.
+Every attempt carries the key as Todoist's X-Request-Id, so a retry of a
+write that did reach Todoist is not applied twice. Repeating a request
+with the same key returns the existing operation instead of queuing
+another one. GET /writes/<key> reports where an operation stands.
+
+Several workers may share the journal file: each operation is claimed
+with a lease before it is sent, and a lease left behind by a crashed
+worker expires and the operation is retried.
+
+Operations are journaled under the name of the tenant that sent them,
+never its Todoist token; the token is looked up in the tenant registry
+when the operation is sent, so a rotated token is picked up and a tenant
+that has been removed has its pending operations marked failed.
+
+Tunables (environment variables):
+    WRITE_BEHIND_ENABLED        set to 1 to turn write-behind on (off)
+    WRITE_BEHIND_DB_PATH        SQLite journal file (outbox.db)
+    WRITE_BEHIND_MAX_ATTEMPTS   attempts before an operation is marked failed (8)
+    WRITE_BEHIND_RETRY_BACKOFF  first retry delay in seconds, doubling up to 5 minutes (2)
+    WRITE_BEHIND_RETENTION      seconds applied/failed operations are kept (7 days)
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import requests
+
+from auth import get_registry
+from metrics import REGISTRY
+from ratelimit import BULK, RateLimited
+from upstream import env_float, env_int
+
+log = logging.getLogger(__name__)
+
+# Actions that may be queued; reads and deletes always run synchronously
+WRITE_BEHIND_ACTIONS = frozenset({"create", "update", "move", "status"})
+
+MAX_BACKOFF_SECONDS = 300.0
+LEASE_SECONDS = 120.0
+IDLE_POLL_SECONDS = 5.0
+MAX_KEY_LENGTH = 200
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS operations (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL,
+    tenant TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    endpoint TEXT NOT NULL,
+    action TEXT NOT NULL,
+    method TEXT NOT NULL,
+    path TEXT NOT NULL,
+    json_data TEXT,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    lease_until REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    status INTEGER,
+    result TEXT,
+    error TEXT,
+    UNIQUE (tenant, key)
+);
+CREATE INDEX IF NOT EXISTS idx_operations_due ON operations (state, next_attempt_at);
+"""
+
+
+class IdempotencyConflict(Exception):
+    """The idempotency key was already used for a different request."""
+
+
+class Outbox:
+    """Durable journal of queued writes plus the thread that flushes it to Todoist."""
+
+    def __init__(self, db_path="outbox.db", max_attempts=8, retry_backoff=2.0, retention=7 * 86400.0):
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.retention = retention
+        self.applied = self.failed = self.retries = 0
+        self.last_error = None
+        self._lock = threading.RLock()
+        self._wake = threading.Event()
+        self._thread = None
+        if db_path != ":memory:" and not os.path.exists(db_path):
+            # The journal holds the users' pending writes; keep it private to this user
+            os.close(os.open(db_path, os.O_WRONLY | os.O_CREAT, 0o600))
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            db_path=os.getenv("WRITE_BEHIND_DB_PATH", "outbox.db"),
+            max_attempts=env_int("WRITE_BEHIND_MAX_ATTEMPTS", 8),
+            retry_backoff=env_float("WRITE_BEHIND_RETRY_BACKOFF", 2.0),
+            retention=env_float("WRITE_BEHIND_RETENTION", 7 * 86400.0),
+        )
+
+    # --- Journal ---
+
+    def enqueue(self, tenant, endpoint, action, call, key=None):
+        """Journals one write for the tenant named `tenant`; returns (operation dict, True if newly queued).
+
+        Raises IdempotencyConflict if `key` was already used for a different request.
+        """
+        key = key or uuid.uuid4().hex
+        fingerprint = _fingerprint(tenant, call.method, call.path, call.json_data)
+        now = time.time()
+        with self._transaction():
+            row = self._db.execute("SELECT * FROM operations WHERE key = ? AND tenant = ?", (key, tenant)).fetchone()
+            if row is not None:
+                if row["fingerprint"] != fingerprint:
+                    raise IdempotencyConflict(key)
+                return _describe(row), False
+            self._db.execute(
+                "INSERT INTO operations (key, tenant, fingerprint, endpoint, action, method, path, json_data,"
+                " state, next_attempt_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'pending', ?, ?, ?)",
+                (key, tenant, fingerprint, endpoint, action, call.method, call.path,
+                 None if call.json_data is None else json.dumps(call.json_data), now, now, now))
+            row = self._db.execute("SELECT * FROM operations WHERE key = ? AND tenant = ?", (key, tenant)).fetchone()
+        self._wake.set()
+        return _describe(row), True
+
+    def lookup(self, tenant, key):
+        """Returns the operation for `key` if it belongs to the tenant named `tenant`, else None."""
+        with self._lock:
+            row = self._db.execute("SELECT * FROM operations WHERE key = ? AND tenant = ?",
+                                   (key, tenant)).fetchone()
+        return _describe(row) if row is not None else None
+
+    def summary(self, tenant, state=None, limit=50):
+        """Counts by state and the most recent operations for one tenant."""
+        with self._lock:
+            counts = {"pending": 0, "applied": 0, "failed": 0}
+            for row in self._db.execute("SELECT state, COUNT(*) FROM operations WHERE tenant = ? GROUP BY state",
+                                        (tenant,)):
+                counts[_public_state(row[0])] += row[1]
+            query = "SELECT * FROM operations WHERE tenant = ?"
+            args = [tenant]
+            if state == "pending":
+                query += " AND state IN ('pending', 'in_flight')"
+            elif state:
+                query += " AND state = ?"
+                args.append(state)
+            rows = self._db.execute(query + " ORDER BY seq DESC LIMIT ?", args + [limit]).fetchall()
+        return {"counts": counts, "operations": [_describe(row) for row in rows]}
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    # --- Background flush ---
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        last_prune = 0.0
+        while True:
+            try:
+                sent = self.flush_once()
+                if time.time() - last_prune > 3600:
+                    self._prune()
+                    last_prune = time.time()
+            except Exception as e:  # keep the thread alive through anything unexpected
+                self.last_error = str(e)
+                log.warning("Write-behind flush failed: %s", e)
+                sent = 0
+            if not sent:
+                self._wake.wait(self._idle_wait())
+                self._wake.clear()
+
+    def flush_once(self):
+        """Sends every operation that is due, oldest first; returns how many were attempted."""
+        sent = 0
+        blocked = set()  # objects with an earlier operation still outstanding
+        after = 0  # the journal up to here has been looked at in this flush
+        while True:
+            op = self._claim(blocked, after)
+            if op is None:
+                return sent
+            self._send(op)
+            sent += 1
+            after = op["seq"]
+
+    def _claim(self, blocked, after=0):
+        """Claims the first due operation past seq `after` whose object isn't in `blocked`, or returns None.
+
+        Every outstanding operation passed over has its object added to
+        `blocked`, so the next claim in the same flush resumes at the
+        claimed row instead of reading the backlog again.
+        """
+        now = time.time()
+        with self._transaction():
+            rows = self._db.execute("SELECT * FROM operations WHERE seq > ? AND state IN ('pending', 'in_flight')"
+                                    " ORDER BY seq", (after,))
+            try:
+                for row in rows:
+                    item = object_key(row["path"])
+                    waiting = row["state"] == "in_flight" and (row["lease_until"] or 0) > now
+                    if waiting or row["next_attempt_at"] > now or (item is not None and item in blocked):
+                        if item is not None:
+                            blocked.add(item)
+                        continue
+                    self._db.execute("UPDATE operations SET state = 'in_flight', lease_until = ?, updated_at = ?"
+                                     " WHERE seq = ?", (now + LEASE_SECONDS, now, row["seq"]))
+                    if item is not None:
+                        blocked.add(item)
+                    return row
+            finally:
+                rows.close()
+        return None
+
+    def _send(self, op):
+        # Imported here: todoist imports the mirror, cache and client this module doesn't need at import time
+        from todoist import fetch_todoist
+
+        tenant = get_registry().named(op["tenant"])
+        if tenant is None:
+            self._finish(op, "failed", op["attempts"], None, None,
+                         error=f"Tenant '{op['tenant']}' is no longer configured")
+            self.failed += 1
+            log.warning("Write-behind %s %s dropped: tenant '%s' is no longer configured (key %s)",
+                        op["method"], op["path"], op["tenant"], op["key"])
+            return
+        headers = dict(tenant.headers, **{"X-Request-Id": op["key"]})
+        json_data = json.loads(op["json_data"]) if op["json_data"] is not None else None
+        attempts = op["attempts"] + 1
+        try:
+            result = fetch_todoist(headers, op["method"], op["path"], json_data=json_data, priority=BULK)
+        except RateLimited as e:
+            self._retry(op, attempts, str(e), delay=e.retry_after)
+            return
+        except requests.exceptions.RequestException as e:
+            self._retry(op, attempts, f"Failed to reach Todoist: {e}")
+            return
+
+        body = result.content.decode("utf-8", "replace") if result.content else None
+        if 200 <= result.status < 300:
+            self._finish(op, "applied", attempts, result.status, body)
+            self.applied += 1
+            log.info("Write-behind %s %s applied (key %s)", op["method"], op["path"], op["key"])
+        elif result.status == 429 or result.status == 408 or result.status >= 500:
+            self._retry(op, attempts, f"Todoist returned {result.status}: {(body or '')[:500]}", status=result.status)
+        else:
+            self._finish(op, "failed", attempts, result.status, body, error=f"Todoist rejected the write ({result.status})")
+            self.failed += 1
+            log.warning("Write-behind %s %s rejected with %s (key %s)", op["method"], op["path"], result.status, op["key"])
+
+    def _retry(self, op, attempts, error, delay=None, status=None):
+        if attempts >= self.max_attempts:
+            self._finish(op, "failed", attempts, status, None, error=f"Gave up after {attempts} attempts: {error}")
+            self.failed += 1
+            log.warning("Write-behind %s %s failed for good (key %s): %s", op["method"], op["path"], op["key"], error)
+            return
+        if delay is None:
+            delay = min(self.retry_backoff * 2 ** (attempts - 1), MAX_BACKOFF_SECONDS)
+        now = time.time()
+        with self._transaction():
+            self._db.execute(
+                "UPDATE operations SET state = 'pending', attempts = ?, next_attempt_at = ?, lease_until = NULL,"
+                " updated_at = ?, status = ?, error = ? WHERE seq = ?",
+                (attempts, now + delay, now, status, error, op["seq"]))
+        self.retries += 1
+        log.info("Write-behind %s %s will retry in %.1fs (key %s): %s", op["method"], op["path"], delay, op["key"], error)
+
+    def _finish(self, op, state, attempts, status, result, error=None):
+        now = time.time()
+        with self._transaction():
+            self._db.execute(
+                "UPDATE operations SET state = ?, attempts = ?, lease_until = NULL, updated_at = ?, status = ?,"
+                " result = ?, error = ? WHERE seq = ?",
+                (state, attempts, now, status, result, error, op["seq"]))
+
+    def _idle_wait(self):
+        with self._lock:
+            row = self._db.execute("SELECT MIN(CASE WHEN state = 'in_flight' THEN lease_until ELSE next_attempt_at END)"
+                                   " FROM operations WHERE state IN ('pending', 'in_flight')").fetchone()
+        if row[0] is None:
+            return IDLE_POLL_SECONDS  # also picks up work other workers journaled
+        return min(max(row[0] - time.time(), 0.05), IDLE_POLL_SECONDS)
+
+    def _prune(self):
+        with self._transaction():
+            self._db.execute("DELETE FROM operations WHERE state IN ('applied', 'failed') AND updated_at < ?",
+                             (time.time() - self.retention,))
+
+    def stats(self):
+        with self._lock:
+            counts = {"pending": 0, "applied": 0, "failed": 0}
+            for row in self._db.execute("SELECT state, COUNT(*) FROM operations GROUP BY state"):
+                counts[_public_state(row[0])] += row[1]
+        return {"enabled": True, "operations": counts, "applied": self.applied, "failed": self.failed,
+                "retries": self.retries, "last_error": self.last_error}
+
+
+def accept(outbox, tenant, endpoint, action, call, key=None):
+    """Queues a validated manage write for an auth.Tenant; returns (HTTP status, JSON body) for the client."""
+    if key is not None and not 0 < len(key) <= MAX_KEY_LENGTH:
+        return 400, {"error": f"Idempotency-Key must be 1 to {MAX_KEY_LENGTH} characters"}
+    try:
+        operation, created = outbox.enqueue(tenant.name, endpoint, action, call, key)
+    except IdempotencyConflict:
+        return 422, {"error": "Idempotency-Key was already used for a different request"}
+    if created:
+        log.debug("Queued %s %s as write-behind operation %s", call.method, call.path, operation["idempotency_key"])
+    return (202 if operation["state"] == "pending" else 200), operation
+
+
+def is_write_behind(call, action):
+    return call.method != "GET" and action in WRITE_BEHIND_ACTIONS
+
+
+def with_request_id(headers, key):
+    """Todoist headers carrying the client's Idempotency-Key as X-Request-Id, for synchronous writes."""
+    if not key:
+        return headers
+    return dict(headers, **{"X-Request-Id": key[:MAX_KEY_LENGTH]})
+
+
+def object_key(path):
+    """The object a write is to, as "/tasks/123" for /tasks/123 and /tasks/123/close; None for a create."""
+    parts = path.split("/")
+    return "/".join(parts[:3]) if len(parts) > 2 else None
+
+
+def _fingerprint(tenant, method, path, json_data):
+    raw = json.dumps([tenant, method, path, json_data], sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def _public_state(state):
+    return "pending" if state == "in_flight" else state
+
+
+def _describe(row):
+    result = row["result"]
+    if result is not None:
+        try:
+            result = json.loads(result)
+        except ValueError:
+            pass
+    return {
+        "idempotency_key": row["key"],
+        "state": _public_state(row["state"]),
+        "endpoint": row["endpoint"],
+        "action": row["action"],
+        "attempts": row["attempts"],
+        "created_at": row["created_at"],
+        "updated_at": row["updated_at"],
+        "status": row["status"],
+        "result": result,
+        "error": row["error"],
+        "status_url": f"/writes/{row['key']}",
+    }
+
+
+_outbox = None
+_outbox_pid = None
+_outbox_lock = threading.Lock()
+
+
+def _outbox_collector():
+    if _outbox is None or _outbox_pid != os.getpid():
+        return []
+    stats = _outbox.stats()
+    return [
+        ("gtd_writebehind_operations", "gauge", "Journaled write-behind operations, by state.",
+         [({"state": state}, count) for state, count in stats["operations"].items()]),
+        ("gtd_writebehind_retries_total", "counter", "Write-behind attempts that will be retried.",
+         [({}, stats["retries"])]),
+    ]
+
+
+REGISTRY.add_collector(_outbox_collector)
+
+
+def get_outbox():
+    """Returns this process's write-behind journal (starting its flush thread), or None when disabled."""
+    global _outbox, _outbox_pid
+    if os.getenv("WRITE_BEHIND_ENABLED", "0").lower() not in ("1", "true", "yes"):
+        return None
+    pid = os.getpid()
+    if _outbox is None or _outbox_pid != pid:
+        with _outbox_lock:
+            if _outbox is None or _outbox_pid != pid:
+                _outbox = Outbox.from_env()
+                _outbox_pid = pid
+                _outbox.start()
+    return _outbox
@@ -0,0 +1,307 @@
+"""Client-side token bucket that keeps each Todoist user inside their request budget.
+
+Todoist allows a fixed number of requests per user per window and answers
+anything over it with 429. Rather than forward those failures, every call
+through the upstream client first takes a token from its credential's
+bucket. When the bucket is empty the call queues, and queued calls are let
+through in priority order (interactive reads and single writes before
+list/bulk work, background syncs last). A call is refused with RateLimited
+only if it would still be queued past its deadline; the exception carries
+the estimated wait so the client knows when to come back.
+
+The bucket starts from the configured budget and is corrected from what
+Todoist tells us: X-RateLimit-Remaining lowers the token count, and a 429
+empties the bucket and holds it closed for Retry-After. Budgets are per
+worker process; set the budget to the account limit divided by the worker
+count, and any 429s still correct the rest.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import namedtuple
+
+import requests
+
+from metrics import REGISTRY
+
+log = logging.getLogger(__name__)
+
+INTERACTIVE = 0  # single-object reads and single writes
+BULK = 1         # collection listings and /batch operations
+BACKGROUND = 2   # mirror syncs
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BULK: "bulk", BACKGROUND: "background"}
+
+# How long to hold a bucket closed after a 429 that came without Retry-After
+DEFAULT_BACKOFF_SECONDS = 15.0
+# Idle, full buckets are dropped once there are more than this many credentials
+MAX_IDLE_BUCKETS = 256
+# Async waiters aren't notified; the shortest interval at which they recheck their bucket
+ASYNC_POLL_SECONDS = 0.01
+
+QUEUE_DEPTH = REGISTRY.gauge(
+    "gtd_ratelimit_queue_depth", "Upstream calls waiting for rate-limit budget, by priority.", ("priority",))
+QUEUE_WAIT = REGISTRY.histogram(
+    "gtd_ratelimit_wait_seconds", "Time upstream calls spent queued for rate-limit budget, by priority.",
+    ("priority",))
+REJECTED = REGISTRY.counter(
+    "gtd_ratelimit_rejected_total", "Upstream calls refused because the queue wait would exceed its deadline.",
+    ("priority",))
+THROTTLED = REGISTRY.counter(
+    "gtd_ratelimit_throttled_total", "429 responses received from Todoist despite the scheduler.")
+
+
+class RateLimited(requests.exceptions.RequestException):
+    """Raised when a call can't get rate-limit budget before its deadline; `retry_after` is in seconds."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Todoist rate limit reached; estimated wait {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+def classify(method, path):
+    """Default priority: collection GETs (/tasks, /projects/123/collaborators) are bulk, the rest interactive."""
+    if method != "GET":
+        return INTERACTIVE
+    parts = path.strip("/").split("/")
+    return INTERACTIVE if len(parts) == 2 else BULK
+
+
+class _Bucket:
+    def __init__(self, capacity, rate, now):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = float(capacity)
+        self.updated = now
+        self.blocked_until = 0.0
+        self.waiters = []  # heap of (priority, seq)
+
+
+# A queued call: its bucket, its (priority, seq) heap entry, the priority's label, and when it queued and gives up
+_Ticket = namedtuple("_Ticket", "bucket entry label started deadline")
+
+
+class RateLimiter:
+    """Per-credential token buckets with a priority queue in front of each."""
+
+    def __init__(self, requests_per_window=450, window=900.0, max_wait=10.0):
+        self.capacity = requests_per_window
+        self.window = window
+        self.rate = requests_per_window / window if window > 0 else 0.0
+        self.max_wait = max_wait
+        self._budgets = {}  # namespace -> requests per window, where it differs from the default
+        self._buckets = {}
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self.granted = self.queued = self.rejected = self.throttled = 0
+
+    @property
+    def enabled(self):
+        return self.capacity > 0 and self.rate > 0
+
+    def acquire(self, namespace, priority=INTERACTIVE):
+        """Blocks until `namespace` may send one request; returns the seconds spent queued.
+
+        Raises RateLimited right away if the estimated wait already exceeds
+        the deadline, or once the deadline passes.
+        """
+        with self._cond:
+            ticket = self._join(namespace, priority)
+            if ticket is None:
+                return 0.0
+            try:
+                while True:
+                    waited, ready_in = self._poll(ticket)
+                    if waited is not None:
+                        return waited
+                    # Only the head can use the next token; everyone else waits to be notified
+                    timeout = ticket.deadline - time.monotonic()
+                    if ticket.bucket.waiters[0] == ticket.entry:
+                        timeout = min(timeout, ready_in)
+                    self._cond.wait(timeout)
+            finally:
+                self._leave(ticket)
+
+    async def acquire_async(self, namespace, priority=INTERACTIVE):
+        """acquire() for the event loop: a queued call sleeps on the loop instead of holding a thread.
+
+        Async waiters can't be notified, so each one rechecks the bucket when
+        the next token is due (at least every ASYNC_POLL_SECONDS).
+        """
+        with self._cond:
+            ticket = self._join(namespace, priority)
+        if ticket is None:
+            return 0.0
+        try:
+            while True:
+                with self._cond:
+                    waited, ready_in = self._poll(ticket)
+                if waited is not None:
+                    return waited
+                await asyncio.sleep(min(max(ready_in, ASYNC_POLL_SECONDS), ticket.deadline - time.monotonic()))
+        finally:
+            with self._cond:
+                self._leave(ticket)
+
+    def _join(self, namespace, priority):
+        """Takes a token or queues for one; returns None if taken, else the _Ticket to _poll() with."""
+        label = PRIORITY_NAMES.get(priority, str(priority))
+        now = time.monotonic()
+        bucket = self._bucket(namespace, now)
+        if self._take_now(bucket, now):
+            return None
+
+        estimate = self._estimate(bucket, priority, now)
+        if estimate > self.max_wait:
+            self.rejected += 1
+            REJECTED.inc(priority=label)
+            raise RateLimited(estimate)
+
+        ticket = _Ticket(bucket, (priority, next(self._seq)), label, now, now + self.max_wait)
+        heapq.heappush(bucket.waiters, ticket.entry)
+        self.queued += 1
+        QUEUE_DEPTH.inc(priority=label)
+        return ticket
+
+    def _poll(self, ticket):
+        """(seconds queued, None) once the ticket gets its token, else (None, seconds until the next token).
+
+        Raises RateLimited once the ticket's deadline has passed.
+        """
+        bucket, entry = ticket.bucket, ticket.entry
+        now = time.monotonic()
+        self._refill(bucket, now)
+        ready_in = self._ready_in(bucket, now)
+        if bucket.waiters[0] == entry and ready_in <= 0:
+            heapq.heappop(bucket.waiters)
+            bucket.tokens -= 1
+            self.granted += 1
+            self._cond.notify_all()  # the next waiter is now at the head
+            waited = now - ticket.started
+            QUEUE_WAIT.observe(waited, priority=ticket.label)
+            return waited, None
+        if now >= ticket.deadline:
+            self.rejected += 1
+            REJECTED.inc(priority=ticket.label)
+            raise RateLimited(self._estimate(bucket, entry[0], now))
+        return None, ready_in
+
+    def _leave(self, ticket):
+        QUEUE_DEPTH.dec(priority=ticket.label)
+        bucket = ticket.bucket
+        if ticket.entry in bucket.waiters:
+            bucket.waiters.remove(ticket.entry)
+            heapq.heapify(bucket.waiters)
+            self._cond.notify_all()
+
+    def set_budgets(self, budgets):
+        """Gives namespaces their own requests-per-window budget; everyone else keeps the default."""
+        with self._cond:
+            self._budgets = dict(budgets)
+            now = time.monotonic()
+            for namespace, bucket in self._buckets.items():
+                self._refill(bucket, now)
+                bucket.capacity, bucket.rate = self._budget(namespace)
+                bucket.tokens = min(bucket.tokens, bucket.capacity)
+            self._cond.notify_all()
+
+    def try_acquire(self, namespace):
+        """Takes a token only if no queuing is needed; callers that get False should acquire()."""
+        with self._cond:
+            now = time.monotonic()
+            return self._take_now(self._bucket(namespace, now), now)
+
+    def observe(self, namespace, resp):
+        """Corrects the bucket from a Todoist response's rate-limit headers and 429s."""
+        remaining = resp.headers.get("X-RateLimit-Remaining")
+        if resp.status_code != 429 and remaining is None:
+            return
+        with self._cond:
+            now = time.monotonic()
+            bucket = self._bucket(namespace, now)
+            self._refill(bucket, now)
+            if remaining is not None:
+                try:
+                    bucket.tokens = min(bucket.tokens, max(float(remaining), 0.0))
+                except ValueError:
+                    pass
+            if resp.status_code == 429:
+                backoff = _retry_after(resp)
+                bucket.tokens = 0.0
+                bucket.blocked_until = max(bucket.blocked_until, now + backoff)
+                self.throttled += 1
+                THROTTLED.inc()
+                log.warning("Todoist rate limit hit; holding requests for %.1fs", backoff)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            waiting = {name: 0 for name in PRIORITY_NAMES.values()}
+            for bucket in self._buckets.values():
+                for priority, _ in bucket.waiters:
+                    waiting[PRIORITY_NAMES.get(priority, str(priority))] += 1
+            return {
+                "enabled": self.enabled,
+                "requests_per_window": self.capacity,
+                "refill_per_second": round(self.rate, 4),
+                "max_wait_seconds": self.max_wait,
+                "credentials": len(self._buckets),
+                "tenant_budgets": len(self._budgets),
+                "waiting": waiting,
+                "granted": self.granted,
+                "queued": self.queued,
+                "rejected": self.rejected,
+                "throttled": self.throttled,
+            }
+
+    def _bucket(self, namespace, now):
+        bucket = self._buckets.get(namespace)
+        if bucket is None:
+            if len(self._buckets) >= MAX_IDLE_BUCKETS:
+                self._prune(now)
+            bucket = self._buckets[namespace] = _Bucket(*self._budget(namespace), now)
+        return bucket
+
+    def _budget(self, namespace):
+        """(capacity, refill per second) for `namespace`."""
+        capacity = self._budgets.get(namespace, self.capacity)
+        return capacity, capacity / self.window if self.window > 0 else 0.0
+
+    def _prune(self, now):
+        for namespace, bucket in list(self._buckets.items()):
+            self._refill(bucket, now)
+            if not bucket.waiters and bucket.tokens >= bucket.capacity:
+                del self._buckets[namespace]
+
+    def _take_now(self, bucket, now):
+        self._refill(bucket, now)
+        if bucket.waiters or bucket.tokens < 1 or now < bucket.blocked_until:
+            return False
+        bucket.tokens -= 1
+        self.granted += 1
+        return True
+
+    def _refill(self, bucket, now):
+        if now > bucket.updated:
+            bucket.tokens = min(bucket.capacity, bucket.tokens + (now - bucket.updated) * bucket.rate)
+            bucket.updated = now
+
+    def _ready_in(self, bucket, now):
+        """Seconds until the bucket can hand out a token."""
+        return max(bucket.blocked_until - now, (1 - bucket.tokens) / bucket.rate, 0.0)
+
+    def _estimate(self, bucket, priority, now):
+        """Seconds a new `priority` call would queue: everyone at or above its priority goes first."""
+        ahead = sum(1 for waiter_priority, _ in bucket.waiters if waiter_priority <= priority)
+        blocked = max(bucket.blocked_until - now, 0.0)
+        tokens = 0.0 if blocked else bucket.tokens
+        return blocked + max(ahead + 1 - tokens, 0.0) / bucket.rate
+
+
+def _retry_after(resp):
+    try:
+        return max(float(resp.headers.get("Retry-After")), 0.0)
+    except (TypeError, ValueError):
+        return DEFAULT_BACKOFF_SECONDS
@@ -0,0 +1,59 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# main.py validates the tenant configuration at import
+os.environ.setdefault("API_KEY", "test-key")
+os.environ.setdefault("TODOIST_API_TOKEN", "test-token")
+os.environ.setdefault("LOG_LEVEL", "CRITICAL")
+
+import async_upstream  # noqa: E402
+import auth  # noqa: E402
+import cache  # noqa: E402
+import changes  # noqa: E402
+import coalesce  # noqa: E402
+import mirror  # noqa: E402
+import mock_todoist  # noqa: E402
+import outbox  # noqa: E402
+import upstream  # noqa: E402
+
+API_KEY = os.environ["API_KEY"]
+SINGLETONS = [(upstream, "_client"), (upstream, "_limiter"), (upstream, "_breakers"), (async_upstream, "_client"),
+              (cache, "_cache"), (cache, "_stale"), (coalesce, "_flights"), (coalesce, "_shared"),
+              (changes, "_feed"), (mirror, "_mirror"), (outbox, "_outbox")]
+
+
+@pytest.fixture(autouse=True)
+def fresh_process(monkeypatch):
+    """Every test starts with the per-process clients, caches and queues unbuilt, so they read its environment."""
+    for module, name in SINGLETONS:
+        monkeypatch.setattr(module, name, None)
+    monkeypatch.setattr(auth, "_registry", None)
+    monkeypatch.setenv("RATE_LIMIT_REQUESTS", "0")
+    monkeypatch.setenv("TODOIST_MAX_RETRIES", "0")
+    for name in ("TENANTS_FILE", "COALESCE_SHARED_DIR", "MIRROR_ENABLED", "WRITE_BEHIND_ENABLED",
+                 "TODOIST_CLIENT_SECRET"):
+        monkeypatch.delenv(name, raising=False)
+
+
+@pytest.fixture
+def todoist(monkeypatch):
+    """A mock Todoist (mock_todoist.py) that the app is pointed at."""
+    server = mock_todoist.start()
+    monkeypatch.setenv("TODOIST_API_BASE", server.base_url)
+    monkeypatch.setenv("TODOIST_SYNC_API_BASE", server.sync_url)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client(todoist):
+    import main
+    test_client = main.app.test_client()
+    test_client.environ_base["HTTP_X_API_KEY"] = API_KEY
+    return test_client
@@ -0,0 +1,89 @@
+import copy
+import json
+
+import pytest
+
+from actions import SPEC_PATH, ActionError, SpecError, UpstreamCall, build_call, compile_spec
+
+
+def test_a_status_change_maps_to_its_todoist_path():
+    assert build_call("tasks", {"action": "status", "task_id": "7", "status": "closed"}) == \
+        UpstreamCall("POST", "/tasks/7/close")
+
+
+def test_inputs_the_hand_written_handlers_accepted():
+    call = build_call("/tasks/manage", {"action": "STATUS", "task_id": 5, "status": "CLOSED"})
+    assert call.path == "/tasks/5/close"
+    call = build_call("tasks", {"action": "update", "task_id": "5", "priority": "4", "duration_unit": "Minute"})
+    assert call.json_data == {"priority": 4, "duration_unit": "minute"}
+
+
+def test_only_the_fields_an_action_uses_are_sent():
+    call = build_call("tasks", {"action": "move", "task_id": "5", "section_id": "9", "content": "ignored"})
+    assert call == UpstreamCall("POST", "/tasks/5", None, {"section_id": "9"})
+    call = build_call("tasks", {"action": "list", "project_id": "1", "filter": "", "limit": 2})
+    assert call.params == {"project_id": "1"} and call.view.limit == 2
+
+
+@pytest.mark.parametrize("endpoint, data, message", [
+    ("tasks", {"action": "get"}, "task_id is required for 'get' action"),
+    ("tasks", {"action": "create"}, "'content' is required to create a task"),
+    ("tasks", {"action": "update", "task_id": "5"}, "At least one field"),
+    ("tasks", {"action": "move", "task_id": "5"}, "Either 'project_id' or 'section_id'"),
+    ("tasks", {"action": "status", "task_id": "5", "status": "done"}, "'status' must be one of: closed, open"),
+    ("tasks", {"action": "create", "content": ["a"]}, "'content' must be a string"),
+    ("tasks", {"action": "create", "content": "a", "priority": 5}, "'priority' must be an integer from 1 to 4"),
+    ("tasks", {"action": "create", "content": "a", "labels": "errand"}, "'labels' must be a list of strings"),
+    ("projects", {"action": "update", "project_id": "1", "is_favorite": "yes"}, "must be true or false"),
+    ("projects", {"action": "archive"}, "Unknown or unsupported action 'archive'"),
+    ("folders", {"action": "list"}, "Unknown endpoint 'folders'"),
+    ("tasks", [], "Request body must be a JSON object"),
+])
+def test_invalid_requests_are_refused(endpoint, data, message):
+    with pytest.raises(ActionError) as raised:
+        build_call(endpoint, data)
+    assert message in raised.value.message and raised.value.status == 400
+
+
+def spec():
+    with open(SPEC_PATH) as f:
+        return json.load(f)
+
+
+def tasks_schema(document):
+    return document["paths"]["/tasks/manage"]["post"]["requestBody"]["content"]["application/json"]["schema"]
+
+
+def test_the_committed_spec_compiles():
+    assert set(compile_spec(spec())["tasks"]) == {"list", "get", "create", "update", "delete", "move", "status"}
+
+
+@pytest.mark.parametrize("change", [
+    lambda schema: schema["x-actions"].pop("move"),
+    lambda schema: schema["x-actions"]["get"].update(query=["no_such_field"]),
+    lambda schema: schema["x-actions"]["get"].update(retries=2),
+])
+def test_a_spec_that_drifts_from_the_handlers_fails_at_startup(change):
+    document = copy.deepcopy(spec())
+    change(tasks_schema(document))
+    with pytest.raises(SpecError):
+        compile_spec(document)
+
+
+def test_every_reference_in_the_spec_resolves():
+    document = spec()
+
+    def refs(node):
+        if isinstance(node, dict):
+            if "$ref" in node:
+                yield node["$ref"]
+            for value in node.values():
+                yield from refs(value)
+        elif isinstance(node, list):
+            for value in node:
+                yield from refs(value)
+
+    for ref in refs(document):
+        target = document
+        for part in ref.lstrip("#/").split("/"):
+            target = target[part]
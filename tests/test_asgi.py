@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest
+
+from conftest import API_KEY
+
+httpx = pytest.importorskip("httpx")  # optional: requirements-async.txt
+
+import asgi  # noqa: E402
+from async_upstream import close_async_client  # noqa: E402
+from metrics import UPSTREAM_LATENCY  # noqa: E402
+
+
+def serve(*requests):
+    """Sends (method, path, json) requests to the ASGI app concurrently; returns the responses in order."""
+    async def run():
+        transport = httpx.ASGITransport(app=asgi.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://gtd", headers={"X-API-KEY": API_KEY}) as c:
+            try:
+                return await asyncio.gather(*(c.request(method, path, json=body) for method, path, body in requests))
+            finally:
+                await close_async_client()
+    return asyncio.run(run())
+
+
+def upstream_calls_observed(labels):
+    return next((value for name, sample_labels, value in UPSTREAM_LATENCY.samples()
+                 if name == "gtd_upstream_duration_seconds_count" and sample_labels == labels), 0)
+
+
+def test_manage_calls_go_through_the_async_client(todoist):
+    task = todoist.account["tasks"][0]
+    [response] = serve(("POST", "/tasks/manage", {"action": "get", "task_id": task["id"]}))
+    assert response.status_code == 200 and response.json() == task
+
+
+def test_invalid_calls_never_reach_todoist(todoist):
+    [response] = serve(("POST", "/tasks/manage", {"action": "get"}))
+    assert response.status_code == 400 and "task_id" in response.json()["error"]
+    assert todoist.stats()["total"] == 0
+
+
+def test_concurrent_identical_reads_make_one_call(todoist, monkeypatch):
+    monkeypatch.setenv("CACHE_TTL_SECONDS", "0")
+    todoist.settings.latency_ms = 100
+    responses = serve(*[("POST", "/projects/manage", {"action": "list"})] * 5)
+    assert [response.status_code for response in responses] == [200] * 5
+    assert todoist.stats()["calls"] == {"GET /projects": 1}
+
+
+def test_other_routes_are_served_by_the_flask_app(todoist):
+    [response] = serve(("GET", "/metrics", None))
+    assert response.status_code == 200 and "gtd_requests_total" in response.text
+
+
+def test_a_slow_todoist_answers_504(todoist, monkeypatch):
+    monkeypatch.setenv("TODOIST_READ_TIMEOUT", "0.05")
+    todoist.settings.latency_ms = 300
+    [response] = serve(("POST", "/projects/manage", {"action": "list"}))
+    assert response.status_code == 504
+
+
+def test_a_429_is_left_to_the_rate_limiter(todoist, monkeypatch):
+    monkeypatch.setenv("RATE_LIMIT_REQUESTS", "100")
+    monkeypatch.setenv("RATE_LIMIT_WINDOW_SECONDS", "1")  # a 429 empties the bucket; refill it quickly
+    monkeypatch.setenv("TODOIST_MAX_RETRIES", "2")
+    monkeypatch.setenv("TODOIST_RETRY_BACKOFF", "0.01")
+    todoist.settings.rate_limit_rate = 1.0
+    todoist.settings.retry_after = 0
+    [response] = serve(("POST", "/tasks/manage", {"action": "get", "task_id": "1"}))
+    assert response.status_code == 429
+    assert todoist.stats()["calls"] == {"GET /tasks/{id}": 2}
+
+
+def test_upstream_latency_is_observed_once_per_call(todoist, monkeypatch):
+    monkeypatch.setenv("TODOIST_MAX_RETRIES", "2")
+    monkeypatch.setenv("TODOIST_RETRY_BACKOFF", "0.01")
+    todoist.settings.error_rate = 1.0
+    labels = (("method", "GET"), ("route", "/tasks/{id}"))
+    before = upstream_calls_observed(labels)
+    [response] = serve(("POST", "/tasks/manage", {"action": "get", "task_id": "1"}))
+    assert response.status_code == 500 and todoist.stats()["total"] == 3
+    assert upstream_calls_observed(labels) == before + 1  # retries included
@@ -0,0 +1,75 @@
+import hashlib
+import json
+import runpy
+import signal
+
+import pytest
+
+import auth
+from conftest import ROOT
+
+
+@pytest.fixture
+def tenants_file(tmp_path, monkeypatch):
+    path = tmp_path / "tenants.json"
+    monkeypatch.setenv("TENANTS_FILE", str(path))
+
+    def write(*tenants):
+        path.write_text(json.dumps({"tenants": list(tenants)}))
+    return write
+
+
+def test_the_default_tenant_comes_from_the_environment():
+    tenant, failure = auth.authenticate("test-key")
+    assert failure is None and tenant.name == "default"
+    assert tenant.headers["Authorization"] == "Bearer test-token"
+    assert auth.authenticate("wrong")[1] == auth.UNAUTHORIZED
+    assert auth.authenticate(None)[1] == auth.UNAUTHORIZED
+
+
+def test_tenants_file(tenants_file):
+    tenants_file({"name": "alice", "api_key": "a-key", "todoist_token": "a", "todoist_user_id": 7},
+                 {"name": "bob", "api_key_sha256": hashlib.sha256(b"b-key").hexdigest(), "todoist_token": "b",
+                  "rate_limit_requests": 100})
+    registry = auth.get_registry()
+    assert auth.authenticate("b-key")[0].name == "bob"
+    assert registry.named("alice").headers["Authorization"] == "Bearer a"
+    assert registry.for_user("7").name == "alice" and registry.for_user("8") is None
+    assert registry.budgets() == {"Bearer b": 100}
+
+
+@pytest.mark.parametrize("tenants", [
+    [{"name": "a", "api_key": "k", "todoist_token": "t"}, {"name": "b", "api_key": "k", "todoist_token": "u"}],
+    [{"name": "a", "api_key": "k"}],
+    [{"name": "a", "api_key": "k", "todoist_token": "t", "rate_limit_requests": 0}],
+])
+def test_an_invalid_file_is_refused(tenants_file, tenants):
+    tenants_file(*tenants)
+    with pytest.raises(auth.ConfigError):
+        auth.load_registry()
+
+
+def test_a_bad_reload_keeps_the_current_registry(tenants_file, monkeypatch):
+    monkeypatch.setattr(auth, "_listeners", [])
+    tenants_file({"name": "alice", "api_key": "a-key", "todoist_token": "a"})
+    seen = []
+    auth.on_reload(seen.append)
+    current = auth.get_registry()
+    tenants_file({"name": "alice"})
+    assert auth.reload_registry() is False
+    assert auth.get_registry() is current
+
+    tenants_file({"name": "carol", "api_key": "c-key", "todoist_token": "c"})
+    assert auth.reload_registry() is True
+    assert auth.authenticate("c-key")[0].name == "carol"
+    assert [registry.tenants[0].name for registry in seen] == ["alice", "carol"]
+
+
+def test_the_gunicorn_hook_installs_the_reload_handler():
+    previous = signal.signal(signal.SIGHUP, signal.SIG_DFL)  # as gunicorn leaves a forked worker
+    try:
+        config = runpy.run_path(f"{ROOT}/gunicorn.conf.py")
+        config["post_worker_init"](None)
+        assert callable(signal.getsignal(signal.SIGHUP))
+    finally:
+        signal.signal(signal.SIGHUP, previous)
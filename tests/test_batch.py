@@ -0,0 +1,146 @@
+import json
+import threading
+import time
+
+import pytest
+import requests
+
+import batch
+from actions import ActionError
+from todoist import UpstreamResult
+
+
+def op(endpoint, action, **fields):
+    return dict(fields, endpoint=endpoint, action=action)
+
+
+def test_references_must_point_back():
+    with pytest.raises(ActionError) as raised:
+        batch.parse_operations([op("tasks", "create", content="x", project_id="$0.id")], 10)
+    assert "does not run before it" in raised.value.message
+
+
+def test_operations_on_one_object_keep_their_order():
+    ops = batch.parse_operations([op("tasks", "update", task_id="1", priority=2),
+                                  op("tasks", "update", task_id="2", priority=2),
+                                  op("tasks", "status", task_id="1", status="closed")], 10)
+    assert ops[1].deps == set() and ops[2].deps == {0}
+
+
+def test_reads_and_writes_keep_their_order():
+    ops = batch.parse_operations([op("tasks", "list"), op("projects", "list"),
+                                  op("tasks", "create", content="x"), op("tasks", "create", content="y"),
+                                  op("tasks", "list")], 10)
+    assert ops[1].after == set()
+    assert ops[2].after == ops[3].after == {0, 1}
+    assert ops[4].after == {2, 3}
+
+
+def test_a_read_runs_after_the_writes_before_it(monkeypatch):
+    log, lock = [], threading.Lock()
+
+    def fetch(headers, method, path, **kwargs):
+        with lock:
+            log.append(("start", method))
+        time.sleep(0.05 if method == "POST" else 0.0)
+        with lock:
+            log.append(("end", method))
+        body = b"[]" if method == "GET" else json.dumps({"id": "9"}).encode()
+        return UpstreamResult(200, body, "application/json", {}, None)
+
+    monkeypatch.setattr(batch, "fetch_todoist", fetch)
+    document = batch.run_batch([op("tasks", "create", content="x"), op("tasks", "list", project_id="1")],
+                               {"Authorization": "Bearer t"}, mode="rest")
+    assert [result["status"] for result in document["results"]] == [200, 200]
+    assert log == [("start", "POST"), ("end", "POST"), ("start", "GET"), ("end", "GET")]
+
+
+def test_a_failed_write_does_not_skip_the_reads_after_it(client, todoist):
+    document = client.post("/batch", json={"mode": "rest", "operations": [
+        op("tasks", "update", task_id="999999", priority=2), op("projects", "list")]}).json
+    assert [result["status"] for result in document["results"]] == [404, 200]
+
+
+def test_a_dependent_operation_gets_the_created_id(client, todoist):
+    document = client.post("/batch", json={"mode": "rest", "operations": [
+        op("projects", "create", name="Errands"), op("sections", "create", name="Shop", project_id="$0.id")]}).json
+    project, section = document["results"]
+    assert section["status"] == 200 and section["body"]["project_id"] == project["body"]["id"]
+
+
+def test_a_failed_dependency_skips_the_operation(client, todoist):
+    todoist.settings.error_rate = 1.0
+    document = client.post("/batch", json={"mode": "rest", "operations": [
+        op("projects", "create", name="Errands"), op("sections", "create", name="Shop", project_id="$0.id")]}).json
+    assert [result["status"] for result in document["results"]] == [500, 424]
+
+
+class SyncClient:
+    """Answers Sync API requests as Todoist would, mapping every temp id to a new id."""
+
+    def __init__(self):
+        self.sent = []
+
+    def request(self, method, path, data=None, **kwargs):
+        commands = json.loads(data["commands"])
+        self.sent.append(commands)
+        payload = {"sync_status": {c["uuid"]: "ok" for c in commands},
+                   "temp_id_mapping": {c["temp_id"]: str(100 + i) for i, c in enumerate(commands) if "temp_id" in c}}
+        resp = requests.Response()
+        resp.status_code, resp._content = 200, json.dumps(payload).encode()
+        return resp
+
+
+@pytest.fixture
+def sync_client(monkeypatch):
+    client = SyncClient()
+    monkeypatch.setattr(batch, "get_client", lambda: client)
+    return client
+
+
+def test_writes_go_as_sync_commands_with_temp_ids(sync_client):
+    document = batch.run_batch([op("projects", "create", name="Errands"),
+                                op("tasks", "create", content="Milk", project_id="$0.id"),
+                                op("tasks", "status", task_id="$1.id", status="closed")],
+                               {"Authorization": "Bearer t"})
+    assert document["mode"] == "sync" and document["upstream_calls"] == 1
+    project_add, item_add, item_close = sync_client.sent[0]
+    assert item_add["args"]["project_id"] == project_add["temp_id"]
+    assert item_close == dict(item_close, type="item_close", args={"id": item_add["temp_id"]})
+    # Creates answer with just the new id, other writes with no body
+    assert [(r["status"], r.get("body")) for r in document["results"]] == [(200, {"id": "100"}), (200, {"id": "101"}),
+                                                                            (204, None)]
+
+
+def test_temp_ids_from_an_earlier_request_are_sent_as_real_ids(sync_client, monkeypatch):
+    monkeypatch.setattr(batch, "SYNC_COMMANDS_PER_REQUEST", 1)
+    batch.run_batch([op("projects", "create", name="Errands"),
+                     op("tasks", "create", content="Milk", project_id="$0.id")], {"Authorization": "Bearer t"})
+    assert sync_client.sent[1][0]["args"]["project_id"] == "100"
+
+
+def test_batches_sync_cannot_express_use_rest():
+    ops = batch.parse_operations([op("tasks", "create", content="x"), op("tasks", "list")], 10)
+    assert batch.plan_sync(ops) is None
+    ops = batch.parse_operations([op("tasks", "create", content="x"),
+                                  op("tasks", "create", content="y", description="$0.content")], 10)
+    assert batch.plan_sync(ops) is None
+    with pytest.raises(ActionError):
+        batch.run_batch([op("tasks", "list")], {"Authorization": "Bearer t"}, mode="sync")
+
+
+def test_a_chunk_answered_with_an_error_page_fails_alone(sync_client, monkeypatch):
+    monkeypatch.setattr(batch, "SYNC_COMMANDS_PER_REQUEST", 1)
+    answer = sync_client.request
+
+    def request(method, path, data=None, **kwargs):
+        resp = answer(method, path, data=data)
+        if len(sync_client.sent) == 2:
+            resp._content = b"<html>Bad gateway</html>"
+        return resp
+
+    monkeypatch.setattr(sync_client, "request", request)
+    document = batch.run_batch([op("projects", "create", name="Errands"), op("projects", "create", name="Home")],
+                               {"Authorization": "Bearer t"})
+    assert [result["status"] for result in document["results"]] == [200, 502]
+    assert "invalid JSON" in document["results"][1]["error"]
@@ -0,0 +1,54 @@
+import argparse
+import json
+import os
+import random
+
+import pytest
+
+import benchmark
+import mock_todoist
+from actions import build_call
+
+
+def test_every_benchmarked_request_is_valid():
+    account = mock_todoist.build_account(mock_todoist.Settings())
+    rng = random.Random(0)
+    for name, payload in benchmark.PAYLOADS.items():
+        build_call(name.split(".")[0], payload(rng, account))
+
+
+def test_a_mix_is_a_name_or_weighted_actions():
+    assert benchmark.parse_mix("read") is benchmark.MIXES["read"]
+    assert benchmark.parse_mix("tasks.list=3, tasks.get") == {"tasks.list": 3.0, "tasks.get": 1.0}
+    for value in ("tasks.purge", "tasks.list=x"):
+        with pytest.raises(argparse.ArgumentTypeError):
+            benchmark.parse_mix(value)
+
+
+def report(throughput=100.0, p95=50.0, p99=80.0, per_request=1.0):
+    return {"overall": {"throughput": throughput, "p95_ms": p95, "p99_ms": p99},
+            "upstream": {"per_request": per_request}}
+
+
+def test_only_changes_past_the_tolerance_are_regressions():
+    baseline = report()
+    assert benchmark.compare(report(throughput=95.0, p95=54.0), baseline, 0.1) == []
+    assert benchmark.compare(report(throughput=200.0, p99=10.0), baseline, 0.1) == []  # better is fine
+    regressions = benchmark.compare(report(throughput=80.0, per_request=1.5), baseline, 0.1)
+    assert [line.split(":")[0] for line in regressions] == ["throughput", "upstream calls/request"]
+
+
+@pytest.mark.parametrize("name, mix, server", [("default", "default", "wsgi"), ("read", "read", "wsgi"),
+                                               ("write", "write", "wsgi"), ("default-asgi", "default", "asgi")])
+def test_the_committed_baselines_match_their_mix(name, mix, server):
+    with open(os.path.join(benchmark.BASELINE_DIR, f"{name}.json")) as f:
+        baseline = json.load(f)
+    assert baseline["config"]["mix"] == benchmark.MIXES[mix] and baseline["config"]["server"] == server
+    assert benchmark.compare(baseline, baseline, 0.0) == []
+    assert set(baseline["statuses"]) <= {"200", "204"}
+
+
+def test_validation_is_timed_for_every_benchmarked_action():
+    report = benchmark.time_validation(number=10)
+    assert set(report) == set(benchmark.PAYLOADS)
+    assert all(timings["current"] > 0 for timings in report.values())
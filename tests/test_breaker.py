@@ -0,0 +1,134 @@
+import threading
+
+import pytest
+
+from breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpen
+from conftest import API_KEY
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+def breaker(clock, **settings):
+    settings = dict(dict(failure_rate=0.5, min_calls=4, window=30.0, slow_call_seconds=5.0, open_seconds=10.0),
+                    **settings)
+    return CircuitBreaker("/tasks", clock=clock, **settings)
+
+
+def test_opens_once_the_failed_share_reaches_the_rate(clock):
+    b = breaker(clock)
+    for failed in (False, True, False):
+        b.record(failed, 0.1)
+    assert b.state == CLOSED  # too few calls to judge
+    b.record(True, 0.1)
+    assert b.state == OPEN
+    with pytest.raises(CircuitOpen) as raised:
+        b.admit()
+    assert raised.value.retry_after == pytest.approx(10.0)
+
+
+def test_slow_calls_count_as_failures(clock):
+    b = breaker(clock, min_calls=2)
+    b.record(False, 6.0)
+    b.record(False, 6.0)
+    assert b.state == OPEN
+
+
+def test_old_outcomes_leave_the_window(clock):
+    b = breaker(clock)
+    for _ in range(3):
+        b.record(True, 0.1)
+    clock.now = 31.0
+    b.record(True, 0.1)
+    assert b.state == CLOSED
+    assert b.stats()["calls"] == 1
+
+
+def test_half_open_lets_one_probe_through_and_closes_on_success(clock):
+    b = breaker(clock, min_calls=1)
+    b.record(True, 0.1)
+    clock.now = 10.0
+    probe = b.admit()
+    assert probe is True and b.state == HALF_OPEN
+    with pytest.raises(CircuitOpen):
+        b.admit()  # only one probe at a time
+    b.record(False, 0.1)
+    b.release(probe)
+    assert b.state == CLOSED
+    assert b.admit() is False
+
+
+def test_failed_probe_opens_again(clock):
+    b = breaker(clock, min_calls=1)
+    b.record(True, 0.1)
+    clock.now = 10.0
+    probe = b.admit()
+    b.record(True, 0.1)
+    b.release(probe)
+    assert b.state == OPEN
+    assert b.opened_at == 10.0
+
+
+def test_one_revalidation_at_a_time(clock):
+    b = breaker(clock, min_calls=1)
+    b.record(True, 0.1)
+    assert b.start_revalidation() is False  # not due yet
+    clock.now = 10.0
+    assert b.start_revalidation() is True
+    assert b.start_revalidation() is False
+    b.end_revalidation()
+    assert b.start_revalidation() is True
+
+
+def get_task(client, task_id):
+    return client.post("/tasks/manage", json={"action": "get", "task_id": task_id})
+
+
+def test_an_outage_serves_the_last_good_response(client, todoist, monkeypatch):
+    task_id = todoist.account["tasks"][0]["id"]
+    monkeypatch.setenv("CACHE_TTL_SECONDS", "0")
+    first = get_task(client, task_id)
+    assert first.status_code == 200 and first.json["id"] == task_id
+
+    todoist.settings.error_rate = 1.0
+    stale = get_task(client, task_id)
+    assert stale.status_code == 200
+    assert stale.json == first.json
+    assert "X-Stale" in stale.headers
+
+
+def test_coalesced_reads_all_get_the_last_good_response(client, todoist, monkeypatch):
+    import main
+    task_id = todoist.account["tasks"][0]["id"]
+    monkeypatch.setenv("CACHE_TTL_SECONDS", "0")
+    assert get_task(client, task_id).json["id"] == task_id  # read in full, so it is kept
+
+    # Slow failures, so the identical reads below wait on one upstream call
+    todoist.settings.error_rate = 1.0
+    todoist.settings.latency_ms = 300
+    responses = []
+
+    def read():
+        test_client = main.app.test_client()
+        response = test_client.post("/tasks/manage", json={"action": "get", "task_id": task_id},
+                                    headers={"X-API-KEY": API_KEY})
+        responses.append((response.status_code, response.headers.get("X-Stale")))
+
+    threads = [threading.Thread(target=read) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert todoist.stats()["calls"]["GET /tasks/{id}"] < 7  # they did coalesce
+    assert [status for status, _ in responses] == [200] * 6
+    assert all(stale is not None for _, stale in responses)
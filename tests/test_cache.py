@@ -0,0 +1,89 @@
+import time
+
+from cache import ResponseCache
+
+NAMESPACE = "Bearer test-token"
+
+
+def cached(cache, *paths):
+    """Which of `paths` are still cached."""
+    return [path for path in paths if cache.get(cache.make_key(NAMESPACE, path)) is not None]
+
+
+def fill(cache, *paths):
+    for path in paths:
+        cache.set(cache.make_key(NAMESPACE, path), 200, b"[]", "application/json")
+
+
+def test_params_are_part_of_the_key():
+    cache = ResponseCache()
+    cache.set(cache.make_key(NAMESPACE, "/tasks", {"project_id": "1", "label": None}), 200, b"[1]", "application/json")
+    assert cache.get(cache.make_key(NAMESPACE, "/tasks", {"project_id": "1"})).body == b"[1]"
+    assert cache.get(cache.make_key(NAMESPACE, "/tasks", {"project_id": "2"})) is None
+    assert cache.get(cache.make_key("Bearer other", "/tasks", {"project_id": "1"})) is None
+
+
+def test_entries_expire():
+    cache = ResponseCache(ttl=0.05)
+    fill(cache, "/tasks")
+    time.sleep(0.06)
+    assert cached(cache, "/tasks") == []
+    assert cache.stats()["expirations"] == 1
+
+
+def test_least_recently_used_entries_go_first():
+    cache = ResponseCache(max_entries=2)
+    fill(cache, "/tasks", "/projects")
+    cached(cache, "/tasks")
+    fill(cache, "/labels")
+    assert cached(cache, "/tasks", "/projects", "/labels") == ["/tasks", "/labels"]
+
+
+def test_byte_limits():
+    cache = ResponseCache(max_bytes=10, max_entry_bytes=8)
+    assert cache.set(cache.make_key(NAMESPACE, "/a"), 200, b"x" * 9, "application/json") is False
+    cache.set(cache.make_key(NAMESPACE, "/a"), 200, b"x" * 6, "application/json")
+    cache.set(cache.make_key(NAMESPACE, "/b"), 200, b"x" * 6, "application/json")
+    assert cached(cache, "/a", "/b") == ["/b"]
+    assert cache.stats()["bytes"] == 6
+
+
+def test_a_read_that_started_before_a_write_is_not_stored():
+    cache = ResponseCache()
+    generation = cache.generation(NAMESPACE)
+    cache.invalidate(NAMESPACE, "POST", "/tasks/1")
+    assert cache.set(cache.make_key(NAMESPACE, "/tasks/1"), 200, b"{}", "application/json", generation) is False
+
+
+def test_a_write_evicts_its_object_and_collection():
+    cache = ResponseCache()
+    fill(cache, "/tasks", "/tasks/1", "/tasks/2", "/projects")
+    assert cache.invalidate(NAMESPACE, "POST", "/tasks/1/close") == 2
+    assert cached(cache, "/tasks", "/tasks/1", "/tasks/2", "/projects") == ["/tasks/2", "/projects"]
+
+
+def test_deleting_a_project_cascades():
+    cache = ResponseCache()
+    fill(cache, "/projects/1", "/projects/1/collaborators", "/sections", "/tasks/5", "/comments", "/labels")
+    cache.invalidate(NAMESPACE, "DELETE", "/projects/1")
+    assert cached(cache, "/projects/1", "/projects/1/collaborators", "/sections", "/tasks/5", "/comments",
+                  "/labels") == ["/labels"]
+
+
+def test_renaming_a_label_evicts_tasks():
+    cache = ResponseCache()
+    fill(cache, "/tasks", "/tasks/1", "/projects")
+    cache.invalidate(NAMESPACE, "POST", "/labels/3")
+    assert cached(cache, "/tasks", "/tasks/1", "/projects") == ["/projects"]
+
+
+def test_reads_are_served_from_the_cache_until_a_write(client, todoist):
+    task_id = todoist.account["tasks"][0]["id"]
+    get = {"action": "get", "task_id": task_id}
+    assert client.post("/tasks/manage", json=get).json["id"] == task_id
+    hit = client.post("/tasks/manage", json=get)
+    assert hit.headers["X-Cache"] == "HIT" and hit.json["id"] == task_id
+
+    assert client.post("/tasks/manage", json={"action": "update", "task_id": task_id, "priority": 3}).status_code == 200
+    assert "X-Cache" not in client.post("/tasks/manage", json=get).headers
+    assert todoist.stats()["calls"] == {"GET /tasks/{id}": 2, "POST /tasks/{id}": 1}
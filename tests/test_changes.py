@@ -0,0 +1,102 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+
+import pytest
+
+from changes import ChangeFeed, get_feed, long_poll_async, receive_webhook
+
+SECRET = "client-secret"
+NAMESPACE = "Bearer test-token"
+
+
+@pytest.fixture
+def secret(monkeypatch):
+    monkeypatch.setenv("TODOIST_CLIENT_SECRET", SECRET)
+
+
+def sign(body, secret=SECRET):
+    return base64.b64encode(hmac.new(secret.encode(), body, hashlib.sha256).digest()).decode()
+
+
+def delivery(event="item:updated", **data):
+    return json.dumps({"event_name": event, "user_id": "2671355", "triggered_at": "2026-01-01T00:00:00Z",
+                       "event_data": dict({"id": "123", "content": "Buy milk"}, **data)}).encode()
+
+
+def test_reads_see_only_their_namespace():
+    feed = ChangeFeed(start=100)
+    feed.publish(NAMESPACE, "item:added", {"id": "1"})
+    feed.publish("Bearer other", "item:added", {"id": "2"})
+    batch = feed.read(NAMESPACE, 100)
+    assert [json.loads(change.encoded)["id"] for change in batch.changes] == ["1"]
+    assert batch.next == 102 and not batch.reset
+
+
+def test_a_client_behind_the_buffer_is_reset():
+    feed = ChangeFeed(size=2, start=100)
+    for _ in range(3):
+        feed.publish(NAMESPACE, "item:added", {})
+    assert feed.read(NAMESPACE, 100).reset
+    assert not feed.read(NAMESPACE, 101).reset
+    assert feed.read(NAMESPACE, 999).reset  # from another process, or before a restart
+
+
+def test_a_redelivery_is_not_added_again():
+    feed = ChangeFeed(start=0)
+    assert feed.publish(NAMESPACE, "item:added", {}, delivery_id="d1") == 1
+    assert feed.publish(NAMESPACE, "item:added", {}, delivery_id="d1") is None
+
+
+def test_an_async_long_poll_wakes_on_a_publish():
+    feed = ChangeFeed(start=0)
+
+    async def poll_then_publish():
+        poll = asyncio.create_task(long_poll_async(feed, NAMESPACE, 0, 5.0))
+        await asyncio.sleep(0.05)
+        feed.publish(NAMESPACE, "item:added", {"id": "1"})
+        return json.loads(await asyncio.wait_for(poll, 1.0))
+
+    body = asyncio.run(poll_then_publish())
+    assert body["next"] == 1 and [change["id"] for change in body["changes"]] == ["1"]
+
+
+def test_webhooks_are_off_without_a_secret():
+    body = delivery()
+    assert receive_webhook(body, sign(body))[0] == 404
+
+
+def test_a_bad_signature_is_rejected(secret):
+    body = delivery()
+    assert receive_webhook(body, sign(body, "wrong"))[0] == 401
+    assert receive_webhook(body, None)[0] == 401
+    assert get_feed().read(NAMESPACE, None).changes == []
+
+
+def test_a_signed_delivery_is_published_to_its_tenant(secret):
+    since = get_feed().seq
+    body = delivery()
+    status, answer = receive_webhook(body, sign(body), "d1")
+    assert status == 200 and answer["accepted"]
+    change = json.loads(get_feed().read(NAMESPACE, since).changes[0].encoded)
+    assert change["event"] == "item:updated" and change["resource"] == "tasks" and change["id"] == "123"
+    assert receive_webhook(body, sign(body), "d1")[1]["duplicate"]
+
+
+def test_wsgi_answers_a_long_poll_at_once(client, secret):
+    since = get_feed().seq
+    body = delivery()
+    receive_webhook(body, sign(body))
+    answer = client.get(f"/changes?since={since}&timeout=30")
+    assert answer.status_code == 200
+    assert [change["id"] for change in answer.json["changes"]] == ["123"]
+    # Nothing new: an empty answer rather than a wait
+    assert client.get(f"/changes?since={answer.json['next']}&timeout=30").json["changes"] == []
+
+
+def test_wsgi_refuses_event_streams(client):
+    assert client.get("/changes?stream=sse").status_code == 501
+    assert client.get("/changes", headers={"Accept": "text/event-stream"}).status_code == 501
+    assert client.get("/changes?since=x").status_code == 400
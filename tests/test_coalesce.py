@@ -0,0 +1,76 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import main
+from coalesce import SharedFlights, SingleFlight
+from conftest import API_KEY
+
+KEY = ("Bearer test-token", "/tasks", ())
+
+
+def test_the_first_caller_leads_and_the_rest_wait():
+    flights = SingleFlight()
+    flight, leading = flights.join(KEY)
+    same, following = flights.join(KEY)
+    assert leading and not following and same is flight
+    flights.land(KEY, flight, result="body")
+    assert same.wait(0) == "body"
+    assert flights.join(KEY)[1]  # nothing is kept once the call lands
+
+
+def test_waiters_get_the_leaders_error():
+    flights = SingleFlight()
+    flight, _ = flights.join(KEY)
+    flights.land(KEY, flight, error=ValueError("down"))
+    with pytest.raises(ValueError):
+        flight.wait(0)
+
+
+def test_async_waiters_wake_when_the_call_lands():
+    flights = SingleFlight()
+    flight, _ = flights.join(KEY)
+    threading.Timer(0.05, flights.land, (KEY, flight), {"result": "body"}).start()
+    assert asyncio.run(flight.wait_async(1.0)) == "body"
+
+
+def test_a_wait_that_times_out_goes_upstream_itself():
+    flight, _ = SingleFlight().join(KEY)
+    assert flight.wait(0.01) is None
+
+
+def test_workers_share_a_call_through_the_directory(tmp_path):
+    leader, follower = SharedFlights(str(tmp_path)), SharedFlights(str(tmp_path), wait_timeout=1.0)
+    fd = leader.try_lead(KEY)
+    assert fd is not None and follower.try_lead(KEY) is None
+    arrived = time.time()
+    threading.Timer(0.05, leader.publish, (KEY, fd, 200, "application/json", b"[]")).start()
+    assert follower.follow(KEY, arrived) == (200, "application/json", b"[]")
+
+
+def test_a_body_published_before_arriving_is_not_used(tmp_path):
+    flights = SharedFlights(str(tmp_path))
+    flights.publish(KEY, flights.try_lead(KEY), 200, "application/json", b"[]")
+    assert flights.follow(KEY, time.time() + 1) is None
+
+
+def test_identical_concurrent_reads_make_one_call(todoist, monkeypatch):
+    monkeypatch.setenv("CACHE_TTL_SECONDS", "0")
+    todoist.settings.latency_ms = 200
+    responses = []
+
+    def read():
+        response = main.app.test_client().post("/projects/manage", json={"action": "list"},
+                                               headers={"X-API-KEY": API_KEY})
+        assert isinstance(response.json, list)  # the leader shares its body once it has been read
+        responses.append((response.status_code, response.headers.get("X-Coalesced")))
+
+    threads = [threading.Thread(target=read) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert todoist.stats()["calls"] == {"GET /projects": 1}
+    assert sorted(responses, key=lambda r: r[1] or "") == [(200, None)] + [(200, "worker")] * 4
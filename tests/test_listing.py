@@ -0,0 +1,78 @@
+import pytest
+
+from listing import LIST_MAX_LIMIT, apply_view, parse_list_view
+
+ITEMS = [{"id": str(i), "order": 10 - i, "content": f"task {i}", "priority": 1} for i in (9, 10, 2, 100, 1)]
+
+
+def pages(data, items=ITEMS, resource="tasks"):
+    """Every page of `items` under the list request `data`, following next_cursor."""
+    found = []
+    while True:
+        page = apply_view(parse_list_view(data, resource), items)
+        found.append([item["id"] for item in page["items"]])
+        if page["next_cursor"] is None:
+            return found
+        data = dict(data, cursor=page["next_cursor"])
+
+
+def test_nothing_asked_means_no_view():
+    assert parse_list_view({"project_id": "1"}, "tasks") is None
+
+
+def test_fields_keep_the_id():
+    view = parse_list_view({"fields": "content, content"}, "tasks")
+    assert view.fields == ("id", "content")
+    assert apply_view(view, ITEMS[:1]) == [{"id": "9", "content": "task 9"}]
+
+
+def test_ids_page_in_numeric_order():
+    assert pages({"limit": 2}) == [["1", "2"], ["9", "10"], ["100"]]
+
+
+def test_manual_order_pages():
+    assert pages({"limit": 3, "order_by": "order"}) == [["100", "10", "9"], ["2", "1"]]
+
+
+def test_pages_survive_inserts_and_deletes():
+    first = apply_view(parse_list_view({"limit": 2}, "tasks"), ITEMS)
+    changed = [item for item in ITEMS if item["id"] != "9"] + [{"id": "3"}, {"id": "0"}]
+    rest = apply_view(parse_list_view({"limit": 10, "cursor": first["next_cursor"]}, "tasks"), changed)
+    assert [item["id"] for item in rest["items"]] == ["3", "10", "100"]
+
+
+def test_a_cursor_alone_pages_at_the_max():
+    cursor = apply_view(parse_list_view({"limit": 1}, "tasks"), ITEMS)["next_cursor"]
+    assert parse_list_view({"cursor": cursor}, "tasks").limit == LIST_MAX_LIMIT
+
+
+@pytest.mark.parametrize("data", [
+    {"limit": 0}, {"limit": LIST_MAX_LIMIT + 1}, {"limit": True}, {"limit": "-1"},
+    {"fields": []}, {"fields": [1]},
+    {"order_by": "due"},
+    {"cursor": "not a cursor"}, {"cursor": "eyJvIjoiaWQiLCJrIjpbMV19"},
+])
+def test_invalid_views_are_refused(data):
+    with pytest.raises(ValueError):
+        parse_list_view(data, "tasks")
+
+
+def test_a_cursor_is_tied_to_its_ordering():
+    cursor = apply_view(parse_list_view({"limit": 1}, "tasks"), ITEMS)["next_cursor"]
+    with pytest.raises(ValueError):
+        parse_list_view({"cursor": cursor, "order_by": "order"}, "tasks")
+
+
+def test_comments_have_no_manual_order():
+    with pytest.raises(ValueError):
+        parse_list_view({"order_by": "order"}, "comments")
+
+
+def test_a_paged_list_through_the_api(client, todoist):
+    response = client.post("/tasks/manage", json={"action": "list", "limit": 5, "fields": ["content"]})
+    page = response.json
+    assert len(page["items"]) == 5 and set(page["items"][0]) == {"id", "content"}
+    following = client.post("/tasks/manage", json={"action": "list", "limit": 5, "cursor": page["next_cursor"]}).json
+    assert int(following["items"][0]["id"]) > int(page["items"][-1]["id"])
+    assert todoist.stats()["calls"] == {"GET /tasks": 1}  # the second page came from the cache
+    assert client.post("/tasks/manage", json={"action": "list", "limit": 0}).status_code == 400
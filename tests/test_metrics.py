@@ -0,0 +1,35 @@
+from metrics import REQUEST_LATENCY, REGISTRY, Registry
+
+
+def observed(endpoint, action):
+    labels = (("endpoint", endpoint), ("action", action))
+    return next((value for name, sample_labels, value in REQUEST_LATENCY.samples()
+                 if name == "gtd_request_duration_seconds_count" and sample_labels == labels), 0)
+
+
+def test_rendering():
+    registry = Registry()
+    registry.counter("hits_total", "Hits.", ("path",)).inc(path='/a"b')
+    registry.histogram("wait_seconds", "Waits.", buckets=(0.1, 1.0)).observe(0.5)
+    text = registry.render()
+    assert 'hits_total{path="/a\\"b"} 1' in text
+    assert 'wait_seconds_bucket{le="0.1"} 0' in text and 'wait_seconds_bucket{le="1"} 1' in text
+    assert 'wait_seconds_bucket{le="+Inf"} 1' in text and "wait_seconds_count 1" in text
+
+
+def test_a_streamed_response_is_timed_once_its_body_is_done(client, todoist):
+    task_id = todoist.account["tasks"][0]["id"]
+    before = observed("/tasks/manage", "get")
+    response = client.post("/tasks/manage", json={"action": "get", "task_id": task_id}, buffered=False)
+    assert response.is_streamed
+    assert observed("/tasks/manage", "get") == before  # the body hasn't been sent yet
+    assert response.get_json()["id"] == task_id
+    response.close()
+    assert observed("/tasks/manage", "get") == before + 1
+
+
+def test_the_scrape_endpoint(client):
+    client.get("/metrics")
+    text = client.get("/metrics").get_data(as_text=True)
+    assert 'gtd_requests_total{endpoint="/metrics",action="",status="200"}' in text
+    assert REGISTRY.render().startswith("# HELP")
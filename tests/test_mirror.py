@@ -0,0 +1,90 @@
+import json
+
+import pytest
+import requests
+
+import mirror
+from mirror import Mirror
+
+
+class SyncServer:
+    """Answers Sync API reads with queued payloads, recording the sync tokens asked with."""
+
+    def __init__(self, *payloads):
+        self.payloads = list(payloads)
+        self.tokens = []
+
+    def request(self, method, path, data=None, **kwargs):
+        self.tokens.append(data["sync_token"])
+        resp = requests.Response()
+        resp.status_code, resp._content = 200, json.dumps(self.payloads.pop(0)).encode()
+        return resp
+
+
+FULL = {
+    "full_sync": True, "sync_token": "t1",
+    "projects": [{"id": "p1", "name": "Home", "child_order": 1}],
+    "sections": [{"id": "s1", "project_id": "p1", "name": "Kitchen"}],
+    "labels": [{"id": "l1", "name": "errand"}],
+    "items": [{"id": "i1", "project_id": "p1", "section_id": "s1", "content": "Milk", "labels": ["errand"],
+               "child_order": 2, "due": {"date": "2026-01-02T10:00:00", "string": "tomorrow at 10"}},
+              {"id": "i2", "project_id": "p1", "content": "Bread", "child_order": 1}],
+    "notes": [{"id": "n1", "item_id": "i1", "content": "2%", "posted_at": "2026-01-01"}],
+}
+
+
+@pytest.fixture
+def synced(monkeypatch):
+    server = SyncServer(FULL)
+    monkeypatch.setattr(mirror, "get_client", lambda: server)
+    copy = Mirror("test-token", sync_base="http://sync")
+    assert copy.sync_once()
+    return copy, server
+
+
+def read(copy, path, **params):
+    body = copy.answer(path, params)
+    return None if body is None else json.loads(body)
+
+
+def test_a_full_sync_is_served_in_rest_shape(synced):
+    copy, _ = synced
+    milk = read(copy, "/tasks/i1")
+    assert milk["content"] == "Milk" and milk["comment_count"] == 1
+    assert milk["due"] == {"string": "tomorrow at 10", "date": "2026-01-02", "is_recurring": False,
+                           "datetime": "2026-01-02T10:00:00"}
+    assert [t["id"] for t in read(copy, "/tasks", project_id="p1")] == ["i2", "i1"]
+    assert [t["id"] for t in read(copy, "/tasks", label_id="l1")] == ["i1"]
+    assert [c["id"] for c in read(copy, "/comments", task_id="i1")] == ["n1"]
+    assert read(copy, "/tasks", filter="today") is None  # Todoist's filter language stays upstream
+
+
+def test_changes_are_pulled_from_the_last_sync_token(synced, monkeypatch):
+    copy, server = synced
+    server.payloads.append({"sync_token": "t2", "items": [{"id": "i2", "is_deleted": True},
+                                                          {"id": "i1", "project_id": "p1", "content": "Oat milk"}]})
+    copy.sync_once()
+    assert server.tokens == ["*", "t1"]
+    assert [t["content"] for t in read(copy, "/tasks")] == ["Oat milk"]
+
+
+def test_deleting_a_project_removes_what_was_in_it(synced):
+    copy, _ = synced
+    copy.apply_write("DELETE", "/projects/p1", None)
+    assert read(copy, "/tasks") == [] and read(copy, "/sections") == []
+    assert read(copy, "/comments", task_id="i1") == []
+
+
+def test_writes_through_the_proxy_apply_at_once(synced):
+    copy, _ = synced
+    copy.apply_write("POST", "/tasks", {"id": "i3", "project_id": "p1", "content": "Eggs", "is_completed": False,
+                                        "labels": [], "order": 3})
+    copy.apply_write("POST", "/tasks/i2/close", None)
+    assert [t["id"] for t in read(copy, "/tasks", project_id="p1")] == ["i1", "i3"]
+    assert copy._wake.is_set()  # a close may move a recurring task's due date; resync
+
+
+def test_a_stale_mirror_does_not_answer(synced):
+    copy, _ = synced
+    copy.last_sync -= copy.max_staleness + 1
+    assert copy.answer("/tasks") is None
@@ -0,0 +1,116 @@
+import time
+
+import pytest
+
+import auth
+from actions import UpstreamCall
+from outbox import IdempotencyConflict, Outbox, accept, object_key
+
+
+@pytest.fixture
+def journal(tmp_path):
+    return Outbox(db_path=str(tmp_path / "outbox.db"), retry_backoff=0.01)
+
+
+def tenant():
+    return auth.get_registry().tenants[0]
+
+
+def drain(journal):
+    """Flushes until nothing is due, as the flush thread does; returns how many attempts were made."""
+    sent = total = journal.flush_once()
+    while sent:
+        sent = journal.flush_once()
+        total += sent
+    return total
+
+
+def update(task_id, **fields):
+    return UpstreamCall("POST", f"/tasks/{task_id}", None, fields or {"priority": 4})
+
+
+def test_object_key_groups_actions_on_one_object():
+    assert object_key("/tasks/123") == "/tasks/123"
+    assert object_key("/tasks/123/close") == "/tasks/123"
+    assert object_key("/tasks") is None
+
+
+def test_a_retrying_update_holds_back_a_later_close_of_the_same_task(journal):
+    first, _ = journal.enqueue("default", "tasks", "update", update("123"))
+    journal.enqueue("default", "tasks", "status", UpstreamCall("POST", "/tasks/123/close"))
+    journal.enqueue("default", "tasks", "create", UpstreamCall("POST", "/tasks", None, {"content": "x"}))
+    journal.enqueue("default", "tasks", "update", update("456"))
+    journal._db.execute("UPDATE operations SET next_attempt_at = ? WHERE key = ?",
+                        (time.time() + 60, first["idempotency_key"]))
+
+    blocked = set()
+    claimed = [journal._claim(blocked)["path"], journal._claim(blocked)["path"]]
+    assert claimed == ["/tasks", "/tasks/456"]
+    assert journal._claim(blocked) is None
+
+
+def test_a_flush_reads_each_row_once(journal, monkeypatch):
+    for task_id in range(5):
+        journal.enqueue("default", "tasks", "update", update(str(task_id)))
+    claims = []
+    monkeypatch.setattr(journal, "_send", lambda op: claims.append(op["seq"]))
+    original = journal._claim
+    monkeypatch.setattr(journal, "_claim", lambda blocked, after: claims.append(after) or original(blocked, after))
+    assert journal.flush_once() == 5
+    assert claims == [0, 1, 1, 2, 2, 3, 3, 4, 4, 5, 5]  # each claim resumes after the row claimed before it
+
+
+def test_idempotency_key_returns_the_same_operation(journal):
+    operation, created = journal.enqueue("default", "tasks", "update", update("1"), key="k1")
+    again, created_again = journal.enqueue("default", "tasks", "update", update("1"), key="k1")
+    assert created and not created_again
+    assert again["idempotency_key"] == operation["idempotency_key"] == "k1"
+    with pytest.raises(IdempotencyConflict):
+        journal.enqueue("default", "tasks", "update", update("1", priority=1), key="k1")
+
+
+def test_operations_are_scoped_to_their_tenant(journal):
+    journal.enqueue("default", "tasks", "update", update("1"), key="k1")
+    assert journal.lookup("default", "k1")["state"] == "pending"
+    assert journal.lookup("someone-else", "k1") is None
+    assert journal.summary("someone-else")["counts"] == {"pending": 0, "applied": 0, "failed": 0}
+
+
+def test_tenants_do_not_share_idempotency_keys(journal):
+    journal.enqueue("default", "tasks", "update", update("1"), key="k1")
+    theirs, created = journal.enqueue("someone-else", "tasks", "update", update("2"), key="k1")
+    assert created and journal.lookup("someone-else", "k1") == theirs
+    assert [len(journal.summary(name)["operations"]) for name in ("default", "someone-else")] == [1, 1]
+
+
+def test_the_journal_never_holds_the_token(journal, tmp_path):
+    status, operation = accept(journal, tenant(), "tasks", "update", update("1"), key="k1")
+    assert status == 202
+    journal._db.close()
+    assert b"test-token" not in (tmp_path / "outbox.db").read_bytes()
+
+
+def test_flush_sends_with_the_tenants_current_headers(journal, todoist):
+    task_id = todoist.account["tasks"][0]["id"]
+    journal.enqueue("default", "tasks", "update", update(task_id), key="k1")
+    journal.enqueue("gone", "tasks", "update", update(task_id), key="k2")
+    assert drain(journal) == 2
+    assert journal.lookup("default", "k1")["state"] == "applied"
+    orphan = journal.lookup("gone", "k2")
+    assert orphan["state"] == "failed" and "no longer configured" in orphan["error"]
+    assert todoist.stats()["calls"] == {"POST /tasks/{id}": 1}
+
+
+def test_failed_attempts_are_retried_in_order(journal, todoist):
+    task_id = todoist.account["tasks"][0]["id"]
+    journal.enqueue("default", "tasks", "update", update(task_id), key="k1")
+    journal.enqueue("default", "tasks", "status", UpstreamCall("POST", f"/tasks/{task_id}/close"), key="k2")
+    todoist.settings.error_rate = 1.0
+    assert drain(journal) == 1  # the close waits behind the update
+    assert journal.lookup("default", "k1")["attempts"] == 1
+    assert journal.lookup("default", "k2")["attempts"] == 0
+
+    todoist.settings.error_rate = 0.0
+    time.sleep(0.05)
+    assert drain(journal) == 2
+    assert todoist.stats()["calls"] == {"POST /tasks/{id}": 2, "POST /tasks/{id}/close": 1}
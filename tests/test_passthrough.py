@@ -0,0 +1,59 @@
+import json
+
+from todoist import _Passthrough
+
+
+class Body:
+    def __init__(self, *chunks):
+        self.chunks = chunks
+        self.closed = 0
+
+    def iter_content(self, size):
+        return iter(self.chunks)
+
+    def close(self):
+        self.closed += 1
+
+
+def passthrough(body, limit=100):
+    reported = []
+    return _Passthrough(body, limit, reported.append), reported
+
+
+def test_a_body_read_to_the_end_is_reported_whole():
+    body = Body(b"ab", b"cd")
+    chunks, reported = passthrough(body)
+    assert list(chunks) == [b"ab", b"cd"]
+    chunks.close()
+    assert reported == [b"abcd"] and body.closed == 1
+
+
+def test_a_body_abandoned_halfway_is_not_kept():
+    body = Body(b"ab", b"cd")
+    chunks, reported = passthrough(body)
+    next(iter(chunks))
+    chunks.close()
+    assert reported == [None] and body.closed == 1
+
+
+def test_a_body_over_the_limit_is_sent_but_not_kept():
+    chunks, reported = passthrough(Body(b"ab", b"cd"), limit=3)
+    assert b"".join(chunks) == b"abcd"
+    assert reported == [None]
+
+
+def test_the_upstream_body_is_passed_through_as_is(client, todoist):
+    task = todoist.account["tasks"][0]
+    response = client.post("/tasks/manage", json={"action": "get", "task_id": task["id"]}, buffered=False)
+    assert response.is_streamed and response.content_type == "application/json"
+    assert json.loads(response.get_data()) == task
+    response.close()
+
+
+def test_an_abandoned_response_is_not_cached(client, todoist):
+    get = {"action": "get", "task_id": todoist.account["tasks"][0]["id"]}
+    client.post("/tasks/manage", json=get, buffered=False).close()
+    second = client.post("/tasks/manage", json=get)
+    assert "X-Cache" not in second.headers and second.json["id"] == get["task_id"]  # read in full, so kept
+    assert client.post("/tasks/manage", json=get).headers["X-Cache"] == "HIT"
+    assert todoist.stats()["calls"] == {"GET /tasks/{id}": 2}
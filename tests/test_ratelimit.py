@@ -0,0 +1,133 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests
+
+from ratelimit import BACKGROUND, BULK, INTERACTIVE, RateLimited, RateLimiter, classify
+from upstream import UpstreamClient
+
+HEADERS = {"Authorization": "Bearer test-token"}
+
+
+def response(status, **headers):
+    resp = requests.Response()
+    resp.status_code = status
+    resp.headers.update(headers)
+    return resp
+
+
+def test_collection_reads_are_bulk():
+    assert classify("GET", "/tasks") == BULK
+    assert classify("GET", "/projects/1/collaborators") == BULK
+    assert classify("GET", "/tasks/1") == INTERACTIVE
+    assert classify("POST", "/tasks") == INTERACTIVE
+
+
+def test_the_bucket_refills_at_the_budget_rate():
+    limiter = RateLimiter(requests_per_window=2, window=0.2, max_wait=1.0)
+    assert limiter.acquire("a") == 0.0
+    assert limiter.acquire("a") == 0.0
+    assert limiter.acquire("a") == pytest.approx(0.1, abs=0.05)
+    assert limiter.acquire("b") == 0.0  # every credential has its own bucket
+
+
+def test_a_wait_past_the_deadline_is_refused_up_front():
+    limiter = RateLimiter(requests_per_window=1, window=60.0, max_wait=1.0)
+    limiter.acquire("a")
+    with pytest.raises(RateLimited) as raised:
+        limiter.acquire("a")
+    assert raised.value.retry_after == pytest.approx(60.0, rel=0.01)
+    assert limiter.stats()["rejected"] == 1
+
+
+def test_queued_calls_go_in_priority_order():
+    limiter = RateLimiter(requests_per_window=1, window=0.3, max_wait=5.0)
+    limiter.acquire("a")
+    granted = []
+
+    def acquire(priority):
+        limiter.acquire("a", priority)
+        granted.append(priority)
+
+    threads = []
+    for priority in (BACKGROUND, BULK, INTERACTIVE):
+        threads.append(threading.Thread(target=acquire, args=(priority,)))
+        threads[-1].start()
+        time.sleep(0.02)  # queued in this order
+    for thread in threads:
+        thread.join()
+    assert granted == [INTERACTIVE, BULK, BACKGROUND]
+
+
+class NoThreads(ThreadPoolExecutor):
+    def submit(self, *args, **kwargs):
+        raise AssertionError("an async waiter took a thread")
+
+
+def test_async_waiters_queue_on_the_loop_in_priority_order():
+    limiter = RateLimiter(requests_per_window=1, window=0.3, max_wait=5.0)
+    limiter.acquire("a")
+    granted = []
+
+    async def acquire(priority):
+        await limiter.acquire_async("a", priority)
+        granted.append(priority)
+
+    async def run():
+        asyncio.get_running_loop().set_default_executor(NoThreads())
+        waiters = []
+        for priority in (BACKGROUND, BULK, INTERACTIVE):
+            waiters.append(asyncio.create_task(acquire(priority)))
+            await asyncio.sleep(0.02)  # queued in this order
+        await asyncio.gather(*waiters)
+
+    asyncio.run(run())
+    assert granted == [INTERACTIVE, BULK, BACKGROUND]
+    assert limiter.stats()["waiting"] == {"interactive": 0, "bulk": 0, "background": 0}
+
+
+def test_an_async_waiter_gives_up_at_its_deadline():
+    limiter = RateLimiter(requests_per_window=1, window=0.3, max_wait=0.5)
+    limiter.acquire("a")
+
+    async def run():
+        waiter = asyncio.create_task(limiter.acquire_async("a"))
+        await asyncio.sleep(0.02)
+        limiter.observe("a", response(429, **{"Retry-After": "30"}))  # held closed after it queued
+        with pytest.raises(RateLimited):
+            await waiter
+
+    asyncio.run(run())
+    assert limiter.stats()["rejected"] == 1
+
+
+def test_todoist_headers_correct_the_bucket():
+    limiter = RateLimiter(requests_per_window=100, window=60.0, max_wait=0.0)
+    limiter.observe("a", response(200, **{"X-RateLimit-Remaining": "0"}))
+    assert limiter.try_acquire("a") is False
+
+    limiter.observe("b", response(429, **{"Retry-After": "30"}))
+    with pytest.raises(RateLimited) as raised:
+        limiter.acquire("b")
+    assert raised.value.retry_after >= 29
+    assert limiter.stats()["throttled"] == 1
+
+
+def test_a_429_is_resent_once_by_the_limiter_not_by_the_transport(todoist):
+    todoist.settings.rate_limit_rate = 1.0
+    todoist.settings.retry_after = 0
+    limiter = RateLimiter(requests_per_window=100, window=1.0, max_wait=1.0)
+    client = UpstreamClient(todoist.base_url, max_retries=2, backoff_factor=0.01, limiter=limiter)
+    assert client.request("GET", "/tasks/1", headers=HEADERS).status_code == 429
+    assert todoist.stats()["calls"] == {"GET /tasks/{id}": 2}
+
+
+def test_without_the_limiter_the_transport_retries_429s(todoist):
+    todoist.settings.rate_limit_rate = 1.0
+    todoist.settings.retry_after = 0
+    client = UpstreamClient(todoist.base_url, max_retries=2, backoff_factor=0.01)
+    assert client.request("GET", "/tasks/1", headers=HEADERS).status_code == 429
+    assert todoist.stats()["calls"] == {"GET /tasks/{id}": 3}
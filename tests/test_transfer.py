@@ -0,0 +1,114 @@
+import io
+import json
+
+import pytest
+import requests
+
+import batch
+import transfer
+
+
+def records(body):
+    return [json.loads(line) for line in body.splitlines()]
+
+
+def ndjson(*lines):
+    return b"".join(json.dumps(line).encode() + b"\n" for line in lines)
+
+
+def test_parents_come_before_their_children():
+    items = [{"id": "c", "parent_id": "b", "order": 1}, {"id": "b", "order": 2}, {"id": "a", "order": 1},
+             {"id": "d", "parent_id": "gone", "order": 3}]
+    assert [item["id"] for item in transfer._parents_first(items)] == ["a", "b", "c", "d"]
+
+
+def test_a_recurring_due_date_is_kept_as_its_text():
+    assert transfer._task_fields({"due": {"is_recurring": True, "string": "every day", "date": "2026-01-01"},
+                                  "duration": {"amount": 30, "unit": None}}) == \
+        {"due_string": "every day", "duration": 30, "duration_unit": "minute"}
+    assert transfer._task_fields({"due": {"date": "2026-01-01", "datetime": "2026-01-01T09:00:00"}}) == \
+        {"due_datetime": "2026-01-01T09:00:00"}
+
+
+def test_an_overlong_line_is_skipped_whole(monkeypatch):
+    monkeypatch.setattr(transfer, "MAX_LINE_BYTES", 8)
+    monkeypatch.setattr(transfer, "READ_BYTES", 4)
+    body = io.BytesIO(b"short\n" + b"x" * 20 + b"\nlast")
+    assert list(transfer._read_lines(body.read)) == [(1, b"short"), (2, None), (3, b"last")]
+
+
+def test_an_export_has_every_record_between_its_header_and_end(client, todoist):
+    lines = records(client.get("/export").get_data())
+    assert lines[0]["type"] == "export" and lines[0]["version"] == transfer.FORMAT_VERSION
+    assert lines[-1]["type"] == "end"
+    account = todoist.account
+    assert lines[-1]["counts"] == {"project": len(account["projects"]), "section": len(account["sections"]),
+                                   "label": len(account["labels"]), "task": len(account["tasks"]),
+                                   "comment": len(account["comments"])}
+    seen = set()
+    for line in lines[1:-1]:
+        if line["type"] == "task":
+            assert line["data"].get("parent_id") in seen | {None}
+            seen.add(line["data"]["id"])
+
+
+def test_an_export_without_comments_reads_only_the_collections(client, todoist):
+    lines = records(client.get("/export?comments=0").get_data())
+    assert lines[-1]["counts"]["comment"] == 0
+    assert todoist.stats()["calls"] == {"GET /projects": 1, "GET /sections": 1, "GET /labels": 1, "GET /tasks": 1}
+
+
+class SyncClient:
+    """Answers Sync API requests as Todoist would, mapping every temp id to a new id."""
+
+    def __init__(self):
+        self.sent = []
+
+    def request(self, method, path, data=None, **kwargs):
+        commands = json.loads(data["commands"])
+        self.sent.extend(commands)
+        payload = {"sync_status": {c["uuid"]: "ok" for c in commands},
+                   "temp_id_mapping": {c["temp_id"]: f"new-{len(self.sent)}-{i}"
+                                       for i, c in enumerate(commands) if "temp_id" in c}}
+        resp = requests.Response()
+        resp.status_code, resp._content = 200, json.dumps(payload).encode()
+        return resp
+
+
+@pytest.fixture
+def sync_client(monkeypatch):
+    client = SyncClient()
+    monkeypatch.setattr(batch, "get_client", lambda: client)
+    return client
+
+
+def test_an_import_maps_ids_onto_the_new_objects(client, todoist, sync_client, monkeypatch):
+    monkeypatch.setattr(transfer, "BATCH_SIZE", 2)
+    inbox = next(p for p in todoist.account["projects"] if p["is_inbox_project"])
+    body = ndjson({"type": "export", "version": 1},
+                  {"type": "project", "data": {"id": "1", "name": "Inbox", "is_inbox_project": True}},
+                  {"type": "label", "data": {"id": "2", "name": todoist.account["labels"][0]["name"]}},
+                  {"type": "project", "data": {"id": "3", "name": "Garden"}},
+                  {"type": "task", "data": {"id": "4", "content": "Mow", "project_id": "3"}},
+                  {"type": "task", "data": {"id": "5", "content": "Edges", "project_id": "3", "parent_id": "4"}},
+                  {"type": "task", "data": {"id": "6", "content": "Sort mail", "project_id": "1"}},
+                  {"type": "comment", "data": {"id": "7", "content": "?", "task_id": "99"}},
+                  {"type": "end", "counts": {}})
+    lines = records(client.post("/import", data=body, content_type=transfer.NDJSON).get_data())
+
+    adds = {command["args"].get("content") or command["args"].get("name"): command for command in sync_client.sent}
+    assert set(adds) == {"Garden", "Mow", "Edges", "Sort mail"}  # the inbox and the label already exist
+    first = [line for line in lines if line["type"] == "progress"][0]["ids"]
+    assert adds["Mow"]["args"]["project_id"] == adds["Garden"]["temp_id"]  # created in the same request
+    assert adds["Edges"]["args"]["project_id"] == first["project"]["3"]  # created by an earlier request
+    assert adds["Edges"]["args"]["parent_id"] == first["task"]["4"]
+    assert adds["Sort mail"]["args"]["project_id"] == inbox["id"]
+    assert [(line["line"], line["status"]) for line in lines if line["type"] == "error"] == [(8, 424)]
+    assert lines[-1] == dict(lines[-1], type="done", records=7, created=4, existing=2, failed=1)
+
+
+def test_an_import_of_an_unknown_version_stops(client, todoist, sync_client):
+    body = ndjson({"type": "export", "version": 2}, {"type": "project", "data": {"id": "1", "name": "x"}})
+    lines = records(client.post("/import", data=body).get_data())
+    assert lines[0]["type"] == "error" and lines[-1]["records"] == 0
+    assert sync_client.sent == []
@@ -0,0 +1,54 @@
+import io
+
+import pytest
+
+import uploads
+
+
+def upload(client, fields, data=b"hello, attachment", filename="notes.txt"):
+    form = dict(fields, file=(io.BytesIO(data), filename, "text/plain"))
+    return client.post("/comments/attachments", data=form, content_type="multipart/form-data")
+
+
+def test_upload_creates_a_comment_with_the_attachment(client, todoist):
+    task_id = todoist.account["tasks"][0]["id"]
+    data = b"x" * (3 * uploads.CHUNK_BYTES + 17)
+    response = upload(client, {"task_id": task_id, "content": "See attached"}, data=data, filename="report.pdf")
+    assert response.status_code == 200, response.data
+    comment = response.json
+    assert comment["task_id"] == task_id and comment["content"] == "See attached"
+    attachment = comment["attachment"]
+    assert attachment["file_name"] == "report.pdf"
+    assert attachment["file_size"] == len(data)
+    assert attachment["upload_state"] == "completed"
+    assert todoist.stats()["calls"] == {"POST /uploads/add": 1, "POST /comments": 1}
+
+
+def test_fields_are_validated_before_anything_is_uploaded(client, todoist):
+    response = upload(client, {"content": "No task or project"})
+    assert response.status_code == 400
+    assert "task_id" in response.json["error"]
+    assert todoist.stats()["total"] == 0
+
+
+def test_fields_after_the_file_are_refused(client, todoist):
+    boundary = "b0undary"
+    body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"a.txt\"\r\n\r\n"
+            f"data\r\n--{boundary}\r\nContent-Disposition: form-data; name=\"content\"\r\n\r\nlate\r\n"
+            f"--{boundary}--\r\n").encode()
+    response = client.post("/comments/attachments", data=body,
+                           content_type=f"multipart/form-data; boundary={boundary}")
+    assert response.status_code == 400
+    assert todoist.stats()["total"] == 0
+
+
+def test_a_file_over_the_limit_is_refused(client, todoist, monkeypatch):
+    monkeypatch.setattr(uploads, "MAX_BYTES", 1024)
+    response = upload(client, {"task_id": "1", "content": "Too big"}, data=b"x" * 4096)
+    assert response.status_code == 413
+
+
+@pytest.mark.parametrize("content_type", ["application/json", "multipart/form-data"])
+def test_only_multipart_bodies_are_accepted(client, content_type):
+    response = client.post("/comments/attachments", data=b"{}", content_type=content_type)
+    assert response.status_code == 415
@@ -0,0 +1,71 @@
+import time
+
+import pytest
+import requests
+
+import upstream
+from upstream import UpstreamClient, replayable
+
+HEADERS = {"Authorization": "Bearer test-token"}
+
+
+def test_failed_reads_are_retried(todoist):
+    todoist.settings.error_rate = 1.0
+    client = UpstreamClient(todoist.base_url, max_retries=2, backoff_factor=0.01)
+    assert client.request("GET", "/tasks", headers=HEADERS).status_code == 500
+    assert todoist.stats()["calls"] == {"GET /tasks": 3}
+
+
+def test_failed_writes_are_not_retried(todoist):
+    todoist.settings.error_rate = 1.0
+    client = UpstreamClient(todoist.base_url, max_retries=2, backoff_factor=0.01)
+    assert client.request("POST", "/tasks", headers=HEADERS, json_data={"content": "x"}).status_code == 500
+    assert todoist.stats()["calls"] == {"POST /tasks": 1}
+
+
+def test_a_long_retry_after_goes_back_to_the_caller(todoist):
+    todoist.settings.rate_limit_rate = 1.0
+    todoist.settings.retry_after = 60
+    client = UpstreamClient(todoist.base_url, max_retries=2, max_retry_after=1.0)
+    started = time.monotonic()
+    assert client.request("GET", "/tasks", headers=HEADERS).status_code == 429
+    assert time.monotonic() - started < 1.0
+    assert todoist.stats()["total"] == 1
+
+
+@pytest.mark.parametrize("retries", [0, 1])
+def test_a_slow_response_times_out(todoist, retries):
+    todoist.settings.latency_ms = 300
+    client = UpstreamClient(todoist.base_url, max_retries=retries, backoff_factor=0.01, read_timeout=0.05)
+    with pytest.raises(requests.exceptions.Timeout):
+        client.request("GET", "/tasks", headers=HEADERS)
+    assert todoist.stats()["total"] == retries + 1
+
+
+def test_the_client_is_told_about_a_timeout(client, todoist, monkeypatch):
+    monkeypatch.setenv("TODOIST_READ_TIMEOUT", "0.05")
+    todoist.settings.latency_ms = 300
+    assert client.post("/projects/manage", json={"action": "list"}).status_code == 504
+
+
+def test_connections_are_reused(todoist):
+    client = UpstreamClient(todoist.base_url)
+    for _ in range(5):
+        client.request("GET", "/projects", headers=HEADERS).content
+    stats = client.stats()
+    assert stats["requests_sent"] == 5
+    assert stats["connections_opened"] == 1 and stats["connections_reused"] == 4
+
+
+def test_every_tenant_gets_its_own_pool(todoist, monkeypatch):
+    monkeypatch.setattr(upstream, "MAX_TENANT_POOLS", 2)
+    client = UpstreamClient(todoist.base_url)
+    for token in ("a", "b", "c"):
+        client.request("GET", "/projects", headers={"Authorization": f"Bearer {token}"}).content
+    stats = client.stats()
+    assert stats["tenant_pools"] == 2 and stats["tenant_pools_closed"] == 1
+
+
+def test_only_buffered_bodies_can_be_replayed():
+    assert replayable(None) and replayable(b"x") and replayable({"a": 1})
+    assert not replayable(iter([b"x"]))
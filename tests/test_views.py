@@ -0,0 +1,83 @@
+import pytest
+
+from actions import ActionError
+from views import build, plan
+
+TODAY = "2026-03-10"
+RESOURCES = {
+    "projects": [{"id": "in", "name": "Inbox", "order": 0, "is_inbox_project": True},
+                 {"id": "p2", "name": "Garden", "order": 2},
+                 {"id": "p1", "name": "House", "order": 1},
+                 {"id": "p3", "name": "Someday", "order": 3}],
+    "sections": [{"id": "s1", "project_id": "p1", "name": "Kitchen", "order": 1}],
+    "labels": [{"name": "errand", "color": "red"}, {"name": "unused", "color": "blue"}],
+    "tasks": [
+        {"id": "t1", "project_id": "p1", "content": "Paint", "order": 1},
+        {"id": "t2", "project_id": "p1", "parent_id": "t1", "content": "Buy paint", "order": 2, "priority": 4,
+         "labels": ["errand"], "due": {"date": "2026-03-09"}},
+        {"id": "t3", "project_id": "p1", "section_id": "s1", "content": "Fix tap", "order": 3,
+         "due": {"date": "2026-03-12"}},
+        {"id": "t4", "project_id": "p2", "content": "Mow", "order": 1, "due": {"date": "2026-04-30"}},
+        {"id": "t5", "project_id": "in", "content": "Call Sam", "order": 1},
+    ],
+}
+
+
+def test_next_actions_leave_out_tasks_with_open_subtasks():
+    document = build("next-actions", {"today": TODAY}, RESOURCES)
+    inbox, house, garden = document["projects"]
+    assert [group["project"]["name"] for group in (inbox, house, garden)] == ["Inbox", "House", "Garden"]
+    assert [task["id"] for task in house["tasks"]] == ["t2", "t3"]  # most urgent first; t1 waits on t2
+    assert house["tasks"][0] == {"id": "t2", "content": "Buy paint", "priority": 4, "due": "2026-03-09",
+                                 "overdue": True, "labels": ["errand"]}
+    assert house["tasks"][1]["section"] == "Kitchen"
+    assert document["count"] == 4 and document["labels"] == {"errand": "red"}
+
+
+def test_a_project_nests_subtasks_under_their_sections():
+    resources = dict(RESOURCES, project=RESOURCES["projects"][2],
+                     tasks=[task for task in RESOURCES["tasks"] if task["project_id"] == "p1"])
+    document = build("project", {"today": TODAY}, resources)
+    assert [node["id"] for node in document["tasks"]] == ["t1"]
+    assert [node["id"] for node in document["tasks"][0]["subtasks"]] == ["t2"]
+    assert document["sections"] == [{"id": "s1", "name": "Kitchen", "tasks": [{"id": "t3", "content": "Fix tap",
+                                                                              "due": "2026-03-12"}]}]
+    assert document["open_tasks"] == 3
+
+
+def test_the_weekly_review_splits_dated_tasks_by_the_horizon():
+    document = build("weekly-review", {"today": TODAY, "days": "7"}, RESOURCES)
+    assert document["horizon"] == "2026-03-17"
+    assert [task["id"] for task in document["inbox"]] == ["t5"]
+    assert [(task["id"], task["project"]) for task in document["overdue"]] == [("t2", "House")]
+    assert [(task["id"], task["section"]) for task in document["upcoming"]] == [("t3", "Kitchen")]
+    house = document["projects"][0]
+    assert (house["open_tasks"], house["overdue"], house["undated"]) == (3, 1, 1)
+    assert house["next_action"]["id"] == "t3"  # the most urgent top-level task
+    assert document["stalled_projects"] == [{"id": "p3", "name": "Someday"}]
+
+
+def test_next_actions_read_only_what_was_asked_for():
+    calls = plan("next-actions", {"project_id": "p1", "label": "errand"})
+    assert calls["tasks"].params == {"project_id": "p1", "label": "errand"}
+    assert calls["sections"].params == {"project_id": "p1"}
+
+
+@pytest.mark.parametrize("view, args", [
+    ("next-actions", {"today": "10/03/2026"}),
+    ("weekly-review", {"days": "0"}),
+    ("weekly-review", {"days": "61"}),
+    ("project", {}),
+])
+def test_bad_arguments_are_refused_before_any_read(view, args):
+    with pytest.raises(ActionError) as raised:
+        plan(view, args)
+    assert raised.value.status == 400
+
+
+def test_views_through_the_api(client, todoist):
+    response = client.get("/views/weekly-review?today=2026-03-10")
+    assert response.status_code == 200 and response.json["view"] == "weekly-review"
+    assert todoist.stats()["calls"] == {"GET /projects": 1, "GET /sections": 1, "GET /labels": 1, "GET /tasks": 1}
+    assert client.get("/views/project/1").status_code == 404
+    assert client.get("/views/weekly-review?days=x").status_code == 400
@@ -0,0 +1,505 @@
+"""The path every Todoist REST call takes, independent of Flask.
+
+fetch_todoist() checks the local mirror and the response cache before going
+upstream through the pooled client, and keeps both up to date after
+successful writes. Identical GETs that miss both while one is already in
+flight wait for that call instead of sending their own (see coalesce.py).
+proxy() turns its result into a Flask response; /batch and other
+multi-call endpoints use it directly. fetch_todoist_async() is the same
+path for the ASGI serving mode (asgi.py), sharing the mirror and cache
+steps through check_local()/store_read().
+
+Bodies are passed through as the bytes Todoist sent. With stream=True a
+successful response is handed back as an iterator of chunks so large task
+lists are never held in memory or parsed on their way to the client; the
+body is only decoded when the mirror needs the object from a write.
+
+When Todoist can't answer a read, because its route's circuit breaker is
+open (see breaker.py), it can't be reached or it fails with a 5xx, the
+last good response is served instead, marked with X-Stale (its age in
+seconds). While a breaker isn't closed, reads that have such a response
+get it straight away and the breaker's probe refreshes it in the
+background.
+"""
+import asyncio
+import logging
+import math
+import threading
+import time
+from collections import namedtuple
+
+import requests
+
+from async_upstream import get_async_client
+from breaker import CircuitOpen
+from cache import STALE_RESPONSES, get_cache, get_stale_store, normalize_params
+from coalesce import coalescing_enabled, get_flights, get_shared_flights
+from listing import render_view
+from mirror import get_mirror
+from ratelimit import BACKGROUND, RateLimited
+from upstream import env_float, env_int, get_breakers, get_client
+
+log = logging.getLogger(__name__)
+
+STREAM_CHUNK_BYTES = 64 * 1024
+COALESCE_WAIT_SECONDS = env_float("COALESCE_WAIT_SECONDS", 15.0)
+# Coalesced GET bodies larger than this aren't shared; waiters go upstream themselves
+COALESCE_MAX_BYTES = env_int("COALESCE_MAX_BYTES", 8 * 1024 * 1024)
+
+# content is the raw body bytes, or None when the body is in `stream` (an
+# iterator of byte chunks); headers are extra response headers for our client
+UpstreamResult = namedtuple("UpstreamResult", "status content content_type headers stream")
+UpstreamResult.__new__.__defaults__ = (None,)
+
+
+# What check_local() learned about a call, for the steps after the upstream request
+LocalState = namedtuple("LocalState", "namespace mirror cache cache_key generation stale stale_generation")
+
+
+def check_local(headers, method, path, params=None):
+    """Tries to answer a call from the mirror or the response cache.
+
+    Returns (UpstreamResult, None) on a hit, else (None, LocalState).
+    """
+    namespace = headers["Authorization"]
+
+    # Answer reads from the local Sync API mirror when it is enabled, fresh and covers the query
+    mirror = get_mirror()
+    if mirror is not None and mirror.authorization != namespace:
+        mirror = None  # The mirror only holds the server's own Todoist account
+    if mirror is not None and method == "GET":
+        body = mirror.answer(path, params)
+        if body is not None:
+            log.debug("Mirror answered GET %s, Params: %s", path, params)
+            return UpstreamResult(200, body.encode(), "application/json", {"X-Mirror-Age": f"{mirror.age():.1f}"}), None
+
+    # Serve repeated reads from the response cache; the credential is part of the key
+    cache, stale = get_cache(), get_stale_store()
+    cache_key = generation = stale_generation = None
+    if method == "GET" and (cache.enabled or stale.enabled):
+        cache_key = cache.make_key(namespace, path, params)
+        cached = cache.get(cache_key) if cache.enabled else None
+        if cached is not None:
+            log.debug("Cache hit for GET %s, Params: %s", path, params)
+            return UpstreamResult(cached.status, cached.body, cached.content_type, {"X-Cache": "HIT"}), None
+        generation = cache.generation(namespace)
+        stale_generation = stale.generation(namespace)
+    return None, LocalState(namespace, mirror, cache, cache_key, generation, stale, stale_generation)
+
+
+def store_read(local, status, content_type, body):
+    """Caches a GET body once it has been read in full (`body` None means it wasn't kept)."""
+    if body is not None and local.cache_key is not None and status == 200:
+        local.cache.set(local.cache_key, status, body, content_type, generation=local.generation)
+        local.stale.set(local.cache_key, status, body, content_type, generation=local.stale_generation)
+
+
+def stale_read(local, reason):
+    """The last good response to a GET Todoist can't answer now, marked with its age; None if there is none."""
+    if local.cache_key is None or not local.stale.enabled:
+        return None
+    entry = local.stale.get(local.cache_key)
+    if entry is None:
+        return None
+    age = time.monotonic() - entry.stored_at
+    STALE_RESPONSES.inc(reason=reason)
+    log.info("Serving a %.0fs old response for GET %s: %s", age, local.cache_key[1], reason)
+    return UpstreamResult(entry.status, entry.body, entry.content_type, {"X-Stale": str(int(age))})
+
+
+def stale_on_error(local, method, error=None, status=None):
+    """stale_read() for a GET whose upstream call raised `error` or answered `status`."""
+    if method != "GET":
+        return None
+    if error is not None:
+        if isinstance(error, CircuitOpen):
+            return stale_read(local, "circuit_open")
+        if isinstance(error, requests.exceptions.RequestException) and not isinstance(error, RateLimited):
+            return stale_read(local, "unreachable")
+        return None
+    return stale_read(local, "server_error") if status >= 500 else None
+
+
+def coalesced(local, shared, scope, allow_stale):
+    """A coalesced GET's share of the leader's result, or the last good response when that was a 5xx."""
+    stale = stale_on_error(local, "GET", status=shared.status) if allow_stale else None
+    return stale or shared._replace(headers={"X-Coalesced": scope})
+
+
+def open_circuit(path):
+    """The breaker for `path` if it isn't closed, else None."""
+    breaker = get_breakers().get(path)
+    return breaker if breaker is not None and not breaker.closed else None
+
+
+def keep_limit(local):
+    """Bytes of a streamed body worth keeping for the cache."""
+    return local.cache.max_entry_bytes if local.cache_key is not None else 0
+
+
+def fetch_todoist(headers, method, path, params=None, json_data=None, stream=False, priority=None, allow_stale=True):
+    """Runs one Todoist REST call and returns an UpstreamResult.
+
+    Raises requests.exceptions.RequestException when Todoist can't be reached
+    (ratelimit.RateLimited when it can't be reached in time). `priority` is
+    the rate-limit queue priority for the upstream call. allow_stale=False
+    never answers with a last good response.
+    """
+    hit, local = check_local(headers, method, path, params)
+    if hit is not None:
+        return hit
+    namespace, mirror = local.namespace, local.mirror
+
+    breaker = open_circuit(path) if method == "GET" and allow_stale else None
+    if breaker is not None:
+        stale = stale_read(local, "circuit_open")
+        if stale is not None:
+            if breaker.start_revalidation():
+                threading.Thread(target=_revalidate, args=(breaker, headers, path, params), name="revalidate",
+                                 daemon=True).start()
+            return stale
+
+    # Identical GETs already in flight (in this worker or, if configured, another) share one call
+    landing = None
+    if method == "GET" and coalescing_enabled():
+        flight_key = (namespace, path, normalize_params(params))
+        flight, leading = get_flights().join(flight_key)
+        if not leading:
+            try:
+                shared = flight.wait(COALESCE_WAIT_SECONDS)
+            except Exception as e:
+                stale = stale_on_error(local, method, error=e) if allow_stale else None
+                if stale is not None:
+                    return stale
+                raise
+            if shared is not None:
+                log.debug("Coalesced GET %s, Params: %s", path, params)
+                return coalesced(local, shared, "worker", allow_stale)
+        else:
+            landing = _Landing(flight_key, flight)
+            shared_flights = get_shared_flights()
+            if shared_flights is not None:
+                arrived = time.time()
+                fd = shared_flights.try_lead(flight_key)
+                if fd is not None:
+                    landing.shared, landing.shared_fd = shared_flights, fd
+                else:
+                    found = shared_flights.follow(flight_key, arrived)
+                    if found is not None:
+                        status, content_type, content = found
+                        landing.land(status, content_type, content)
+                        log.debug("Coalesced GET %s across workers, Params: %s", path, params)
+                        return coalesced(local, UpstreamResult(status, content, content_type, {}), "shared",
+                                         allow_stale)
+
+    log.debug("Sending to Todoist: %s %s, Params: %s, JSON: %s", method, path, params, json_data)
+    try:
+        resp = get_client().request(method, path, headers=headers, params=params, json_data=json_data, stream=True,
+                                      priority=priority)
+    except BaseException as e:
+        if landing is not None:
+            landing.fail(e)
+        stale = stale_on_error(local, method, error=e) if allow_stale else None
+        if stale is not None:
+            return stale
+        raise
+    content_type = resp.headers.get("Content-Type", "text/plain")
+    ok = 200 <= resp.status_code < 300
+    log.debug("Todoist response: Status %s, Length %s", resp.status_code, resp.headers.get("Content-Length", "chunked"))
+
+    if method != "GET" and ok:
+        after_write(namespace, method, path, resp if mirror is not None else None, mirror=mirror)
+
+    def on_body(body):
+        """Fills the cache and hands the body to coalesced waiters once it has been read (None if it wasn't kept)."""
+        store_read(local, resp.status_code, content_type, body)
+        if landing is not None:
+            landing.land(resp.status_code, content_type, body)
+
+    if stream and ok and resp.status_code != 204 and not (mirror is not None and method != "GET"):
+        # Keep a copy while streaming (up to a limit) so the cache and waiters get it without a second call
+        limit = max(keep_limit(local), COALESCE_MAX_BYTES if landing is not None else 0)
+        return UpstreamResult(resp.status_code, None, content_type, {}, _Passthrough(resp, limit, on_body))
+
+    try:
+        content = resp.content
+    except BaseException as e:
+        if landing is not None:
+            landing.fail(e)
+        raise
+    finally:
+        resp.close()
+    if not ok:
+        log.info("Todoist error response: Status %s, Body: %r", resp.status_code, content[:500]) # Log truncated body
+    on_body(content)
+    stale = stale_on_error(local, method, status=resp.status_code) if allow_stale and not ok else None
+    return stale or UpstreamResult(resp.status_code, content, content_type, {})
+
+
+def _revalidate(breaker, headers, path, params):
+    """Refreshes a read that was answered stale; as the breaker's probe, it may close the circuit."""
+    try:
+        result = fetch_todoist(headers, "GET", path, params=params, priority=BACKGROUND, allow_stale=False)
+        log.info("Revalidated GET %s: %s", path, result.status)
+    except requests.exceptions.RequestException as e:
+        log.info("Revalidating GET %s failed: %s", path, e)
+    finally:
+        breaker.end_revalidation()
+
+
+async def fetch_todoist_async(headers, method, path, params=None, json_data=None, stream=False, priority=None,
+                              allow_stale=True):
+    """fetch_todoist() for the event loop, going upstream through the async client.
+
+    Same mirror, cache and in-worker coalescing steps; the stream, when
+    set, is an async iterable with aclose(). Cross-worker coalescing
+    (COALESCE_SHARED_DIR) is only done by the threaded path.
+    """
+    if get_mirror() is not None:
+        # The mirror answers from SQLite, which may be busy applying a sync
+        hit, local = await asyncio.to_thread(check_local, headers, method, path, params)
+    else:
+        hit, local = check_local(headers, method, path, params)
+    if hit is not None:
+        return hit
+    namespace, mirror = local.namespace, local.mirror
+
+    breaker = open_circuit(path) if method == "GET" and allow_stale else None
+    if breaker is not None:
+        stale = stale_read(local, "circuit_open")
+        if stale is not None:
+            if breaker.start_revalidation():
+                task = asyncio.get_running_loop().create_task(_revalidate_async(breaker, headers, path, params))
+                _revalidations.add(task)
+                task.add_done_callback(_revalidations.discard)
+            return stale
+
+    landing = None
+    if method == "GET" and coalescing_enabled():
+        flight_key = (namespace, path, normalize_params(params))
+        flight, leading = get_flights().join(flight_key)
+        if not leading:
+            try:
+                shared = await flight.wait_async(COALESCE_WAIT_SECONDS)
+            except Exception as e:
+                stale = stale_on_error(local, method, error=e) if allow_stale else None
+                if stale is not None:
+                    return stale
+                raise
+            if shared is not None:
+                log.debug("Coalesced GET %s, Params: %s", path, params)
+                return coalesced(local, shared, "worker", allow_stale)
+        else:
+            landing = _Landing(flight_key, flight)
+
+    log.debug("Sending to Todoist: %s %s, Params: %s, JSON: %s", method, path, params, json_data)
+    client = get_async_client()
+    try:
+        resp = await client.request(method, path, headers=headers, params=params, json_data=json_data, stream=True,
+                                    priority=priority)
+    except BaseException as e:
+        if landing is not None:
+            landing.fail(e)
+        stale = stale_on_error(local, method, error=e) if allow_stale else None
+        if stale is not None:
+            return stale
+        raise
+    content_type = resp.headers.get("Content-Type", "text/plain")
+    ok = 200 <= resp.status_code < 300
+    log.debug("Todoist response: Status %s, Length %s", resp.status_code, resp.headers.get("Content-Length", "chunked"))
+
+    def on_body(body):
+        store_read(local, resp.status_code, content_type, body)
+        if landing is not None:
+            landing.land(resp.status_code, content_type, body)
+
+    if stream and ok and resp.status_code != 204 and not (mirror is not None and method != "GET"):
+        if method != "GET":
+            after_write(namespace, method, path)
+        limit = max(keep_limit(local), COALESCE_MAX_BYTES if landing is not None else 0)
+        return UpstreamResult(resp.status_code, None, content_type, {}, _AsyncPassthrough(resp, limit, on_body))
+
+    try:
+        content = await client.read(resp)
+    except BaseException as e:
+        if landing is not None:
+            landing.fail(e)
+        raise
+    if method != "GET" and ok:
+        if mirror is not None:
+            await asyncio.to_thread(after_write, namespace, method, path, resp, mirror)
+        else:
+            after_write(namespace, method, path)
+    if not ok:
+        log.info("Todoist error response: Status %s, Body: %r", resp.status_code, content[:500]) # Log truncated body
+    on_body(content)
+    stale = stale_on_error(local, method, status=resp.status_code) if allow_stale and not ok else None
+    return stale or UpstreamResult(resp.status_code, content, content_type, {})
+
+
+# Background revalidations started by fetch_todoist_async(), referenced until they finish
+_revalidations = set()
+
+
+async def _revalidate_async(breaker, headers, path, params):
+    try:
+        result = await fetch_todoist_async(headers, "GET", path, params=params, priority=BACKGROUND,
+                                           allow_stale=False)
+        log.info("Revalidated GET %s: %s", path, result.status)
+    except requests.exceptions.RequestException as e:
+        log.info("Revalidating GET %s failed: %s", path, e)
+    finally:
+        breaker.end_revalidation()
+
+
+def apply_list_view(result, view, path):
+    """Re-serializes a successful list result through a listing.ListView; anything else is returned as is."""
+    if view is None or result.status != 200 or result.content is None:
+        return result
+    try:
+        body = render_view(view, result.content)
+    except ValueError:
+        log.warning("Could not apply fields/limit to %s: response is not a JSON array", path)
+        return result
+    return UpstreamResult(200, body, "application/json", result.headers)
+
+
+def upstream_error(e):
+    """Maps an exception from fetch_todoist() to (status, JSON body, extra headers) for the client."""
+    if isinstance(e, CircuitOpen):
+        retry_after = max(math.ceil(e.retry_after), 1)
+        return (503, {"error": f"Todoist is failing; not calling it again for {retry_after}s",
+                      "retry_after": retry_after}, {"Retry-After": str(retry_after)})
+    if isinstance(e, RateLimited):
+        log.warning("Rate limit queue full: %s", e)
+        retry_after = math.ceil(e.retry_after)
+        return (503, {"error": f"Todoist rate limit reached; retry in {retry_after}s", "retry_after": retry_after},
+                {"Retry-After": str(retry_after)})
+    if isinstance(e, requests.exceptions.Timeout):
+        log.warning("Timed out waiting for Todoist: %s", e)
+        return 504, {"error": f"Todoist API timed out: {str(e)}"}, {}  # Gateway Timeout
+    log.warning("Request error connecting to Todoist: %s", e)
+    return 503, {"error": f"Failed to connect to Todoist API: {str(e)}"}, {}  # Service Unavailable
+
+
+class _Landing:
+    """Hands a coalesced call's outcome to the threads and workers waiting on it, exactly once."""
+
+    def __init__(self, key, flight):
+        self.key = key
+        self.flight = flight
+        self.shared = None
+        self.shared_fd = None
+        self._landed = False
+
+    def land(self, status, content_type, content):
+        if self._landed:
+            return
+        self._landed = True
+        result = UpstreamResult(status, content, content_type, {}) if content is not None else None
+        get_flights().land(self.key, self.flight, result=result)
+        if self.shared_fd is not None:
+            self.shared.publish(self.key, self.shared_fd, status, content_type, content)
+
+    def fail(self, error):
+        if self._landed:
+            return
+        self._landed = True
+        get_flights().land(self.key, self.flight, error=error)
+        if self.shared_fd is not None:
+            self.shared.publish(self.key, self.shared_fd)
+
+
+class _Passthrough:
+    """Iterable over an upstream body that releases the connection and reports the body exactly once.
+
+    `on_complete` gets the whole body if it was read to the end within
+    `limit` bytes, otherwise None. It also runs if the client goes away
+    before (or while) the body is sent, since the WSGI server calls close().
+    """
+
+    def __init__(self, resp, limit=0, on_complete=None):
+        self.resp = resp
+        self.limit = limit
+        self.on_complete = on_complete
+        self._kept = []
+        self._size = 0
+        self._finished = False
+
+    def __iter__(self):
+        try:
+            for chunk in self.resp.iter_content(STREAM_CHUNK_BYTES):
+                self._keep(chunk)
+                yield chunk
+            self._finish(complete=True)
+        finally:
+            self.close()
+
+    def close(self):
+        self._finish(complete=False)
+
+    def _keep(self, chunk):
+        if self._kept is not None:
+            self._size += len(chunk)
+            if self._size <= self.limit:
+                self._kept.append(chunk)
+            else:
+                self._kept = None
+
+    def _finish(self, complete):
+        if self._finished:
+            return
+        self._finished = True
+        self.resp.close()
+        self._report(complete)
+
+    def _report(self, complete):
+        if self.on_complete is not None:
+            self.on_complete(b"".join(self._kept) if complete and self._kept is not None else None)
+
+
+class _AsyncPassthrough(_Passthrough):
+    """_Passthrough over an httpx response, for the ASGI app to iterate with `async for` and aclose()."""
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self.resp.aiter_bytes(STREAM_CHUNK_BYTES):
+                self._keep(chunk)
+                yield chunk
+            await self._afinish(complete=True)
+        finally:
+            await self.aclose()
+
+    async def aclose(self):
+        await self._afinish(complete=False)
+
+    async def _afinish(self, complete):
+        if self._finished:
+            return
+        self._finished = True
+        await self.resp.aclose()
+        self._report(complete)
+
+
+def after_write(namespace, method, path, resp=None, mirror=None):
+    """Evicts cached reads a successful write made stale and applies it to the mirror.
+
+    `resp` is Todoist's response to the write, or None when the write went
+    through another API (e.g. Sync commands) and only invalidation applies.
+    """
+    get_cache().invalidate(namespace, method, path)
+    get_stale_store().invalidate(namespace, method, path)
+    if mirror is None:
+        mirror = get_mirror()
+        if mirror is None or mirror.authorization != namespace:
+            return
+    if resp is None:
+        mirror.request_sync()
+        return
+    body = None
+    if resp.status_code != 204:
+        try:
+            body = resp.json()
+        except ValueError:
+            pass
+    mirror.apply_write(method, path, body)
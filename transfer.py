@@ -0,0 +1,380 @@
+"""Whole-account export and import as NDJSON streams.
+
+    GET  /export   ?comments=0 leaves comments out
+    POST /import   body: an export (or any NDJSON in its format)
+
+An export is one JSON object per line: a header, then projects, sections,
+labels and tasks, each project and task followed by its comments, then an
+"end" line with the counts. Parents come before their children, so a
+stream can be imported in order.
+
+    {"type": "export", "version": 1, "exported_at": "..."}
+    {"type": "project", "data": {...the Todoist object...}}
+    {"type": "comment", "data": {...}}
+    {"type": "end", "counts": {"project": 3, ...}}
+
+The collections are read once (through the cache and mirror like any
+other read) and written out as they are serialized. Comments are fetched
+per object, EXPORT_PREFETCH objects ahead of the line being written, so
+at most that many comment lists are held at a time; objects whose
+comment_count is 0 are skipped. If a read fails midway, an "error" line
+ends the stream in place of "end".
+
+An import reads its body a line at a time and creates what it describes
+in batches of IMPORT_BATCH_SIZE through batch.run_batch(), which sends
+them as Sync API commands. The ids in the stream are replaced with the
+ones Todoist gives the new objects, within a batch through "$<index>.id"
+references. The inbox is mapped onto the account's own inbox, and labels
+that already exist by name are reused. The response streams back a
+"progress" line per batch with the ids it mapped, an "error" line per
+record that failed (its dependents fail too), and a final "done" line.
+
+Tunables (environment variables, read once per process):
+    EXPORT_PREFETCH          objects whose comments are fetched ahead (8)
+    IMPORT_BATCH_SIZE        records per upstream batch (100)
+    IMPORT_MAX_LINE_BYTES    longest line accepted, longer ones are rejected (1 MiB)
+"""
+import datetime
+import json
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from actions import ActionError, build_call
+from batch import SYNC_COMMANDS_PER_REQUEST, run_batch
+from metrics import REGISTRY
+from ratelimit import BULK
+from todoist import fetch_todoist
+from upstream import env_int
+from views import decode_results
+
+log = logging.getLogger(__name__)
+
+NDJSON = "application/x-ndjson"
+FORMAT_VERSION = 1
+PREFETCH = max(env_int("EXPORT_PREFETCH", 8), 1)
+BATCH_SIZE = min(max(env_int("IMPORT_BATCH_SIZE", 100), 1), SYNC_COMMANDS_PER_REQUEST)
+MAX_LINE_BYTES = env_int("IMPORT_MAX_LINE_BYTES", 1024 * 1024)
+# Lines are written to the client in pieces of about this size
+WRITE_BYTES = 64 * 1024
+READ_BYTES = 64 * 1024
+
+COLLECTIONS = ("projects", "sections", "labels", "tasks")
+
+EXPORTED = REGISTRY.counter(
+    "gtd_export_records_total", "Records written by /export, by type.", ("type",))
+IMPORTED = REGISTRY.counter(
+    "gtd_import_records_total", "Records read by /import, by type and outcome.", ("type", "outcome"))
+
+
+def _read_collections(headers, names):
+    """Reads the named collections concurrently; returns {name: decoded list}."""
+    with ThreadPoolExecutor(max_workers=len(names), thread_name_prefix="transfer") as pool:
+        futures = {name: pool.submit(fetch_todoist, headers, "GET", f"/{name}", priority=BULK) for name in names}
+        return decode_results({name: future.result() for name, future in futures.items()})
+
+
+def _parents_first(items):
+    """Orders objects so each comes after its parent_id, siblings in Todoist's order."""
+    ordered = sorted(items, key=lambda item: item.get("order") or 0)
+    ids = {item["id"] for item in ordered}
+    children = {}
+    for item in ordered:
+        parent = item.get("parent_id")
+        children.setdefault(parent if parent in ids else None, []).append(item)
+    result, stack = [], list(reversed(children.get(None, [])))
+    while stack:
+        item = stack.pop()
+        result.append(item)
+        stack.extend(reversed(children.get(item["id"], ())))
+    return result
+
+
+def _line(record_type, data):
+    return json.dumps({"type": record_type, "data": data}, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+def _meta_line(record_type, **fields):
+    return json.dumps(dict(type=record_type, **fields), separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+# --- Export ---
+
+def _comments(headers, key, object_id):
+    result = fetch_todoist(headers, "GET", "/comments", params={key: object_id}, priority=BULK)
+    return decode_results({f"comments of {key} {object_id}": result}).popitem()[1]
+
+
+def open_export(headers, comments=True):
+    """Reads the account's collections and returns an iterator of the export's NDJSON chunks.
+
+    Raises ActionError or requests.exceptions.RequestException when the
+    collections can't be read, before anything has been sent.
+    """
+    resources = _read_collections(headers, COLLECTIONS)
+    return _chunks(_export_lines(headers, resources, comments))
+
+
+def _export_lines(headers, resources, comments):
+    counts = dict.fromkeys(("project", "section", "label", "task", "comment"), 0)
+    pool = ThreadPoolExecutor(max_workers=PREFETCH, thread_name_prefix="export") if comments else None
+    started = time.perf_counter()
+    try:
+        yield _meta_line("export", version=FORMAT_VERSION,
+                         exported_at=datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"))
+        sources = (
+            ("project", _parents_first(resources["projects"]), "project_id"),
+            ("section", sorted(resources["sections"], key=lambda s: (s.get("project_id") or "", s.get("order") or 0)),
+             None),
+            ("label", sorted(resources["labels"], key=lambda label: label.get("order") or 0), None),
+            ("task", _parents_first(resources["tasks"]), "task_id"),
+        )
+        for record_type, items, comment_key in sources:
+            for item, item_comments in _with_comments(pool, headers, items, comment_key):
+                counts[record_type] += 1
+                yield _line(record_type, item)
+                for comment in item_comments:
+                    counts["comment"] += 1
+                    yield _line("comment", comment)
+        yield _meta_line("end", counts=counts)
+        log.info("Exported %s in %.1fs", counts, time.perf_counter() - started)
+    except (ActionError, requests.exceptions.RequestException) as e:
+        log.warning("Export failed after %s: %s", counts, e)
+        yield _meta_line("error", error=getattr(e, "message", None) or str(e), counts=counts)
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+        for record_type, count in counts.items():
+            EXPORTED.inc(count, type=record_type)
+
+
+def _with_comments(pool, headers, items, comment_key):
+    """Yields (item, its comments), fetching the comments of up to PREFETCH items ahead."""
+    pending = deque()
+    items = iter(items)
+    while True:
+        while len(pending) < PREFETCH:
+            item = next(items, None)
+            if item is None:
+                break
+            future = None
+            if pool is not None and comment_key is not None and item.get("comment_count", 1):
+                future = pool.submit(_comments, headers, comment_key, item["id"])
+            pending.append((item, future))
+        if not pending:
+            return
+        item, future = pending.popleft()
+        yield item, future.result() if future is not None else ()
+
+
+def _chunks(lines):
+    """Joins lines into pieces of about WRITE_BYTES for the client."""
+    buffer, size = [], 0
+    try:
+        for line in lines:
+            buffer.append(line)
+            size += len(line)
+            if size >= WRITE_BYTES:
+                yield b"".join(buffer)
+                buffer, size = [], 0
+        if buffer:
+            yield b"".join(buffer)
+    finally:
+        lines.close()
+
+
+# --- Import ---
+
+# For each record type: the manage endpoint, fields copied as they are, and fields holding ids of other records
+RECORDS = {
+    "project": ("projects", ("name", "color", "is_favorite", "view_style"), {"parent_id": "project"}),
+    "section": ("sections", ("name", "order"), {"project_id": "project"}),
+    "label": ("labels", ("name", "color", "order", "is_favorite"), {}),
+    "task": ("tasks", ("content", "description", "labels", "priority", "order"),
+             {"project_id": "project", "section_id": "section", "parent_id": "task"}),
+    "comment": ("comments", ("content", "attachment"), {"task_id": "task", "project_id": "project"}),
+}
+
+
+def _task_fields(task):
+    """The create fields for a task's due date and duration, as the manage endpoint takes them."""
+    fields = {}
+    due = task.get("due")
+    if isinstance(due, dict):
+        # A recurring date only survives as its text; a one-off keeps its exact date or time
+        if due.get("is_recurring") and due.get("string"):
+            fields["due_string"] = due["string"]
+            if due.get("lang"):
+                fields["due_lang"] = due["lang"]
+        elif due.get("datetime"):
+            fields["due_datetime"] = due["datetime"]
+        elif due.get("date"):
+            fields["due_date"] = due["date"]
+    duration = task.get("duration")
+    if isinstance(duration, dict) and duration.get("amount"):
+        fields["duration"] = duration["amount"]
+        fields["duration_unit"] = duration.get("unit") or "minute"
+    return fields
+
+
+def _read_lines(read):
+    """Yields (line number, line) from a body read with `read(size)`; None for a line over MAX_LINE_BYTES."""
+    buffer = b""
+    number = 0
+    skipping = False
+    while True:
+        chunk = read(READ_BYTES)
+        if not chunk:
+            break
+        lines = (buffer + chunk).split(b"\n")
+        buffer = lines.pop()
+        for line in lines:
+            number += 1
+            if skipping or len(line) > MAX_LINE_BYTES:
+                skipping = False
+                yield number, None
+            else:
+                yield number, line
+        if len(buffer) > MAX_LINE_BYTES:
+            # Drop the rest of this line as it arrives instead of holding it
+            buffer = b""
+            skipping = True
+    if buffer or skipping:
+        yield number + 1, None if skipping or len(buffer) > MAX_LINE_BYTES else buffer
+
+
+def open_import(headers, read):
+    """Starts an import of the NDJSON body `read(size)` returns; returns an iterator of NDJSON progress chunks.
+
+    Raises ActionError or requests.exceptions.RequestException when the
+    account's projects and labels can't be read, before anything is written.
+    """
+    existing = _read_collections(headers, ("projects", "labels"))
+    return _Import(headers, existing).run(read)
+
+
+class _Import:
+    """One import: the id mapping so far and the batch being filled."""
+
+    def __init__(self, headers, existing):
+        self.headers = headers
+        self.ids = {}  # (record type, id in the stream) -> id in this account
+        self.inboxes = {key: project["id"] for project in existing["projects"]
+                        for key in ("is_inbox_project", "is_team_inbox") if project.get(key)}
+        self.labels = {label["name"]: label["id"] for label in existing["labels"]}
+        self.pending = []  # (line number, record type, id in the stream, operation)
+        self.in_batch = {}  # (record type, id in the stream) -> index in self.pending
+        self.counts = {"records": 0, "created": 0, "existing": 0, "failed": 0}
+
+    def run(self, read):
+        started = time.perf_counter()
+        for number, line in _read_lines(read):
+            if line is not None and not line.strip():
+                continue
+            try:
+                record = json.loads(line) if line is not None else None
+            except ValueError:
+                record = None
+            record_type = record.get("type") if isinstance(record, dict) else None
+            if record_type == "export":
+                if record.get("version") != FORMAT_VERSION:
+                    yield self._error(number, record_type, None, 400,
+                                      f"Unsupported export version {record.get('version')!r}")
+                    break
+                continue
+            if record_type in ("end", "error"):
+                continue
+            self.counts["records"] += 1
+            if line is None:
+                yield self._error(number, None, None, 413, f"Lines are limited to {MAX_LINE_BYTES} bytes")
+                continue
+            if not isinstance(record, dict):
+                yield self._error(number, None, None, 400, "Not a JSON object")
+                continue
+            error = self._add(number, record_type, record.get("data"))
+            if error is not None:
+                yield error
+            if len(self.pending) >= BATCH_SIZE:
+                yield from self._flush()
+        yield from self._flush()
+        elapsed = time.perf_counter() - started
+        log.info("Imported %s in %.1fs", self.counts, elapsed)
+        yield _meta_line("done", elapsed_seconds=round(elapsed, 3), **self.counts)
+
+    def _error(self, number, record_type, old_id, status, message):
+        self.counts["failed"] += 1
+        IMPORTED.inc(type=record_type if record_type in RECORDS else "other", outcome="failed")
+        return _meta_line("error", line=number, record=record_type, id=old_id, status=status, error=message)
+
+    def _add(self, number, record_type, data):
+        """Queues one record's create; returns an error line if it can't be, else None."""
+        if record_type not in RECORDS:
+            return self._error(number, record_type, None, 400, f"Unknown record type {record_type!r}")
+        if not isinstance(data, dict) or not data.get("id"):
+            return self._error(number, record_type, None, 400, "'data' must be an object with an 'id'")
+        old_id = str(data["id"])
+
+        # The account has an inbox and may have the label already; map onto those instead of creating
+        mapped = None
+        if record_type == "project":
+            mapped = self.inboxes.get("is_inbox_project" if data.get("is_inbox_project") else
+                                      "is_team_inbox" if data.get("is_team_inbox") else None)
+        elif record_type == "label":
+            mapped = self.labels.get(data.get("name"))
+        if mapped is not None:
+            self.ids[(record_type, old_id)] = mapped
+            self.counts["existing"] += 1
+            IMPORTED.inc(type=record_type, outcome="existing")
+            return None
+
+        endpoint, fields, references = RECORDS[record_type]
+        operation = {"endpoint": endpoint, "action": "create"}
+        operation.update((key, data[key]) for key in fields if data.get(key) is not None)
+        if record_type == "task":
+            operation.update(_task_fields(data))
+        for key, target_type in references.items():
+            value = data.get(key)
+            if value is None:
+                continue
+            target = (target_type, str(value))
+            if target in self.ids:
+                operation[key] = self.ids[target]
+            elif target in self.in_batch:
+                operation[key] = f"${self.in_batch[target]}.id"
+            else:
+                return self._error(number, record_type, old_id, 424,
+                                   f"'{key}' refers to {target_type} {value}, which was not imported")
+        try:
+            build_call(endpoint, {k: v for k, v in operation.items() if k != "endpoint"})
+        except ActionError as e:
+            return self._error(number, record_type, old_id, e.status, e.message)
+        self.in_batch[(record_type, old_id)] = len(self.pending)
+        self.pending.append((number, record_type, old_id, operation))
+        return None
+
+    def _flush(self):
+        """Sends the pending batch; yields its error lines and a progress line."""
+        if not self.pending:
+            return
+        pending, self.pending, self.in_batch = self.pending, [], {}
+        try:
+            document = run_batch([operation for _, _, _, operation in pending], self.headers,
+                                 max_workers=env_int("BATCH_MAX_WORKERS", 4), max_operations=len(pending))
+            results = document["results"]
+        except ActionError as e:
+            results = [{"status": e.status, "error": e.message}] * len(pending)
+        mapped = {}
+        for (number, record_type, old_id, _), result in zip(pending, results):
+            new_id = (result.get("body") or {}).get("id") if isinstance(result.get("body"), dict) else None
+            if 200 <= result["status"] < 300 and new_id is not None:
+                self.ids[(record_type, old_id)] = str(new_id)
+                mapped.setdefault(record_type, {})[old_id] = str(new_id)
+                self.counts["created"] += 1
+                IMPORTED.inc(type=record_type, outcome="created")
+            else:
+                yield self._error(number, record_type, old_id, result["status"],
+                                  result.get("error") or "Todoist did not return the new object's id")
+        yield _meta_line("progress", ids=mapped, **self.counts)
@@ -0,0 +1,260 @@
+"""Comment attachments, streamed through to Todoist.
+
+    POST /comments/attachments   multipart/form-data: content, task_id or project_id, then file
+
+The comment's fields are validated before anything is uploaded. The file
+part is then piped to Todoist's upload endpoint (Sync API uploads/add)
+chunk by chunk as it arrives from the client, so a worker holds a chunk or
+two of it in memory and nothing on disk, however large the file. Todoist
+answers with the attachment object, and the comment is created with it
+like any other comments/manage create.
+
+Fields must come before the file: anything after it would only be seen
+once the upload is done. A file larger than ATTACHMENT_MAX_BYTES is
+refused with 413, up front when the request's Content-Length already says
+so, otherwise as soon as the limit is crossed, which aborts the upload to
+Todoist mid-stream.
+
+Tunables (environment variables, read once per process):
+    ATTACHMENT_MAX_BYTES    largest file accepted (25 MiB)
+    ATTACHMENT_CHUNK_BYTES  size of the pieces read from the client and sent on (64 KiB)
+"""
+import json
+import logging
+import time
+import uuid
+from collections import deque
+
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+
+from actions import ActionError, build_call
+from async_upstream import get_async_client
+from metrics import REGISTRY
+from ratelimit import INTERACTIVE
+from upstream import env_int, get_client, sync_api_base
+
+log = logging.getLogger(__name__)
+
+MAX_BYTES = env_int("ATTACHMENT_MAX_BYTES", 25 * 1024 * 1024)
+CHUNK_BYTES = max(env_int("ATTACHMENT_CHUNK_BYTES", 64 * 1024), 1024)
+# The text fields are short; a bigger one is most likely a file sent without a filename
+MAX_FIELD_BYTES = 64 * 1024
+UPLOAD_PATH = "/uploads/add"
+
+# Bytes per second, from a slow mobile link to a fast LAN
+THROUGHPUT_BUCKETS = (16e3, 64e3, 256e3, 1e6, 4e6, 16e6, 64e6, 256e6)
+
+UPLOADS = REGISTRY.counter(
+    "gtd_attachment_uploads_total", "Comment attachment uploads, by outcome.", ("outcome",))
+UPLOAD_BYTES = REGISTRY.counter(
+    "gtd_attachment_upload_bytes_total", "Attachment bytes streamed to Todoist.")
+UPLOAD_DURATION = REGISTRY.histogram(
+    "gtd_attachment_upload_duration_seconds", "Time from the start of an upload to Todoist's response.")
+UPLOAD_THROUGHPUT = REGISTRY.histogram(
+    "gtd_attachment_upload_throughput_bytes_per_second", "Throughput of successful uploads to Todoist.",
+    buckets=THROUGHPUT_BUCKETS)
+
+
+class _Form:
+    """Incremental parser for an upload's body: the comment's fields, then one file."""
+
+    def __init__(self, content_type):
+        mimetype, options = parse_options_header(content_type or "")
+        if mimetype != "multipart/form-data" or not options.get("boundary"):
+            raise ActionError("Request body must be multipart/form-data", status=415)
+        self.boundary = options["boundary"]
+        # Bounds the decoder's buffer: part headers, plus at most one fed piece of data
+        self._decoder = MultipartDecoder(self.boundary.encode("latin-1"),
+                                         max_form_memory_size=MAX_FIELD_BYTES + CHUNK_BYTES)
+        self.fields = {}
+        self.filename = None
+        self.file_type = None
+        self.pending = deque()  # file data parsed but not yet sent on
+        self.size = 0
+        self.file_done = False
+        self.done = False
+        self._in_file = False
+        self._field = None
+        self._value = bytearray()
+
+    def feed(self, chunk):
+        """Parses the next piece of the body (b"" once it has ended); raises ActionError."""
+        try:
+            if not chunk:
+                self._decoder.receive_data(None)
+                self._drain()
+                return
+            for start in range(0, len(chunk), CHUNK_BYTES):
+                self._decoder.receive_data(chunk[start:start + CHUNK_BYTES])
+                self._drain()
+        except RequestEntityTooLarge:
+            raise ActionError(f"Form fields are limited to {MAX_FIELD_BYTES} bytes", status=413)
+        except ValueError:
+            raise ActionError("Malformed or incomplete multipart body")
+
+    def _drain(self):
+        while True:
+            event = self._decoder.next_event()
+            if isinstance(event, NeedData):
+                return
+            if isinstance(event, File):
+                if self.filename is not None or event.name != "file":
+                    raise ActionError("Send exactly one file, in a part named 'file'")
+                self.filename = event.filename or "attachment"
+                self.file_type = event.headers.get("Content-Type") or "application/octet-stream"
+                self._in_file = True
+            elif isinstance(event, Field):
+                if self.filename is not None:
+                    raise ActionError("Send the comment's fields before the file")
+                self._field = event.name
+            elif isinstance(event, Data):
+                if self._in_file:
+                    self._file_data(event)
+                else:
+                    self._value += event.data
+                    if len(self._value) > MAX_FIELD_BYTES:
+                        raise RequestEntityTooLarge()
+                    if not event.more_data:
+                        self.fields[self._field] = self._value.decode("utf-8", "replace")
+                        self._value = bytearray()
+            elif isinstance(event, Epilogue):
+                self.done = True
+                return
+
+    def _file_data(self, event):
+        self.size += len(event.data)
+        if self.size > MAX_BYTES:
+            raise ActionError(f"Attachments are limited to {MAX_BYTES} bytes", status=413)
+        if event.data:
+            self.pending.append(event.data)
+        if not event.more_data:
+            self._in_file = False
+            self.file_done = True
+
+
+def _start(content_type, content_length):
+    """Checks what can be checked before reading the body; returns the form parser."""
+    if content_length is not None and content_length > MAX_BYTES + MAX_FIELD_BYTES:
+        raise ActionError(f"Attachments are limited to {MAX_BYTES} bytes", status=413)
+    return _Form(content_type)
+
+
+def _comment(form):
+    """Validates the fields read so far as a comment to create; raises ActionError."""
+    if form.filename is None:
+        raise ActionError("A 'file' part is required")
+    return build_call("comments", dict(form.fields, action="create"))
+
+
+def _envelope(form):
+    """The multipart framing around the file for the upload to Todoist: (content type, head, tail).
+
+    uploads/add wants the name in a file_name field as well as on the file part.
+    """
+    boundary = uuid.uuid4().hex
+    # Quotes and line breaks can't appear in a quoted filename; browsers escape them the same way
+    filename = form.filename.replace('"', "%22").replace("\r", "%0D").replace("\n", "%0A")
+    head = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"file_name\"\r\n\r\n{form.filename}\r\n"
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{filename}\"\r\n"
+            f"Content-Type: {form.file_type}\r\n\r\n").encode("utf-8")
+    return f"multipart/form-data; boundary={boundary}", head, f"\r\n--{boundary}--\r\n".encode("latin-1")
+
+
+def _finish(form, status, content, started):
+    """Records the upload and builds the comment's UpstreamCall from Todoist's response."""
+    elapsed = time.perf_counter() - started
+    UPLOAD_BYTES.inc(form.size)
+    UPLOAD_DURATION.observe(elapsed)
+    if status != 200:
+        UPLOADS.inc(outcome="rejected_upstream")
+        log.warning("Todoist refused an attachment upload with %s", status)
+        raise ActionError(f"Todoist returned {status} for the upload: {content[:200].decode('utf-8', 'replace')}",
+                          status=status if status >= 400 else 502)
+    try:
+        attachment = json.loads(content)
+    except ValueError:
+        attachment = None
+    if not isinstance(attachment, dict):
+        UPLOADS.inc(outcome="rejected_upstream")
+        raise ActionError("Todoist returned an invalid upload response", status=502)
+    UPLOADS.inc(outcome="ok")
+    UPLOAD_THROUGHPUT.observe(form.size / elapsed if elapsed > 0 else 0.0)
+    log.info("Uploaded attachment %r: %d bytes in %.2fs", form.filename, form.size, elapsed)
+    return build_call("comments", dict(form.fields, action="create", attachment=attachment))
+
+
+def _failed(form, e):
+    UPLOAD_BYTES.inc(form.size)
+    UPLOADS.inc(outcome="too_large" if getattr(e, "status", None) == 413 else "failed")
+
+
+def stream_attachment(headers, content_type, content_length, read):
+    """Streams a multipart upload through to Todoist; returns the UpstreamCall that creates its comment.
+
+    `read(size)` reads the request body, returning b"" at its end. Raises
+    ActionError for a bad form or a refused upload, and
+    requests.exceptions.RequestException when Todoist can't be reached.
+    """
+    form = _start(content_type, content_length)
+    while form.filename is None and not form.done:
+        form.feed(read(CHUNK_BYTES))
+    _comment(form)
+    upload_type, head, tail = _envelope(form)
+
+    def body():
+        yield head
+        while True:
+            while form.pending:
+                yield form.pending.popleft()
+            if form.file_done:
+                break
+            form.feed(read(CHUNK_BYTES))
+        yield tail
+
+    started = time.perf_counter()
+    try:
+        # The body is an iterator, so requests sends it with chunked transfer encoding as it's produced
+        resp = get_client().request("POST", UPLOAD_PATH, headers=dict(headers, **{"Content-Type": upload_type}),
+                                    data=body(), base_url=sync_api_base(), priority=INTERACTIVE)
+        with resp:
+            status, content = resp.status_code, resp.content
+        while not form.done:
+            form.feed(read(CHUNK_BYTES))
+    except Exception as e:
+        _failed(form, e)
+        raise
+    return _finish(form, status, content, started)
+
+
+async def stream_attachment_async(headers, content_type, content_length, read):
+    """stream_attachment() for the ASGI mode; `read(size)` is a coroutine function."""
+    form = _start(content_type, content_length)
+    while form.filename is None and not form.done:
+        form.feed(await read(CHUNK_BYTES))
+    _comment(form)
+    upload_type, head, tail = _envelope(form)
+
+    async def body():
+        yield head
+        while True:
+            while form.pending:
+                yield form.pending.popleft()
+            if form.file_done:
+                break
+            form.feed(await read(CHUNK_BYTES))
+        yield tail
+
+    client = get_async_client()
+    started = time.perf_counter()
+    try:
+        resp = await client.request("POST", UPLOAD_PATH, headers=dict(headers, **{"Content-Type": upload_type}),
+                                    data=body(), base_url=sync_api_base(), priority=INTERACTIVE)
+        status, content = resp.status_code, resp.content
+        while not form.done:
+            form.feed(await read(CHUNK_BYTES))
+    except Exception as e:
+        _failed(form, e)
+        raise
+    return _finish(form, status, content, started)
@@ -0,0 +1,358 @@
+"""Shared HTTP client for calls to the Todoist API.
+
+Each worker process keeps a pooled, keep-alive requests.Session per Todoist
+credential (tenant, see auth.py), so calls reuse TCP/TLS connections instead
+of paying a fresh handshake every time, and one tenant's burst can't take
+every connection from the others.
+All calls get connect/read timeouts, and idempotent calls are retried with
+jittered exponential backoff that honors Todoist's Retry-After header.
+Every call first waits for budget from the rate limiter (see ratelimit.py);
+a call that still gets a 429 is queued and sent once more. 429s are then
+left to the limiter alone: retrying them in the transport as well would
+spend more calls, and sleep, against a quota that is already used up.
+Only with the limiter off are 429s retried like 5xx.
+
+Tunables (environment variables, read once per process):
+    TODOIST_API_BASE             upstream base URL (Todoist REST v2)
+    TODOIST_SYNC_API_BASE        Sync API base URL (Todoist Sync v9)
+    TODOIST_POOL_SIZE            max keep-alive connections per tenant per worker (10)
+    TODOIST_CONNECT_TIMEOUT      seconds to establish a connection (3.05)
+    TODOIST_READ_TIMEOUT         seconds to wait for response data (15)
+    TODOIST_MAX_RETRIES          retries for idempotent calls, 0 disables (2)
+    TODOIST_RETRY_BACKOFF        backoff factor in seconds (0.3)
+    TODOIST_MAX_RETRY_AFTER      longest Retry-After we wait out in-process (10)
+    RATE_LIMIT_REQUESTS          requests per credential per window, 0 disables (450);
+                                 tenants may override it (see auth.py)
+    RATE_LIMIT_WINDOW_SECONDS    length of Todoist's rate-limit window (900)
+    RATE_LIMIT_MAX_WAIT_SECONDS  longest a call may queue for budget before a 503 (10)
+    BREAKER_*                    per-route circuit breakers, see breaker.py
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, ReadTimeoutError, ResponseError
+from urllib3.util.retry import Retry
+
+from metrics import REGISTRY, UPSTREAM_IN_FLIGHT, UPSTREAM_LATENCY, UPSTREAM_REQUESTS, upstream_route
+from auth import on_reload
+from breaker import STATE_VALUES, Breakers
+from ratelimit import RateLimiter, classify
+
+log = logging.getLogger(__name__)
+
+# Base URL for Todoist’s REST v2 API
+TODOIST_API_BASE = "https://api.todoist.com/rest/v2"
+# Base URL for Todoist's Sync API (mirror, batched commands)
+TODOIST_SYNC_API_BASE = "https://api.todoist.com/sync/v9"
+
+# Methods that are safe to replay. Todoist uses POST for create/update/close,
+# so those are never retried once the request has been sent.
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Connection pools kept per worker; the least recently used one is closed beyond this
+MAX_TENANT_POOLS = 64
+
+
+def retry_statuses(limiter):
+    """Statuses the transport retries: not 429 when the rate limiter handles it."""
+    return RETRY_STATUSES if limiter is None else tuple(status for status in RETRY_STATUSES if status != 429)
+
+
+def replayable(data):
+    """Whether a request body can be sent a second time; an iterator of chunks can't."""
+    return data is None or isinstance(data, (bytes, str, dict, list, tuple))
+
+
+def env_int(name, default):
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        log.warning("Ignoring invalid integer for %s: %r", name, value)
+        return default
+
+
+def env_float(name, default):
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        log.warning("Ignoring invalid number for %s: %r", name, value)
+        return default
+
+
+class TodoistRetry(Retry):
+    """urllib3 Retry that gives up instead of sleeping through long Retry-After waits.
+
+    A 429 asking us to come back in a minute should go back to the caller,
+    not pin a worker for a minute. Only statuses in `status_forcelist` are
+    retried; urllib3 would otherwise retry any 429 carrying Retry-After.
+    """
+
+    def __init__(self, *args, max_retry_after=10, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_retry_after = max_retry_after
+
+    def new(self, **kw):
+        retry = super().new(**kw)
+        retry.max_retry_after = self.max_retry_after
+        return retry
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        return status_code in (self.status_forcelist or ()) and super().is_retry(method, status_code, has_retry_after)
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if response is not None and self.respect_retry_after_header:
+            retry_after = self.get_retry_after(response)
+            if retry_after is not None and retry_after > self.max_retry_after:
+                # With raise_on_status=False urllib3 hands the 429 back as-is
+                raise MaxRetryError(_pool, url, ResponseError(f"Retry-After {retry_after}s exceeds limit"))
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+class UpstreamClient:
+    """Pooled keep-alive client for the Todoist API."""
+
+    def __init__(self, base_url=TODOIST_API_BASE, pool_size=10, connect_timeout=3.05,
+                 read_timeout=15.0, max_retries=2, backoff_factor=0.3, max_retry_after=10.0, limiter=None,
+                 breakers=None):
+        self.base_url = base_url.rstrip("/")
+        self.limiter = limiter if limiter is not None and limiter.enabled else None
+        self.breakers = breakers if breakers is not None and breakers.enabled else None
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+        self.retry = TodoistRetry(
+            total=max_retries,
+            allowed_methods=IDEMPOTENT_METHODS,
+            status_forcelist=retry_statuses(self.limiter),
+            backoff_factor=backoff_factor,
+            backoff_jitter=backoff_factor,
+            backoff_max=max_retry_after,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+            max_retry_after=max_retry_after,
+        )
+        self._sessions = OrderedDict()  # namespace -> (Session, HTTPAdapter), least recently used first
+        self._sessions_lock = threading.Lock()
+        self.pools_closed = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            base_url=os.getenv("TODOIST_API_BASE", TODOIST_API_BASE),
+            pool_size=env_int("TODOIST_POOL_SIZE", 10),
+            connect_timeout=env_float("TODOIST_CONNECT_TIMEOUT", 3.05),
+            read_timeout=env_float("TODOIST_READ_TIMEOUT", 15.0),
+            max_retries=env_int("TODOIST_MAX_RETRIES", 2),
+            backoff_factor=env_float("TODOIST_RETRY_BACKOFF", 0.3),
+            max_retry_after=env_float("TODOIST_MAX_RETRY_AFTER", 10.0),
+            limiter=get_limiter(),
+            breakers=get_breakers(),
+        )
+
+    def request(self, method, path, headers=None, params=None, json_data=None, stream=False,
+                data=None, base_url=None, priority=None):
+        """Sends one request to Todoist; raises requests.exceptions.RequestException on failure.
+
+        `base_url` overrides the REST base for other Todoist APIs (e.g. Sync).
+        `priority` is the rate-limit queue priority (default: from method and
+        path); ratelimit.RateLimited is raised if the call can't be scheduled
+        in time, and breaker.CircuitOpen if its route is failing.
+        """
+        breaker = self.breakers.get(path) if self.breakers is not None else None
+        probe = breaker.admit() if breaker is not None else False
+        try:
+            if self.limiter is None:
+                return self._send(method, path, headers, params, json_data, stream, data, base_url, breaker)
+            namespace = (headers or {}).get("Authorization", "")
+            if priority is None:
+                priority = classify(method, path)
+            self.limiter.acquire(namespace, priority)
+            resp = self._send(method, path, headers, params, json_data, stream, data, base_url, breaker)
+            self.limiter.observe(namespace, resp)
+            if resp.status_code == 429 and replayable(data):
+                # Todoist didn't process it, so it is safe to queue and resend once whatever the method
+                resp.close()
+                self.limiter.acquire(namespace, priority)
+                resp = self._send(method, path, headers, params, json_data, stream, data, base_url, breaker)
+                self.limiter.observe(namespace, resp)
+            return resp
+        finally:
+            if breaker is not None:
+                breaker.release(probe)
+
+    def _session(self, namespace):
+        """The session whose connection pool serves `namespace`."""
+        with self._sessions_lock:
+            entry = self._sessions.get(namespace)
+            if entry is not None:
+                self._sessions.move_to_end(namespace)
+                return entry[0]
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=self.retry)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            self._sessions[namespace] = (session, adapter)
+            if len(self._sessions) > MAX_TENANT_POOLS:
+                # Connections still checked out are closed when they're returned
+                _, (oldest, _) = self._sessions.popitem(last=False)
+                oldest.close()
+                self.pools_closed += 1
+            return session
+
+    def _send(self, method, path, headers, params, json_data, stream, data, base_url, breaker=None):
+        url = (base_url or self.base_url) + path
+        route = upstream_route(path)
+        session = self._session((headers or {}).get("Authorization", ""))
+        status = "error"
+        unreachable = False
+        UPSTREAM_IN_FLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            resp = session.request(method, url, headers=headers, params=params, json=json_data,
+                                        data=data, timeout=self.timeout, stream=stream)
+            status = str(resp.status_code)
+            return resp
+        except requests.exceptions.Timeout:
+            status = "timeout"
+            unreachable = True
+            raise
+        except requests.exceptions.ConnectionError as e:
+            unreachable = True
+            # requests reports a read timeout that used up the retries as a ConnectionError
+            if isinstance(getattr(e.args[0] if e.args else None, "reason", None), ReadTimeoutError):
+                status = "timeout"
+                raise requests.exceptions.ReadTimeout(e, request=e.request)
+            raise
+        except requests.exceptions.RequestException:
+            unreachable = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            UPSTREAM_IN_FLIGHT.dec()
+            UPSTREAM_LATENCY.observe(elapsed, method=method, route=route)
+            UPSTREAM_REQUESTS.inc(method=method, route=route, status=status)
+            # Exceptions of our own (e.g. an aborted upload body) say nothing about Todoist
+            if breaker is not None and (unreachable or status.isdigit()):
+                breaker.record(unreachable or int(status) >= 500, elapsed)
+
+    def stats(self):
+        """Connection reuse counters summed over this worker's connection pools."""
+        opened = sent = 0
+        with self._sessions_lock:
+            adapters = [adapter for _, adapter in self._sessions.values()]
+        for adapter in adapters:
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                opened += pool.num_connections
+                sent += pool.num_requests
+        return {
+            "requests_sent": sent,
+            "connections_opened": opened,
+            "connections_reused": max(sent - opened, 0),
+            "pool_size": self.pool_size,
+            "tenant_pools": len(adapters),
+            "tenant_pools_closed": self.pools_closed,
+            "timeout": {"connect": self.timeout[0], "read": self.timeout[1]},
+            "rate_limit": self.limiter.stats() if self.limiter is not None else {"enabled": False},
+            "circuits": self.breakers.stats() if self.breakers is not None else {"enabled": False},
+        }
+
+
+def _pool_collector():
+    if _client is None or _client_pid != os.getpid():
+        return []
+    stats = _client.stats()
+    return [
+        ("gtd_upstream_connections_opened_total", "counter", "Connections opened to Todoist by this worker.",
+         [({}, stats["connections_opened"])]),
+        ("gtd_upstream_connections_reused_total", "counter", "Todoist requests sent on an already open connection.",
+         [({}, stats["connections_reused"])]),
+    ]
+
+
+REGISTRY.add_collector(_pool_collector)
+
+
+def _breaker_collector():
+    if _breakers is None:
+        return []
+    stats = _breakers.stats()
+    return [("gtd_circuit_state", "gauge", "Circuit breaker state by upstream route: 0 closed, 1 half-open, 2 open.",
+             [({"route": route}, STATE_VALUES[s["state"]]) for route, s in stats.items()])]
+
+
+REGISTRY.add_collector(_breaker_collector)
+
+
+def sync_api_base():
+    return os.getenv("TODOIST_SYNC_API_BASE", TODOIST_SYNC_API_BASE)
+
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+_limiter = None
+_limiter_pid = None
+_limiter_lock = threading.Lock()
+_breakers = None
+_breakers_lock = threading.Lock()
+
+
+def get_client():
+    """Returns this process's shared client, creating it after any fork."""
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                _client = UpstreamClient.from_env()
+                _client_pid = pid
+    return _client
+
+
+def get_limiter():
+    """Returns this process's rate limiter; the sync and async clients share its budget."""
+    global _limiter, _limiter_pid
+    pid = os.getpid()
+    if _limiter is None or _limiter_pid != pid:
+        with _limiter_lock:
+            if _limiter is None or _limiter_pid != pid:
+                limiter = RateLimiter(
+                    requests_per_window=env_int("RATE_LIMIT_REQUESTS", 450),
+                    window=env_float("RATE_LIMIT_WINDOW_SECONDS", 900.0),
+                    max_wait=env_float("RATE_LIMIT_MAX_WAIT_SECONDS", 10.0),
+                )
+                # Tenants' own budgets, now and after every registry reload
+                on_reload(lambda registry: limiter.set_budgets(registry.budgets()))
+                _limiter = limiter
+                _limiter_pid = pid
+    return _limiter
+
+
+def get_breakers():
+    """Returns this process's circuit breakers; the sync and async clients share them."""
+    global _breakers
+    if _breakers is None:
+        with _breakers_lock:
+            if _breakers is None:
+                _breakers = Breakers(
+                    failure_rate=env_float("BREAKER_FAILURE_RATE", 0.5),
+                    min_calls=env_int("BREAKER_MIN_CALLS", 10),
+                    window=env_float("BREAKER_WINDOW_SECONDS", 30.0),
+                    slow_call_seconds=env_float("BREAKER_SLOW_CALL_SECONDS", 5.0),
+                    open_seconds=env_float("BREAKER_OPEN_SECONDS", 30.0),
+                )
+    return _breakers
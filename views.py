@@ -0,0 +1,299 @@
+"""Composite GTD views: the reads behind a screen, joined into one document.
+
+    GET /views/next-actions     actionable tasks (no open subtasks), grouped by project
+    GET /views/project/<id>     a project with its sections and task trees
+    GET /views/weekly-review    inbox, overdue and upcoming tasks, per-project health
+
+Each view names the Todoist collections it needs (plan()), fetches them
+concurrently through the same pipeline as the manage endpoints, so cached
+and mirrored reads are served locally, and then joins them in memory
+(build()). Tasks are attached to their parents in a single pass over the
+task list, already sorted by Todoist's order.
+
+Query parameters:
+    next-actions   project_id, label, filter (a Todoist filter query)
+    weekly-review  days (the upcoming horizon, 1-60, default 7)
+    all            today (YYYY-MM-DD, the client's local date; defaults to the server's)
+"""
+import asyncio
+import datetime
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from actions import ActionError, UpstreamCall
+from ratelimit import INTERACTIVE
+from todoist import fetch_todoist, fetch_todoist_async
+
+log = logging.getLogger(__name__)
+
+VIEWS = ("next-actions", "project", "weekly-review")
+MAX_REVIEW_DAYS = 60
+
+
+def plan(view, args, object_id=None):
+    """Returns {resource name: UpstreamCall} for the reads `view` needs; raises ActionError on bad arguments."""
+    _today(args)  # reject a bad date before anything is fetched
+    if view == "next-actions":
+        params = {}
+        for key in ("project_id", "label", "filter"):
+            if args.get(key):
+                params[key] = args[key]
+        return {
+            "projects": UpstreamCall("GET", "/projects"),
+            "sections": UpstreamCall("GET", "/sections", params={"project_id": params["project_id"]}
+                                     if "project_id" in params else None),
+            "labels": UpstreamCall("GET", "/labels"),
+            "tasks": UpstreamCall("GET", "/tasks", params=params),
+        }
+    if view == "project":
+        if not object_id:
+            raise ActionError("A project id is required")
+        return {
+            "project": UpstreamCall("GET", f"/projects/{object_id}"),
+            "sections": UpstreamCall("GET", "/sections", params={"project_id": object_id}),
+            "labels": UpstreamCall("GET", "/labels"),
+            "tasks": UpstreamCall("GET", "/tasks", params={"project_id": object_id}),
+        }
+    if view == "weekly-review":
+        _review_days(args)
+        return {
+            "projects": UpstreamCall("GET", "/projects"),
+            "sections": UpstreamCall("GET", "/sections"),
+            "labels": UpstreamCall("GET", "/labels"),
+            "tasks": UpstreamCall("GET", "/tasks"),
+        }
+    raise ActionError(f"Unknown view '{view}'", status=404)
+
+
+def build(view, args, resources, object_id=None):
+    """Joins the decoded resources fetched for plan()'s calls into the view document."""
+    today = _today(args)
+    if view == "next-actions":
+        return _next_actions(resources, today)
+    if view == "project":
+        return _project(resources, today)
+    return _weekly_review(resources, today, _review_days(args))
+
+
+def run_view(headers, view, args, object_id=None):
+    """Fetches a view's resources concurrently on worker threads and builds it.
+
+    Raises ActionError for bad arguments or a failed Todoist read, and
+    requests.exceptions.RequestException when Todoist can't be reached.
+    """
+    calls = plan(view, args, object_id)
+    with ThreadPoolExecutor(max_workers=len(calls), thread_name_prefix="view") as pool:
+        futures = {name: pool.submit(fetch_todoist, headers, call.method, call.path, params=call.params,
+                                     priority=INTERACTIVE)
+                   for name, call in calls.items()}
+        results = {name: future.result() for name, future in futures.items()}
+    return build(view, args, decode_results(results), object_id)
+
+
+async def run_view_async(headers, view, args, object_id=None):
+    """run_view() for the ASGI mode: the reads run concurrently on the event loop."""
+    calls = plan(view, args, object_id)
+    fetched = await asyncio.gather(*(fetch_todoist_async(headers, call.method, call.path, params=call.params,
+                                                         priority=INTERACTIVE)
+                                     for call in calls.values()))
+    return build(view, args, decode_results(dict(zip(calls, fetched))), object_id)
+
+
+def decode_results(results):
+    """Decodes {name: UpstreamResult} from successful JSON reads; raises ActionError for a failed one."""
+    resources = {}
+    for name, result in results.items():
+        if result.status == 404 and name == "project":
+            raise ActionError("Project not found", status=404)
+        if result.status != 200:
+            log.warning("Read of %s failed with %s", name, result.status)
+            # Auth, rate-limit and server errors keep their status; anything else is a bad gateway
+            status = result.status if result.status in (401, 403, 429) or result.status >= 500 else 502
+            raise ActionError(f"Todoist returned {result.status} when reading {name}: "
+                              f"{result.content[:200].decode('utf-8', 'replace')}", status=status)
+        try:
+            resources[name] = json.loads(result.content)
+        except ValueError:
+            raise ActionError(f"Todoist returned invalid JSON when reading {name}", status=502)
+    return resources
+
+
+def _today(args):
+    value = args.get("today")
+    if not value:
+        return datetime.date.today().isoformat()
+    try:
+        return datetime.date.fromisoformat(value).isoformat()
+    except ValueError:
+        raise ActionError("'today' must be a date in YYYY-MM-DD format")
+
+
+def _review_days(args):
+    value = args.get("days", 7)
+    try:
+        days = int(value)
+    except (TypeError, ValueError):
+        days = 0
+    if not 1 <= days <= MAX_REVIEW_DAYS:
+        raise ActionError(f"'days' must be an integer from 1 to {MAX_REVIEW_DAYS}")
+    return days
+
+
+# --- Joins ---
+
+def _order(item):
+    return item.get("order") or 0
+
+
+def _due_date(task):
+    due = task.get("due") or {}
+    return (due.get("date") or "")[:10]
+
+
+def _compact(task, today):
+    """The fields an agent needs to act on a task; empty and default values are left out."""
+    item = {"id": task["id"], "content": task.get("content", "")}
+    if task.get("description"):
+        item["description"] = task["description"]
+    if (task.get("priority") or 1) > 1:
+        item["priority"] = task["priority"]
+    due = task.get("due")
+    if due:
+        item["due"] = due.get("datetime") or due.get("date")
+        if due.get("is_recurring"):
+            item["recurring"] = True
+        if _due_date(task) < today:
+            item["overdue"] = True
+    if task.get("labels"):
+        item["labels"] = task["labels"]
+    return item
+
+
+def _trees(tasks, today):
+    """Attaches subtasks to their parents; returns the top-level nodes in Todoist's order."""
+    ordered = sorted(tasks, key=_order)
+    nodes = {task["id"]: _compact(task, today) for task in ordered}
+    roots = []
+    for task in ordered:
+        parent = nodes.get(task.get("parent_id"))
+        (parent.setdefault("subtasks", []) if parent is not None else roots).append(nodes[task["id"]])
+    return roots
+
+
+def _label_colors(resources, tasks):
+    used = {name for task in tasks for name in task.get("labels") or ()}
+    return {label["name"]: label.get("color") for label in resources.get("labels") or () if label["name"] in used}
+
+
+def _urgency(task):
+    # Todoist priority 4 is the most urgent (p1); undated tasks sort after dated ones
+    return (-(task.get("priority") or 1), _due_date(task) or "9999", _order(task))
+
+
+def _next_actions(resources, today):
+    tasks = resources["tasks"]
+    has_children = {task.get("parent_id") for task in tasks if task.get("parent_id")}
+    sections = {section["id"]: section.get("name") for section in resources["sections"]}
+    by_project = {}
+    for task in sorted(tasks, key=_urgency):
+        if task["id"] in has_children:
+            continue
+        item = _compact(task, today)
+        if task.get("section_id") in sections:
+            item["section"] = sections[task["section_id"]]
+        by_project.setdefault(task.get("project_id"), []).append(item)
+
+    groups = []
+    for project in sorted(resources["projects"], key=_order):
+        if project["id"] in by_project:
+            groups.append({"project": {"id": project["id"], "name": project.get("name")},
+                           "tasks": by_project.pop(project["id"])})
+    for project_id, items in by_project.items():  # projects not in the listing (e.g. shared, filtered)
+        groups.append({"project": {"id": project_id, "name": None}, "tasks": items})
+    return {
+        "view": "next-actions",
+        "today": today,
+        "count": sum(len(group["tasks"]) for group in groups),
+        "projects": groups,
+        "labels": _label_colors(resources, tasks),
+    }
+
+
+def _project(resources, today):
+    project = resources["project"]
+    tasks = resources["tasks"]
+    roots = _trees(tasks, today)
+    sections = [{"id": section["id"], "name": section.get("name"), "tasks": []}
+                for section in sorted(resources["sections"], key=_order)]
+    by_section = {section["id"]: section for section in sections}
+    section_of = {task["id"]: task.get("section_id") for task in tasks}
+    unsectioned = []
+    for node in roots:
+        section = by_section.get(section_of.get(node["id"]))
+        (section["tasks"] if section is not None else unsectioned).append(node)
+    return {
+        "view": "project",
+        "today": today,
+        "project": {key: project.get(key) for key in ("id", "name", "color", "is_favorite", "view_style", "url")},
+        "open_tasks": len(tasks),
+        "tasks": unsectioned,
+        "sections": sections,
+        "labels": _label_colors(resources, tasks),
+    }
+
+
+def _weekly_review(resources, today, days):
+    horizon = (datetime.date.fromisoformat(today) + datetime.timedelta(days=days)).isoformat()
+    tasks = resources["tasks"]
+    projects = sorted(resources["projects"], key=_order)
+    inbox_ids = {project["id"] for project in projects if project.get("is_inbox_project")}
+    project_names = {project["id"]: project.get("name") for project in projects}
+    section_names = {section["id"]: section.get("name") for section in resources["sections"]}
+
+    inbox, overdue, upcoming = [], [], []
+    per_project = {}
+    for task in sorted(tasks, key=_urgency):
+        item = _compact(task, today)
+        due = _due_date(task)
+        if due and due <= horizon:
+            # Flat lists lose the grouping, so say where each task lives
+            located = dict(item, project=project_names.get(task.get("project_id")))
+            if task.get("section_id") in section_names:
+                located["section"] = section_names[task["section_id"]]
+            (overdue if due < today else upcoming).append(located)
+        stats = per_project.setdefault(task.get("project_id"), {"open_tasks": 0, "overdue": 0, "undated": 0,
+                                                                "next_action": None})
+        stats["open_tasks"] += 1
+        stats["overdue"] += bool(due and due < today)
+        stats["undated"] += not due
+        if stats["next_action"] is None and not task.get("parent_id"):
+            stats["next_action"] = item
+    for task in sorted((t for t in tasks if t.get("project_id") in inbox_ids), key=_order):
+        inbox.append(_compact(task, today))
+    upcoming.sort(key=lambda item: item.get("due") or "")
+
+    summaries, stalled = [], []
+    for project in projects:
+        if project["id"] in inbox_ids:
+            continue
+        stats = per_project.get(project["id"])
+        summary = {"id": project["id"], "name": project.get("name")}
+        if project.get("parent_id"):
+            summary["parent_id"] = project["parent_id"]
+        if stats is None:
+            stalled.append(summary)
+            continue
+        summary.update(stats)
+        summaries.append(summary)
+    return {
+        "view": "weekly-review",
+        "today": today,
+        "horizon": horizon,
+        "inbox": inbox,
+        "overdue": overdue,
+        "upcoming": upcoming,
+        "projects": summaries,
+        "stalled_projects": stalled,
+        "labels": _label_colors(resources, tasks),
+    }
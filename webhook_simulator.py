@@ -0,0 +1,108 @@
+"""Sends signed, Todoist-shaped webhook deliveries to a local /webhooks/todoist for testing.
+
+    TODOIST_CLIENT_SECRET=... python webhook_simulator.py --count 20 --interval 0.5
+
+Each delivery is signed with TODOIST_CLIENT_SECRET (or --secret) the way
+Todoist signs them, with a fresh X-Todoist-Delivery-ID. The events walk
+through a plausible session: tasks are added, updated, completed and
+deleted, with the occasional comment, project and label change.
+--redeliver sends every delivery twice, as Todoist does when it doesn't
+hear back in time, to check that the second copy is dropped.
+"""
+import argparse
+import base64
+import datetime
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import random
+import sys
+import time
+import uuid
+
+import requests
+
+PROJECT_ID = "2203306141"
+
+
+def sign(secret, body):
+    return base64.b64encode(hmac.new(secret.encode("utf-8"), body, hashlib.sha256).digest()).decode("ascii")
+
+
+def events(rng):
+    """Yields (event_name, event_data) forever."""
+    ids = itertools.count(7025000000)
+    open_tasks = []
+    while True:
+        roll = rng.random()
+        if not open_tasks or roll < 0.3:
+            task = {"id": str(next(ids)), "content": f"Simulated task {len(open_tasks) + 1}",
+                    "project_id": PROJECT_ID, "checked": False, "labels": [], "priority": 1}
+            open_tasks.append(task)
+            yield "item:added", dict(task)
+        elif roll < 0.55:
+            task = rng.choice(open_tasks)
+            task["priority"] = rng.randint(1, 4)
+            yield "item:updated", dict(task)
+        elif roll < 0.7:
+            task = open_tasks.pop(rng.randrange(len(open_tasks)))
+            yield "item:completed", dict(task, checked=True)
+        elif roll < 0.8:
+            task = open_tasks.pop(rng.randrange(len(open_tasks)))
+            yield "item:deleted", dict(task, is_deleted=True)
+        elif roll < 0.9:
+            task = rng.choice(open_tasks)
+            yield "note:added", {"id": str(next(ids)), "item_id": task["id"], "content": "Simulated comment"}
+        elif roll < 0.95:
+            yield "project:updated", {"id": PROJECT_ID, "name": f"Simulated project {rng.randint(1, 9)}"}
+        else:
+            yield "label:added", {"id": str(next(ids)), "name": f"context-{rng.randint(1, 99)}"}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--url", default=f"http://127.0.0.1:{os.environ.get('PORT', 10000)}/webhooks/todoist")
+    parser.add_argument("--secret", default=os.environ.get("TODOIST_CLIENT_SECRET"),
+                        help="the Todoist app's client secret (default: $TODOIST_CLIENT_SECRET)")
+    parser.add_argument("--user-id", default=os.environ.get("TODOIST_USER_ID", "2671355"),
+                        help="the Todoist user the events are for; picks the tenant")
+    parser.add_argument("--count", type=int, default=10, help="deliveries to send")
+    parser.add_argument("--interval", type=float, default=0.2, help="seconds between deliveries")
+    parser.add_argument("--seed", type=int, help="random seed, for a repeatable sequence")
+    parser.add_argument("--redeliver", action="store_true", help="send every delivery twice")
+    parser.add_argument("--bad-signature", action="store_true", help="sign with the wrong secret")
+    args = parser.parse_args(argv)
+    if not args.secret:
+        parser.error("set TODOIST_CLIENT_SECRET or pass --secret")
+
+    session = requests.Session()
+    for number, (event_name, data) in enumerate(itertools.islice(events(random.Random(args.seed)), args.count)):
+        body = json.dumps({
+            "event_name": event_name,
+            "user_id": args.user_id,
+            "event_data": data,
+            "initiator": {"id": args.user_id, "full_name": "Webhook Simulator"},
+            "triggered_at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+            "version": "9",
+        }).encode("utf-8")
+        headers = {
+            "Content-Type": "application/json",
+            "User-Agent": "Todoist-Webhooks",
+            "X-Todoist-Hmac-SHA256": sign(args.secret + ("x" if args.bad_signature else ""), body),
+            "X-Todoist-Delivery-ID": str(uuid.uuid4()),
+        }
+        for _ in range(2 if args.redeliver else 1):
+            try:
+                resp = session.post(args.url, data=body, headers=headers, timeout=10)
+            except requests.exceptions.RequestException as e:
+                print(f"{number:4d} {event_name:16s} failed: {e}", file=sys.stderr)
+                return 1
+            print(f"{number:4d} {event_name:16s} {resp.status_code} {resp.text.strip()}")
+        time.sleep(args.interval)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())